@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Measure highlighting time and usage of the cache of dynamic reg exps.
+
+Dynamic RegExpr rules, i.e. here documents, substitute text of the previous match into the pattern.
+Compiled reg exps are cached by the rules.
+Parser is selected with QPART_CPARSER environment variable as usual.
+Usage:
+    dynamic_reg_exp_cache_test.py [FILE]...
+Files from tests/test_syntax/files, which use dynamic RegExpr rules, are shown, if nothing is given
+"""
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax import loader
+
+
+def regExpRules(syntax):
+    """Counters of not dynamic rules are always 0
+    """
+    return [rule for context in syntax.parser.contexts.values() \
+                for rule in context.rules \
+                    if type(rule).__name__ == 'RegExpr']
+
+
+def highlightText(syntax, lines):
+    contextStack = None
+    for line in lines:
+        lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+        contextStack = lineData[0]
+
+
+def main():
+    if len(sys.argv) > 1:
+        filePaths = sys.argv[1:]
+    else:
+        filesDir = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_syntax', 'files')
+        filePaths = [os.path.join(filesDir, name) for name in sorted(os.listdir(filesDir))]
+
+    logging.getLogger('qutepart').setLevel(logging.ERROR)
+    manager = SyntaxManager(headless=True)
+
+    print('Parser: %s' % loader._parserModule.__name__)
+    print('%-30s %8s %10s %10s %10s' % ('File', 'Lines', 'Time', 'Hits', 'Misses'))
+    for filePath in filePaths:
+        syntax = manager.getSyntax(sourceFilePath=filePath)
+        if syntax is None:
+            continue
+        rules = regExpRules(syntax)
+
+        with open(filePath, encoding='utf-8', errors='replace') as file_:
+            lines = file_.read().splitlines()
+
+        hitCount = sum([rule.cacheHitCount for rule in rules])
+        missCount = sum([rule.cacheMissCount for rule in rules])
+        clockBefore = time.perf_counter()
+        highlightText(syntax, lines)
+        elapsed = time.perf_counter() - clockBefore
+        hitCount = sum([rule.cacheHitCount for rule in rules]) - hitCount
+        missCount = sum([rule.cacheMissCount for rule in rules]) - missCount
+        if hitCount + missCount > 0 or len(sys.argv) > 1:
+            print('%-30s %8d %9.3fs %10d %10d' % (os.path.basename(filePath), len(lines), elapsed,
+                                                 hitCount, missCount))
+
+
+if __name__ == '__main__':
+    main()
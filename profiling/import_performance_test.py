@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Measure qutepart import time.
+
+Every measurement is done in a new Python process, because modules are imported only once
+* import qutepart.syntax - syntax manager without Qt widgets
+* import qutepart - whole package. Includes PyQt import and the global SyntaxManager creation
+* SyntaxManager() - syntax database opening
+* detection - first syntax detection by file name, MIME type and first line
+Usage:
+    import_performance_test.py [REPEAT COUNT]
+"""
+
+import os
+import subprocess
+import sys
+
+
+REPEAT_COUNT = 10
+
+_TOP_LEVEL_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+_MEASURE_SCRIPT = """
+import sys
+import time
+sys.path.insert(0, {topLevelPath!r})
+
+clockBefore = time.perf_counter()
+import {module}
+importTime = time.perf_counter() - clockBefore
+
+from qutepart.syntax import SyntaxManager
+clockBefore = time.perf_counter()
+manager = SyntaxManager()
+managerTime = time.perf_counter() - clockBefore
+
+clockBefore = time.perf_counter()
+manager._getXmlFileName(sourceFilePath='/tmp/CMakeLists.txt')
+manager._getXmlFileName(sourceFilePath='/tmp/Makefile.am')
+manager._getXmlFileName(mimeType='text/x-python')
+manager._getXmlFileName(firstLine='#!/bin/sh')
+detectionTime = time.perf_counter() - clockBefore
+
+print(importTime, managerTime, detectionTime)
+"""
+
+
+def measure(module, repeatCount):
+    """Best of repeatCount runs. Returns (import time, SyntaxManager() time, detection time)
+    """
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    script = _MEASURE_SCRIPT.format(topLevelPath=_TOP_LEVEL_PATH, module=module)
+
+    results = []
+    for i in range(repeatCount):
+        output = subprocess.check_output([sys.executable, '-c', script], env=env)
+        results.append([float(value) for value in output.split()])
+
+    return [min(column) for column in zip(*results)]
+
+
+def main():
+    repeatCount = int(sys.argv[1]) if len(sys.argv) > 1 else REPEAT_COUNT
+
+    print('{:<20} {:>10} {:>16} {:>12}'.format('module', 'import ms', 'SyntaxManager ms', 'detection ms'))
+    for module in ('qutepart.syntax', 'qutepart'):
+        importTime, managerTime, detectionTime = measure(module, repeatCount)
+        print('{:<20} {:>10.1f} {:>16.2f} {:>12.2f}'.format(module,
+                                                           importTime * 1000,
+                                                           managerTime * 1000,
+                                                           detectionTime * 1000))
+
+
+if __name__ == '__main__':
+    main()
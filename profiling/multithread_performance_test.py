@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Measure highlighting throughput of several threads.
+
+Every thread highlights its own copy of the files. The C parser releases the GIL,
+while it parses a line, therefore throughput should grow with count of threads.
+Parser is selected with QPART_CPARSER environment variable as usual.
+Usage:
+    multithread_performance_test.py [MAX THREAD COUNT] [FILE]...
+Default is 4 threads and files from tests/test_syntax/files
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax import loader
+
+
+REPEAT_COUNT = 3
+
+
+def highlightDocuments(documents):
+    for syntax, lines in documents:
+        contextStack = None
+        for line in lines:
+            lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+            contextStack = lineData[0]
+
+
+def measure(documents, threadCount):
+    """Best of REPEAT_COUNT runs
+    """
+    times = []
+    for i in range(REPEAT_COUNT):
+        threads = [threading.Thread(target=highlightDocuments, args=(documents,)) \
+                        for threadIndex in range(threadCount)]
+        clockBefore = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        times.append(time.perf_counter() - clockBefore)
+    return min(times)
+
+
+def main():
+    maxThreadCount = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    if len(sys.argv) > 2:
+        filePaths = sys.argv[2:]
+    else:
+        filesDir = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_syntax', 'files')
+        filePaths = [os.path.join(filesDir, name) for name in sorted(os.listdir(filesDir))]
+
+    logging.getLogger('qutepart').setLevel(logging.ERROR)
+    manager = SyntaxManager(headless=True)
+
+    documents = []
+    lineCount = 0
+    for filePath in filePaths:
+        syntax = manager.getSyntax(sourceFilePath=filePath)
+        if syntax is None:
+            continue
+        with open(filePath, encoding='utf-8', errors='replace') as file_:
+            lines = file_.read().splitlines()
+        documents.append((syntax, lines))
+        lineCount += len(lines)
+
+    print('Parser: %s' % loader._parserModule.__name__)
+    print('Files: %d, lines: %d' % (len(documents), lineCount))
+    print('%7s %10s %14s %8s' % ('Threads', 'Time', 'Lines/sec', 'Speedup'))
+    singleThreadThroughput = None
+    threadCount = 1
+    while threadCount <= maxThreadCount:
+        elapsed = measure(documents, threadCount)
+        throughput = lineCount * threadCount / elapsed
+        if singleThreadThroughput is None:
+            singleThreadThroughput = throughput
+        print('%7d %9.2fs %14d %7.2fx' % (threadCount, elapsed, throughput, throughput / singleThreadThroughput))
+        threadCount *= 2
+
+
+if __name__ == '__main__':
+    main()
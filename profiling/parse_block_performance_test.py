@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Compare performance of Syntax.highlightBlock() and Syntax.parseBlock().
+
+parseBlock() only calculates the context stack and is used for invisible lines.
+Parser is selected with QPART_CPARSER environment variable as usual.
+Usage:
+    parse_block_performance_test.py [FILE]...
+Files from tests/test_syntax/files are used, if nothing is given
+"""
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax import loader
+
+
+REPEAT_COUNT = 3
+
+
+def highlightText(syntax, lines):
+    contextStack = None
+    for line in lines:
+        lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+        contextStack = lineData[0]
+
+
+def parseText(syntax, lines):
+    contextStack = None
+    for line in lines:
+        contextStack = syntax.parseBlock(line, contextStack)[0]
+
+
+def measure(function, syntax, lines):
+    """Best of REPEAT_COUNT runs
+    """
+    times = []
+    for i in range(REPEAT_COUNT):
+        clockBefore = time.perf_counter()
+        function(syntax, lines)
+        times.append(time.perf_counter() - clockBefore)
+    return min(times)
+
+
+def main():
+    if len(sys.argv) > 1:
+        filePaths = sys.argv[1:]
+    else:
+        filesDir = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_syntax', 'files')
+        filePaths = [os.path.join(filesDir, name) for name in sorted(os.listdir(filesDir))]
+
+    logging.getLogger('qutepart').setLevel(logging.ERROR)  # highlighting warnings spoil the table
+    manager = SyntaxManager(headless=True)
+
+    print('Parser: %s' % loader._parserModule.__name__)
+    print('%-30s %-20s %7s %10s %10s %8s' % ('File', 'Language', 'Lines', 'highlight', 'parse', 'Speedup'))
+    totalHighlight = 0
+    totalParse = 0
+    for filePath in filePaths:
+        syntax = manager.getSyntax(sourceFilePath=filePath)
+        if syntax is None:
+            print('%-30s no syntax' % os.path.basename(filePath))
+            continue
+
+        with open(filePath, encoding='utf-8', errors='replace') as file_:
+            lines = file_.read().splitlines()
+
+        highlightTime = measure(highlightText, syntax, lines)
+        parseTime = measure(parseText, syntax, lines)
+
+        totalHighlight += highlightTime
+        totalParse += parseTime
+        print('%-30s %-20s %7d %9.2fms %9.2fms %7.2fx' % (os.path.basename(filePath),
+                                                          syntax.name,
+                                                          len(lines),
+                                                          highlightTime * 1000,
+                                                          parseTime * 1000,
+                                                          highlightTime / parseTime))
+
+    if totalParse:
+        print('%-30s %-20s %7s %9.2fms %9.2fms %7.2fx' % ('Total', '', '',
+                                                          totalHighlight * 1000,
+                                                          totalParse * 1000,
+                                                          totalHighlight / totalParse))
+
+
+if __name__ == '__main__':
+    main()
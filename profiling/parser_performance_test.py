@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Measure performance of the Python syntax parser.
+
+Every file is highlighted with and without context dispatch tables.
+Usage:
+    parser_performance_test.py [FILE]...
+Files from tests/test_syntax/files are used, if nothing is given
+"""
+
+import logging
+import os
+import sys
+import time
+
+os.environ['QPART_CPARSER'] = 'N'  # dispatch tables are used only by the Python parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from qutepart.syntax import SyntaxManager
+
+
+REPEAT_COUNT = 3
+
+
+def highlightText(syntax, lines):
+    contextStack = None
+    for line in lines:
+        lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+        contextStack = lineData[0]
+
+
+def measure(syntax, lines):
+    """Best of REPEAT_COUNT runs
+    """
+    times = []
+    for i in range(REPEAT_COUNT):
+        clockBefore = time.perf_counter()
+        highlightText(syntax, lines)
+        times.append(time.perf_counter() - clockBefore)
+    return min(times)
+
+
+def setDispatchTablesEnabled(syntaxes, enabled):
+    for syntax in syntaxes:
+        for context in syntax.parser.contexts.values():
+            if enabled:
+                context.compileDispatchTable()
+            else:
+                context.dispatchTable = None
+
+
+def main():
+    if len(sys.argv) > 1:
+        filePaths = sys.argv[1:]
+    else:
+        filesDir = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_syntax', 'files')
+        filePaths = [os.path.join(filesDir, name) for name in sorted(os.listdir(filesDir))]
+
+    logging.getLogger('qutepart').setLevel(logging.ERROR)  # highlighting warnings spoil the table
+    manager = SyntaxManager()
+
+    print('%-30s %-20s %7s %10s %10s %8s' % ('File', 'Language', 'Lines', 'Without', 'With', 'Speedup'))
+    totalWithout = 0
+    totalWith = 0
+    for filePath in filePaths:
+        syntax = manager.getSyntax(sourceFilePath=filePath)
+        if syntax is None:
+            print('%-30s no syntax' % os.path.basename(filePath))
+            continue
+
+        with open(filePath, encoding='utf-8', errors='replace') as file_:
+            lines = file_.read().splitlines()
+
+        # included syntaxes are loaded too
+        syntaxes = manager._loadedSyntaxes.values()
+
+        setDispatchTablesEnabled(syntaxes, False)
+        timeWithout = measure(syntax, lines)
+        setDispatchTablesEnabled(syntaxes, True)
+        timeWith = measure(syntax, lines)
+
+        totalWithout += timeWithout
+        totalWith += timeWith
+        print('%-30s %-20s %7d %9.1fms %9.1fms %7.2fx' % (os.path.basename(filePath),
+                                                          syntax.name,
+                                                          len(lines),
+                                                          timeWithout * 1000,
+                                                          timeWith * 1000,
+                                                          timeWithout / timeWith))
+
+    if totalWith:
+        print('%-30s %-20s %7s %9.1fms %9.1fms %7.2fx' % ('Total', '', '',
+                                                          totalWithout * 1000,
+                                                          totalWith * 1000,
+                                                          totalWithout / totalWith))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Measure throughput of the C parser per language.
+
+The C parser is built with PCRE2 or with the legacy PCRE, see setup.py.
+Run the test with both builds to compare reg exp engines.
+Usage:
+    reg_exp_engine_performance_test.py [FILE]...
+Files from tests/test_syntax/files are used, if nothing is given
+"""
+
+import logging
+import os
+import sys
+import time
+
+os.environ['QPART_CPARSER'] = 'Y'
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax import loader
+
+
+REPEAT_COUNT = 5
+
+
+def highlightText(syntax, lines):
+    contextStack = None
+    for line in lines:
+        lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+        contextStack = lineData[0]
+
+
+def measure(syntax, lines):
+    """Best of REPEAT_COUNT runs
+    """
+    times = []
+    for i in range(REPEAT_COUNT):
+        clockBefore = time.perf_counter()
+        highlightText(syntax, lines)
+        times.append(time.perf_counter() - clockBefore)
+    return min(times)
+
+
+def main():
+    if len(sys.argv) > 1:
+        filePaths = sys.argv[1:]
+    else:
+        filesDir = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_syntax', 'files')
+        filePaths = [os.path.join(filesDir, name) for name in sorted(os.listdir(filesDir))]
+
+    if not loader.binaryParserAvailable:
+        print('C parser is not available')
+        sys.exit(1)
+
+    logging.getLogger('qutepart').setLevel(logging.ERROR)  # highlighting warnings spoil the table
+    manager = SyntaxManager(headless=True)
+
+    print('Reg exp engine: %s' % loader._parserModule.regExpEngine)
+    print('%-20s %8s %12s' % ('Language', 'Lines', 'Lines/sec'))
+    totalLineCount = 0
+    totalTime = 0.
+    for filePath in filePaths:
+        syntax = manager.getSyntax(sourceFilePath=filePath)
+        if syntax is None:
+            continue
+
+        with open(filePath, encoding='utf-8', errors='replace') as file_:
+            lines = file_.read().splitlines()
+        if not lines:
+            continue
+
+        highlightText(syntax, lines)  # warm up
+        elapsed = measure(syntax, lines)
+        print('%-20s %8d %12d' % (syntax.name, len(lines), len(lines) / elapsed))
+        totalLineCount += len(lines)
+        totalTime += elapsed
+
+    print('%-20s %8d %12d' % ('Total', totalLineCount, totalLineCount / totalTime))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Measure highlighting time with and without RegExpr rules folded into alternations.
+
+See QPART_COMBINE_REGEXPR in the Qutepart documentation.
+Parser is selected with QPART_CPARSER environment variable as usual.
+Usage:
+    reg_expr_alternation_performance_test.py [FILE]...
+Files from tests/test_syntax/files are used, if nothing is given
+"""
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax import loader
+
+
+REPEAT_COUNT = 3
+
+
+def highlightText(syntax, lines):
+    contextStack = None
+    for line in lines:
+        lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+        contextStack = lineData[0]
+
+
+def measure(syntax, lines):
+    """Best of REPEAT_COUNT runs
+    """
+    times = []
+    for i in range(REPEAT_COUNT):
+        clockBefore = time.perf_counter()
+        highlightText(syntax, lines)
+        times.append(time.perf_counter() - clockBefore)
+    return min(times)
+
+
+def alternations(syntax):
+    return [rule for context in syntax.parser.contexts.values() \
+                for rule in context.rules \
+                    if type(rule).__name__ == 'RegExprAlternation']
+
+
+def main():
+    if len(sys.argv) > 1:
+        filePaths = sys.argv[1:]
+    else:
+        filesDir = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_syntax', 'files')
+        filePaths = [os.path.join(filesDir, name) for name in sorted(os.listdir(filesDir))]
+
+    logging.getLogger('qutepart').setLevel(logging.ERROR)
+
+    # a manager per mode, because a manager loads a syntax once
+    separateManager = SyntaxManager(headless=True)
+    combinedManager = SyntaxManager(headless=True)
+
+    print('Parser: %s' % loader._parserModule.__name__)
+    print('%-30s %8s %12s %10s %10s %8s' % ('File', 'Lines', 'Alternations', 'Separate', 'Combined', 'Speedup'))
+    totalSeparateTime = 0.
+    totalCombinedTime = 0.
+    for filePath in filePaths:
+        loader.combineRegExprRules = False
+        separateSyntax = separateManager.getSyntax(sourceFilePath=filePath)
+        loader.combineRegExprRules = True
+        combinedSyntax = combinedManager.getSyntax(sourceFilePath=filePath)
+        if separateSyntax is None:
+            continue
+
+        with open(filePath, encoding='utf-8', errors='replace') as file_:
+            lines = file_.read().splitlines()
+        if not lines:
+            continue
+
+        separateTime = measure(separateSyntax, lines)
+        combinedTime = measure(combinedSyntax, lines)
+        print('%-30s %8d %12d %9.3fs %9.3fs %7.2fx' % (os.path.basename(filePath), len(lines),
+                                                      len(alternations(combinedSyntax)),
+                                                      separateTime, combinedTime, separateTime / combinedTime))
+        totalSeparateTime += separateTime
+        totalCombinedTime += combinedTime
+
+    print('%-30s %8s %12s %9.3fs %9.3fs %7.2fx' % ('Total', '', '', totalSeparateTime, totalCombinedTime,
+                                                  totalSeparateTime / totalCombinedTime))
+
+
+if __name__ == '__main__':
+    main()
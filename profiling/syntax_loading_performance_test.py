@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Measure syntax definitions loading time with and without the on-disk definition cache.
+
+Every XML file from qutepart/syntax/data/xml is loaded by a new SyntaxManager
+* cold - cache is empty. XML file is parsed and the definition is saved to the cache
+* warm - definition is loaded from the cache
+Included syntaxes are loaded too, their time is counted.
+Usage:
+    syntax_loading_performance_test.py [XML FILE NAME]...
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax.cache import DefinitionCache
+
+
+REPEAT_COUNT = 3
+
+
+def measure(xmlFileName, cacheDirectory, clearCache):
+    """Best of REPEAT_COUNT runs
+    """
+    times = []
+    for i in range(REPEAT_COUNT):
+        if clearCache:
+            shutil.rmtree(cacheDirectory, ignore_errors=True)
+        manager = SyntaxManager()
+        manager._definitionCache = DefinitionCache(cacheDirectory)
+        clockBefore = time.perf_counter()
+        manager._getSyntaxByXmlFileName(xmlFileName)
+        times.append(time.perf_counter() - clockBefore)
+    return min(times)
+
+
+def main():
+    xmlFilesDir = os.path.join(os.path.dirname(__file__), '..', 'qutepart', 'syntax', 'data', 'xml')
+    if len(sys.argv) > 1:
+        xmlFileNames = sys.argv[1:]
+    else:
+        xmlFileNames = sorted(name for name in os.listdir(xmlFilesDir) if name.endswith('.xml'))
+
+    logging.getLogger('qutepart').setLevel(logging.ERROR)  # definition warnings spoil the table
+
+    cacheDirectory = tempfile.mkdtemp(prefix='qutepart-syntax-cache-')
+    try:
+        print('%-30s %10s %10s %8s' % ('File', 'Cold', 'Warm', 'Speedup'))
+        totalCold = 0
+        totalWarm = 0
+        for xmlFileName in xmlFileNames:
+            timeCold = measure(xmlFileName, cacheDirectory, True)
+            timeWarm = measure(xmlFileName, cacheDirectory, False)
+
+            totalCold += timeCold
+            totalWarm += timeWarm
+            print('%-30s %9.1fms %9.1fms %7.2fx' % (xmlFileName,
+                                                    timeCold * 1000,
+                                                    timeWarm * 1000,
+                                                    timeCold / timeWarm))
+
+        # cache all the files for measuring the cache size
+        shutil.rmtree(cacheDirectory, ignore_errors=True)
+        manager = SyntaxManager()
+        manager._definitionCache = DefinitionCache(cacheDirectory)
+        for xmlFileName in xmlFileNames:
+            manager._getSyntaxByXmlFileName(xmlFileName)
+        cacheSize = sum(os.path.getsize(os.path.join(cacheDirectory, name)) \
+                            for name in os.listdir(cacheDirectory))
+    finally:
+        shutil.rmtree(cacheDirectory, ignore_errors=True)
+
+    print('%-30s %9.1fms %9.1fms %7.2fx' % ('Total (%d files)' % len(xmlFileNames),
+                                            totalCold * 1000,
+                                            totalWarm * 1000,
+                                            totalCold / totalWarm))
+    print('Cache size: %.1f KiB' % (cacheSize / 1024.))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Measure memory, which text type maps of a big file take.
+
+Text type maps are run-length encoded. Memory is compared with
+a list of characters, which the Python parser used before, and with a string.
+Parser is selected with QPART_CPARSER environment variable as usual.
+Usage:
+    text_type_map_memory_test.py [FILE] [MIN SIZE IN MB]
+The file is repeated until it is at least MIN SIZE long. Default is tests/test_syntax/files/highlight_lpc.c, 1 MB
+"""
+
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax import loader
+
+
+_MB = 1024. * 1024.
+
+
+def main():
+    if len(sys.argv) > 1:
+        filePath = sys.argv[1]
+    else:
+        filePath = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_syntax', 'files', 'highlight_lpc.c')
+    minSize = float(sys.argv[2]) * _MB if len(sys.argv) > 2 else _MB
+
+    logging.getLogger('qutepart').setLevel(logging.ERROR)
+    syntax = SyntaxManager(headless=True).getSyntax(sourceFilePath=filePath)
+    with open(filePath, encoding='utf-8', errors='replace') as file_:
+        fileLines = file_.read().splitlines()
+
+    lines = []
+    size = 0
+    while size < minSize:
+        lines += fileLines
+        size += sum([len(line) + 1 for line in fileLines])
+
+    runCount = 0
+    mapSize = 0
+    listSize = 0
+    stringSize = 0
+    contextStack = None
+    for line in lines:
+        lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+        contextStack, textTypeMap = lineData
+        runCount += textTypeMap.runCount()
+        mapSize += sys.getsizeof(textTypeMap)
+        listSize += sys.getsizeof(list(textTypeMap))
+        stringSize += sys.getsizeof(str(textTypeMap))
+
+    print('Parser:         %s' % loader._parserModule.__name__)
+    print('File:           %s, %d lines, %.2f MB' % (os.path.basename(filePath), len(lines), size / _MB))
+    print('Runs:           %d, %.1f per line' % (runCount, runCount / len(lines)))
+    print('List of chars:  %.2f MB' % (listSize / _MB))
+    print('String:         %.2f MB' % (stringSize / _MB))
+    print('TextTypeMap:    %.2f MB' % (mapSize / _MB))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
+"""Measure time of opening and of typing a file.
+Usage:
+    typing_performance_test.py FILE
+"""
 
+import os
 import sys
 import time
 
 from PyQt5.QtCore import QTimer, Qt
-from PyQt5.QtGui import QApplication
+from PyQt5.QtWidgets import QApplication
 from PyQt5.QtTest import QTest
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import qutepart
 
 
@@ -23,8 +29,18 @@ with open(sys.argv[1], encoding='utf-8') as file_:
 
 clickTimes = {}
 
+markContentsDirtyCallCount = 0
+markContentsDirty = q.document().markContentsDirty
+
+def countingMarkContentsDirty(position, length):
+    global markContentsDirtyCallCount
+    markContentsDirtyCallCount += 1
+    markContentsDirty(position, length)
+
+q.document().markContentsDirty = countingMarkContentsDirty
+
 def click(key):
-    clockBefore = time.clock()
+    clockBefore = time.perf_counter()
 
     if isinstance(key, str):
         QTest.keyClicks(q, key)
@@ -33,12 +49,26 @@ def click(key):
     while app.hasPendingEvents():
         app.processEvents()
 
-    clockAfter = time.clock()
+    clockAfter = time.perf_counter()
     ms = int((clockAfter - clockBefore) * 1000)
     clickTimes[ms] = clickTimes.get(ms, 0) + 1
 
+def openFile():
+    global markContentsDirtyCallCount
+    clockBefore = time.perf_counter()
+    q.text = text
+    while q.isHighlightingInProgress():
+        app.processEvents()
+    clockAfter = time.perf_counter()
+    print('Opened and highlighted {} lines in {:.3f} sec, markContentsDirty() called {} times'.format(
+            len(q.lines), clockAfter - clockBefore, markContentsDirtyCallCount))
+    q.text = ''
+    markContentsDirtyCallCount = 0
+
 def doTest():
-    clockBefore = time.clock()
+    openFile()
+
+    clockBefore = time.perf_counter()
     for line in text.splitlines():
         indentWidth = len(line) - len(line.lstrip())
         while q.textCursor().positionInBlock() > indentWidth:
@@ -51,9 +81,10 @@ def doTest():
             click(char)
         click(Qt.Key_Enter)
 
-    clockAfter = time.clock()
+    clockAfter = time.perf_counter()
     typingTime = clockAfter - clockBefore
     print('Typed {} chars in {} sec. {} ms per character'.format(len(text), typingTime, typingTime * 1000 / len(text)))
+    print('markContentsDirty() called {} times'.format(markContentsDirtyCallCount))
     print('Time per click: count of clicks')
     clickTimeKeys = sorted(clickTimes.keys())
     for ckt in clickTimeKeys:
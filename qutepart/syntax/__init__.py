@@ -2,12 +2,16 @@
 """
 
 import os.path
+import concurrent.futures
 import fnmatch
-import json
 import threading
+import itertools
 import logging
 import re
 
+from qutepart.syntax.cache import DefinitionCache, defaultDirectory as _defaultCacheDirectory
+from qutepart.syntax.database import SyntaxDatabase
+
 _logger = logging.getLogger('qutepart')
 
 class TextFormat:
@@ -64,10 +68,13 @@ class Syntax:
         indenter        Indenter for the syntax. Possible values are
                             none, normal, cstyle, haskell, lilypond, lisp, python, ruby, xml
                         None, if not set by xml file
+        xmlFileName     XML definition file name. None, if not loaded by SyntaxManager
     """
     def __init__(self, manager):
         self.manager = manager
         self.parser = None
+        self.xmlFileName = None
+        self._attributeToFormatMap = {}  # set by the loader
 
     def __str__(self):
         res = 'Syntax\n'
@@ -90,6 +97,7 @@ class Syntax:
         self.parser = parser
         # performance optimization, avoid 1 function call
         self.highlightBlock = parser.highlightBlock
+        self.highlightBlockPart = parser.highlightBlockPart
         self.parseBlock = parser.parseBlock
 
     def highlightBlock(self, text, prevLineData):
@@ -98,10 +106,26 @@ class Syntax:
         where
             lineData is data, which shall be saved and used for parsing next line
             highlightedSegments is list of touples (segmentLength, segmentFormat)
+        lineData[1] is a text type map. It behaves like a string of text type characters,
+        but is run-length encoded. See isCode() and other methods
         """
         #self.parser.parseAndPrintBlockTextualResults(text, prevLineData)
         return self.parser.highlightBlock(text, prevLineData)
 
+    def highlightBlockPart(self, text, contextStack, fromColumnIndex, maxLength):
+        """Parse part of a line of text, which starts at fromColumnIndex,
+        and is at least maxLength symbols long, if the line is long enough.
+        Used for long lines, which shall be highlighted step by step.
+        contextStack is lineData[0] of the previous line, or of the previous part of this line.
+        Returns
+            (lineData, highlightedSegments, columnIndex)
+        where
+            columnIndex is a column, where parsing stopped.
+            If it is equal to len(text), the line is finished.
+            lineData and highlightedSegments describe only the parsed part
+        """
+        return self.parser.highlightBlockPart(text, contextStack, fromColumnIndex, maxLength)
+
     def parseBlock(self, text, prevLineData):
         """Parse line of text and return
             lineData
@@ -110,10 +134,17 @@ class Syntax:
 
         This is quicker version of highlighBlock, which doesn't return results,
         but only parsers the block and produces data, which is necessary for parsing next line.
-        Use it for invisible lines
+        Use it for invisible lines.
+        Text type map of the lineData is empty, isCode() returns True for all columns of such line
         """
         return self.parser.parseBlock(text, prevLineData)
 
+    def formatForAttribute(self, attribute):
+        """Get format, which highlightBlock() returns for the attribute.
+        Used to apply segments, highlighted by a headless syntax, which return attribute names
+        """
+        return self._attributeToFormatMap.get(attribute)
+
     def _getTextType(self, lineData, column):
         """Get text type (letter)
         """
@@ -147,25 +178,118 @@ class Syntax:
         return self._getTextType(lineData, column) ==  'h'
 
 
+class SyntaxFuture:
+    """Syntax, which is being loaded. Returned by SyntaxManager.getSyntaxAsync()
+
+    Definition is parsed on a worker thread, but Syntax is created by result() on the calling thread,
+    because it creates QTextCharFormat's. Call result() on the GUI thread
+    """
+    def __init__(self, manager, xmlFileNames, definitionFuture):
+        self._manager = manager
+        self._xmlFileNames = xmlFileNames  # iterator, consumed by first result() call
+        self._definitionFuture = definitionFuture
+        self._syntax = None
+
+    def done(self):
+        """Definition has been loaded. result() will not block
+        """
+        return self._definitionFuture is None or \
+               self._definitionFuture.done()
+
+    def addDoneCallback(self, callback):
+        """Call callback(future) when definition has been loaded.
+        Callback is called on a worker thread or immediately, if already loaded
+        """
+        if self._definitionFuture is None:
+            callback(self)
+        else:
+            self._definitionFuture.add_done_callback(lambda definitionFuture: callback(self))
+
+    def result(self):
+        """Get Syntax or None, if syntax not found. Waits, if definition is still being loaded
+        """
+        if self._xmlFileNames is not None:
+            self._syntax = self._manager._getSyntaxByXmlFileNames(self._xmlFileNames)
+            self._xmlFileNames = None
+        return self._syntax
+
+
 class SyntaxManager:
     """SyntaxManager holds references to loaded Syntax'es and allows to find or
     load Syntax by its name or by source file name
+
+    Syntaxes of a headless manager don't use Qt. Their highlighted segments contain
+    attribute names instead of QTextCharFormat. See qutepart.syntax.batch
     """
-    def __init__(self):
+    # definitions are preloaded by this count of worker threads
+    _PRELOAD_THREAD_COUNT = 2
+
+    def __init__(self, headless=False):
+        self._headless = headless
         self._loadedSyntaxesLock = threading.RLock()
         self._loadedSyntaxes = {}
-        syntaxDbPath = os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "syntax_db.json")
-        with open(syntaxDbPath, encoding='utf-8') as syntaxDbFile:
-            syntaxDb = json.load(syntaxDbFile)
-        self._syntaxNameToXmlFileName = syntaxDb['syntaxNameToXmlFileName']
-        self._mimeTypeToXmlFileName = syntaxDb['mimeTypeToXmlFileName']
-        self._firstLineToXmlFileName = syntaxDb['firstLineToXmlFileName']
-        globToXmlFileName = syntaxDb['extensionToXmlFileName']
-
-        # Applying glob patterns is really slow. Therefore they are compiled to reg exps
-        self._extensionToXmlFileName = \
-                {re.compile(fnmatch.translate(glob)): xmlFileName \
-                        for glob, xmlFileName in globToXmlFileName.items()}
+        self._definitionCache = DefinitionCache(_defaultCacheDirectory())
+
+        # preloaded definitions. xmlFileName: concurrent.futures.Future
+        self._definitionFuturesLock = threading.Lock()
+        self._definitionFutures = {}
+        self._threadPool = None  # created on first use
+
+        # Database is memory-mapped. Records are decoded on lookup
+        syntaxDbPath = os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "syntax_db.bin")
+        syntaxDb = SyntaxDatabase(syntaxDbPath)
+        self._syntaxNameToXmlFileName = syntaxDb.syntaxNameToXmlFileName
+        self._mimeTypeToXmlFileName = syntaxDb.mimeTypeToXmlFileName
+        self._xmlFileNameToPriority = syntaxDb.xmlFileNameToPriority
+
+        # File name globs are indexed by regenerate-definitions-db.py
+        self._fileNameToXmlFileName = syntaxDb.fileNameToXmlFileName
+        self._suffixToXmlFileName = syntaxDb.suffixToXmlFileName
+        self._syntaxDb = syntaxDb  # glob lists are decoded on first use
+
+        # Applying glob patterns is really slow. Therefore they are compiled to reg exps.
+        # Only globs, which are really checked, are compiled. glob: compiled reg exp
+        self._globRegExps = {}
+
+    def _loadDefinition(self, xmlFileName):
+        """Load definition from the cache or parse xml file.
+        Doesn't use Qt, might be called on a worker thread
+        """
+        import qutepart.syntax.loader  # delayed import for avoid cross-imports problem
+
+        xmlFilePath = os.path.join(os.path.dirname(__file__), "data", "xml", xmlFileName)
+        definition = self._definitionCache.load(xmlFilePath)
+        if definition is None:
+            definition = qutepart.syntax.loader.loadDefinition(xmlFilePath)
+            self._definitionCache.save(xmlFilePath, definition)
+        return definition
+
+    def _preloadDefinition(self, xmlFileName):
+        """Start loading definition on a worker thread.
+        Returns concurrent.futures.Future or None, if syntax is already loaded
+        """
+        if xmlFileName in self._loadedSyntaxes:
+            return None
+
+        with self._definitionFuturesLock:
+            if not xmlFileName in self._definitionFutures:
+                if self._threadPool is None:
+                    self._threadPool = concurrent.futures.ThreadPoolExecutor(self._PRELOAD_THREAD_COUNT)
+                self._definitionFutures[xmlFileName] = \
+                    self._threadPool.submit(self._preloadDefinitionTask, xmlFileName)
+            return self._definitionFutures[xmlFileName]
+
+    def _preloadDefinitionTask(self, xmlFileName):
+        import qutepart.syntax.loader  # delayed import for avoid cross-imports problem
+
+        definition = self._loadDefinition(xmlFileName)
+
+        # syntaxes, which contexts are used, will be loaded together with this one
+        for syntaxName in qutepart.syntax.loader.includedSyntaxNames(definition):
+            if syntaxName in self._syntaxNameToXmlFileName:
+                self._preloadDefinition(self._syntaxNameToXmlFileName[syntaxName])
+
+        return definition
 
     def _getSyntaxByXmlFileName(self, xmlFileName):
         """Get syntax by its xml file name
@@ -174,87 +298,185 @@ class SyntaxManager:
 
         with self._loadedSyntaxesLock:
             if not xmlFileName in self._loadedSyntaxes:
-                xmlFilePath = os.path.join(os.path.dirname(__file__), "data", "xml", xmlFileName)
+                with self._definitionFuturesLock:
+                    definitionFuture = self._definitionFutures.pop(xmlFileName, None)
+
+                if definitionFuture is not None:
+                    definition = definitionFuture.result()  # wait, if still being loaded
+                else:
+                    definition = self._loadDefinition(xmlFileName)
+
                 syntax = Syntax(self)
+                syntax.xmlFileName = xmlFileName
                 self._loadedSyntaxes[xmlFileName] = syntax
-                qutepart.syntax.loader.loadSyntax(syntax, xmlFilePath)
+                try:
+                    qutepart.syntax.loader.applyDefinition(syntax, definition, self._headless)
+                except Exception:
+                    del self._loadedSyntaxes[xmlFileName]
+                    raise
 
             return self._loadedSyntaxes[xmlFileName]
 
-    def _getSyntaxByLanguageName(self, syntaxName):
-        """Get syntax by its name. Name is defined in the xml file
+    def _globRegExp(self, glob):
+        """Compile glob to reg exp on first use
         """
-        xmlFileName = self._syntaxNameToXmlFileName[syntaxName]
-        return self._getSyntaxByXmlFileName(xmlFileName)
+        regExp = self._globRegExps.get(glob)
+        if regExp is None:
+            regExp = re.compile(fnmatch.translate(glob))
+            self._globRegExps[glob] = regExp
+        return regExp
 
-    def _getSyntaxBySourceFileName(self, name):
-        """Get syntax by source name of file, which is going to be highlighted
+    def _getXmlFileNameBySourceFileName(self, name):
+        """Get xml file name by source name of file, which is going to be highlighted
+
+        Definition with the highest priority is used. If priorities are equal, more specific pattern wins:
+        exact name, then longer suffix, then shorter suffix, then glob
         """
-        for regExp, xmlFileName in self._extensionToXmlFileName.items():
-            if regExp.match(name):
-                return self._getSyntaxByXmlFileName(xmlFileName)
-        else:
+        result = self._fileNameToXmlFileName.get(name)
+
+        # suffixes, starting with the longest one. '.tar.gz', '.gz'
+        dotIndex = name.find('.')
+        while dotIndex != -1:
+            xmlFileName = self._suffixToXmlFileName.get(name[dotIndex:])
+            if xmlFileName is not None and \
+               (result is None or
+                self._xmlFileNameToPriority[xmlFileName] > self._xmlFileNameToPriority[result]):
+                result = xmlFileName
+            dotIndex = name.find('.', dotIndex + 1)
+
+        # globs are checked only while they have bigger priority than the found definition.
+        # List is sorted by priority
+        for glob, xmlFileName in self._syntaxDb.globs('fileNameGlobs'):
+            if result is not None and \
+               self._xmlFileNameToPriority[xmlFileName] <= self._xmlFileNameToPriority[result]:
+                break
+            if self._globRegExp(glob).match(name):
+                result = xmlFileName
+                break
+
+        if result is None:
             raise KeyError("No syntax for " + name)
 
-    def _getSyntaxByMimeType(self, mimeType):
-        """Get syntax by first line of the file
-        """
-        xmlFileName = self._mimeTypeToXmlFileName[mimeType]
-        return self._getSyntaxByXmlFileName(xmlFileName)
+        return result
 
-    def _getSyntaxByFirstLine(self, firstLine):
-        """Get syntax by first line of the file
+    def _getXmlFileNameByFirstLine(self, firstLine):
+        """Get xml file name by first line of the file
         """
-        for pattern, xmlFileName in self._firstLineToXmlFileName.items():
-            if fnmatch.fnmatch(firstLine, pattern):
-                return self._getSyntaxByXmlFileName(xmlFileName)
+        for glob, xmlFileName in self._syntaxDb.globs('firstLineGlobs'):
+            if self._globRegExp(glob).match(firstLine):
+                return xmlFileName
         else:
             raise KeyError("No syntax for " + firstLine)
 
-    def getSyntax(self,
-                  xmlFileName=None,
-                  mimeType=None,
-                  languageName=None,
-                  sourceFilePath=None,
-                  firstLine=None):
-        """Get syntax by one of parameters:
-            * xmlFileName
-            * mimeType
-            * languageName
-            * sourceFilePath
-        First parameter in the list has biggest priority
+    def _getXmlFileNames(self,
+                         xmlFileName=None,
+                         mimeType=None,
+                         languageName=None,
+                         sourceFilePath=None,
+                         firstLine=None):
+        """Generate xml file names, found by parameters of getSyntax(), in priority order.
+        Next name is looked up only when loading previous one failed
         """
-        syntax = None
-
-        if syntax is None and xmlFileName is not None:
-            try:
-                syntax = self._getSyntaxByXmlFileName(xmlFileName)
-            except KeyError:
-                _logger.warning('No xml definition %s' % xmlFileName)
+        if xmlFileName is not None:
+            yield xmlFileName
 
-        if syntax is None and mimeType is not None:
+        if mimeType is not None:
             try:
-                syntax = self._getSyntaxByMimeType(mimeType)
+                yield self._mimeTypeToXmlFileName[mimeType]
             except KeyError:
                 _logger.warning('No syntax for mime type %s' % mimeType)
 
-        if syntax is None and languageName is not None:
+        if languageName is not None:
             try:
-                syntax = self._getSyntaxByLanguageName(languageName)
+                yield self._syntaxNameToXmlFileName[languageName]
             except KeyError:
                 _logger.warning('No syntax for language %s' % languageName)
 
-        if syntax is None and sourceFilePath is not None:
+        if sourceFilePath is not None:
             baseName = os.path.basename(sourceFilePath)
             try:
-                syntax = self._getSyntaxBySourceFileName(baseName)
+                yield self._getXmlFileNameBySourceFileName(baseName)
             except KeyError:
                 pass
 
-        if syntax is None and firstLine is not None:
+        if firstLine is not None:
             try:
-                syntax = self._getSyntaxByFirstLine(firstLine)
+                yield self._getXmlFileNameByFirstLine(firstLine)
             except KeyError:
                 pass
 
-        return syntax
+    def _getSyntaxByXmlFileNames(self, xmlFileNames):
+        """Get syntax by first xml file name, which loads without KeyError.
+        Returns None, if none loaded
+        """
+        for xmlFileName in xmlFileNames:
+            try:
+                return self._getSyntaxByXmlFileName(xmlFileName)
+            except KeyError:
+                _logger.warning('Failed to load xml definition %s' % xmlFileName)
+
+        return None
+
+    def getSyntax(self,
+                  xmlFileName=None,
+                  mimeType=None,
+                  languageName=None,
+                  sourceFilePath=None,
+                  firstLine=None):
+        """Get syntax by one of parameters:
+            * xmlFileName
+            * mimeType
+            * languageName
+            * sourceFilePath
+            * firstLine
+        First parameter in the list has biggest priority.
+        If syntax is not found or failed to load with KeyError, next parameter is tried
+        """
+        return self._getSyntaxByXmlFileNames(
+            self._getXmlFileNames(xmlFileName, mimeType, languageName, sourceFilePath, firstLine))
+
+    def getSyntaxAsync(self,
+                       xmlFileName=None,
+                       mimeType=None,
+                       languageName=None,
+                       sourceFilePath=None,
+                       firstLine=None):
+        """Start loading syntax on a worker thread. Parameters are the same as for getSyntax().
+        Only the definition with biggest priority is loaded on the worker thread,
+        fallback definitions are loaded by SyntaxFuture.result()
+        Returns SyntaxFuture
+        """
+        xmlFileNames = self._getXmlFileNames(xmlFileName, mimeType, languageName, sourceFilePath, firstLine)
+        xmlFileName = next(xmlFileNames, None)
+        if xmlFileName is None:
+            definitionFuture = None
+        else:
+            definitionFuture = self._preloadDefinition(xmlFileName)
+            xmlFileNames = itertools.chain([xmlFileName], xmlFileNames)
+
+        return SyntaxFuture(self, xmlFileNames, definitionFuture)
+
+    def preloadAsync(self, languageNames):
+        """Start loading definitions of the languages and included syntaxes on worker threads.
+        getSyntax() creates Syntax quickly, if definition is loaded
+        """
+        for languageName in languageNames:
+            try:
+                xmlFileName = self._syntaxNameToXmlFileName[languageName]
+            except KeyError:
+                _logger.warning('No syntax for language %s' % languageName)
+            else:
+                self._preloadDefinition(xmlFileName)
+
+    def preload(self, languageNames):
+        """Load definitions of the languages and included syntaxes on worker threads.
+        Returns when all definitions are loaded
+        """
+        self.preloadAsync(languageNames)
+
+        while True:  # included syntaxes are scheduled by the worker threads
+            with self._definitionFuturesLock:
+                notDone = [future for future in self._definitionFutures.values() if not future.done()]
+            if not notDone:
+                break
+            concurrent.futures.wait(notDone)
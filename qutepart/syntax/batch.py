@@ -0,0 +1,167 @@
+"""Headless batch highlighter. Tokenizes files without Qt widgets and QApplication,
+i.e. for generating HTML previews on a server.
+
+Token is a tuple (line, start, length, style, textType)
+
+    line        Line index, starting from 0
+    start       Column index of the first symbol
+    length      Count of symbols
+    style       Attribute name from the XML definition, i.e. 'keyword' or 'comment'.
+                None for the text, which is not highlighted
+    textType    ' ' for code, 'c' for comments, 'b' for block comments, 'h' for here documents,
+                's' for strings. See Syntax.isCode() and other methods
+
+Tokens of a line are sorted by start and cover the whole line.
+Segments of Syntax.highlightBlock() are split, if text type changes within a segment,
+and joined, if neighbour segments have the same style and text type.
+"""
+
+import concurrent.futures
+import itertools
+import os
+import os.path
+import time
+
+from qutepart.syntax import SyntaxManager
+
+
+_defaultManager = None  # created on first use. Every worker process has own manager
+
+
+def defaultManager():
+    """Headless SyntaxManager, which is used, if a manager is not passed to the functions
+    """
+    global _defaultManager
+    if _defaultManager is None:
+        _defaultManager = SyntaxManager(headless=True)
+    return _defaultManager
+
+
+def _lineText(line):
+    """Remove line end symbols, if a line has been read from a stream
+    """
+    if line.endswith('\n'):
+        line = line[:-1]
+    if line.endswith('\r'):
+        line = line[:-1]
+    return line
+
+
+def splitLines(text):
+    """Split text to lines as QTextDocument does. '\\n', '\\r\\n' and '\\r' are line separators
+    """
+    return text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+
+
+def tokenizeLines(syntax, lines):
+    """Generate tokens for lines. Lines might be a list or a text stream.
+    Syntax must be loaded by a headless SyntaxManager
+    """
+    highlightBlock = syntax.highlightBlock
+    lineData = None
+    for lineIndex, line in enumerate(lines):
+        text = _lineText(line)
+        prevContextStack = lineData[0] if lineData is not None else None
+        lineData, highlightedSegments = highlightBlock(text, prevContextStack)
+        textTypeMap = str(lineData[1])
+
+        lineTokens = []
+        start = 0
+        for length, style in highlightedSegments:
+            textTypes = textTypeMap[start:start + length]
+            for textType, group in itertools.groupby(textTypes):
+                groupLength = len(list(group))
+                if lineTokens and lineTokens[-1][3] == style and lineTokens[-1][4] == textType:
+                    lastToken = lineTokens[-1]
+                    lineTokens[-1] = (lineIndex, lastToken[1], lastToken[2] + groupLength, style, textType)
+                else:
+                    lineTokens.append((lineIndex, start, groupLength, style, textType))
+                start += groupLength
+
+        yield from lineTokens
+
+
+def tokenizeText(syntax, text):
+    """Generate tokens for a text
+    """
+    return tokenizeLines(syntax, splitLines(text))
+
+
+def tokenizeFile(filePath, manager=None, encoding='utf-8'):
+    """Detect syntax by the file name and the first line and tokenize the file.
+    Returns (syntax, list of tokens) or (None, None), if syntax not found
+    """
+    if manager is None:
+        manager = defaultManager()
+
+    with open(filePath, encoding=encoding, errors='replace', newline='') as sourceFile:
+        text = sourceFile.read()
+
+    lines = splitLines(text)
+    syntax = manager.getSyntax(sourceFilePath=filePath, firstLine=lines[0])
+    if syntax is None:
+        return None, None
+
+    return syntax, list(tokenizeLines(syntax, lines))
+
+
+def highlightChunk(xmlFileName, lines):
+    """Highlight lines with a headless syntax, starting from the default context stack.
+    Used by SyntaxHighlighter for speculative parallel highlighting of huge files.
+    Returns list of (highlightedSegments, textTypeMap, endsInDefaultContext) for every line.
+    Highlighted segments contain attribute names. See Syntax.formatForAttribute()
+    """
+    syntax = defaultManager().getSyntax(xmlFileName=xmlFileName)
+    highlightBlock = syntax.highlightBlock
+
+    results = []
+    contextStack = None
+    for line in lines:
+        lineData, highlightedSegments = highlightBlock(line, contextStack)
+        contextStack = lineData[0]
+        results.append((highlightedSegments, lineData[1], contextStack is None))
+
+    return results
+
+
+def _tokenizeTreeFile(args):
+    """Process pool task. Returns (filePath, syntax name or None, size in bytes, count of tokens, time)
+    """
+    filePath, rootPath, outputDirectory = args
+
+    size = os.path.getsize(filePath)
+    clockBefore = time.perf_counter()
+    try:
+        syntax, tokens = tokenizeFile(filePath)
+    except OSError:
+        return filePath, None, size, 0, 0.
+
+    tokenizingTime = time.perf_counter() - clockBefore
+    if syntax is None:
+        return filePath, None, size, 0, tokenizingTime
+
+    if outputDirectory is not None:
+        outputFilePath = os.path.join(outputDirectory, os.path.relpath(filePath, rootPath) + '.tokens')
+        os.makedirs(os.path.dirname(outputFilePath), exist_ok=True)
+        with open(outputFilePath, 'w', encoding='utf-8') as outputFile:
+            for line, start, length, style, textType in tokens:
+                outputFile.write('%d\t%d\t%d\t%s\t%s\n' % (line, start, length, style or '', textType))
+
+    return filePath, syntax.name, size, len(tokens), tokenizingTime
+
+
+def tokenizeTree(rootPath, processCount=None, outputDirectory=None):
+    """Tokenize all files of a directory tree on a process pool.
+    If outputDirectory is set, tokens of every file are saved to it as tab separated values.
+    Generates (filePath, syntax name or None, size in bytes, count of tokens, time)
+    """
+    filePaths = []
+    for dirPath, dirNames, fileNames in os.walk(rootPath):
+        dirNames.sort()
+        for fileName in sorted(fileNames):
+            filePaths.append(os.path.join(dirPath, fileName))
+
+    tasks = [(filePath, rootPath, outputDirectory) for filePath in filePaths]
+    with concurrent.futures.ProcessPoolExecutor(processCount) as executor:
+        for result in executor.map(_tokenizeTreeFile, tasks, chunksize=8):
+            yield result
@@ -25,7 +25,13 @@
     #include "config.h"
 #endif
 
-#include <pcre.h>
+// setup.py defines QUTEPART_PCRE2, if PCRE2 is found. Legacy PCRE is used otherwise
+#ifdef QUTEPART_PCRE2
+    #define PCRE2_CODE_UNIT_WIDTH 8
+    #include <pcre2.h>
+#else
+    #include <pcre.h>
+#endif
 
 
 #define UNICODE_CHECK(OBJECT, RET) \
@@ -168,7 +174,7 @@
     PyModule_AddObject(m, #TYPE_NAME, (PyObject *)&TYPE_NAME##Type);
 
 
-#define DECLARE_RULE_METHODS_AND_TYPE(RULE_TYPE_NAME) \
+#define _DECLARE_RULE_METHODS_AND_TYPE(RULE_TYPE_NAME, MEMBERS) \
     static void \
     RULE_TYPE_NAME##_dealloc(RULE_TYPE_NAME* self) \
     { \
@@ -184,24 +190,46 @@
         {NULL}  /* Sentinel */ \
     }; \
  \
-    DECLARE_TYPE(RULE_TYPE_NAME, RULE_TYPE_NAME##_methods, #RULE_TYPE_NAME " rule")
+    _DECLARE_TYPE(RULE_TYPE_NAME, (initproc)RULE_TYPE_NAME##_init, RULE_TYPE_NAME##_methods, MEMBERS, \
+                  #RULE_TYPE_NAME " rule")
+
+#define DECLARE_RULE_METHODS_AND_TYPE(RULE_TYPE_NAME) \
+    _DECLARE_RULE_METHODS_AND_TYPE(RULE_TYPE_NAME, 0)
+
+#define DECLARE_RULE_METHODS_AND_TYPE_WITH_MEMBERS(RULE_TYPE_NAME) \
+    _DECLARE_RULE_METHODS_AND_TYPE(RULE_TYPE_NAME, RULE_TYPE_NAME##_members)
 
 
 /********************************************************************************
  *                                Types declaration
  ********************************************************************************/
-#define QUTEPART_MAX_WORD_LENGTH 128  // max found in existing rules when developing the parser is 65
-
-typedef long long int _StringHash;
-
 #define QUTEPART_MAX_CONTEXT_STACK_DEPTH 128
 
+// Groups of a match, including the whole match. Alternations of RegExpr rules have many groups,
+// the loader keeps count of them within the limit
+#define QUTEPART_MAX_MATCH_GROUPS 64
+
 typedef struct {
     size_t size;
     const char** data;
     unsigned int refCount;
 } _RegExpMatchGroups;
 
+// Compiled reg exp and match data of the reg exp engine. See _RegExp_compile()
+#ifdef QUTEPART_PCRE2
+    typedef pcre2_code _RegExp;
+    typedef pcre2_match_data _MatchData;
+#else
+    typedef struct {
+        pcre* code;
+        pcre_extra* extra;
+    } _RegExp;
+
+    typedef struct {
+        int ovector[3 * QUTEPART_MAX_MATCH_GROUPS];  // the last third is a workspace of the engine
+    } _MatchData;
+#endif
+
 typedef struct {
     PyObject_HEAD
     int _popsCount;
@@ -254,17 +282,21 @@ typedef struct {
     PyObject* wholeLineUnicodeTextLower;
     PyObject* wholeLineUtf8Text;
     PyObject* wholeLineUtf8TextLower;
+    Py_UNICODE* wholeLineUnicodeBuffer;  // buffers are used without the GIL
+    Py_UNICODE* wholeLineUnicodeBufferLower;
+    const char* wholeLineUtf8Buffer;
+    size_t wholeLineUtf8Len;  // in bytes
     Py_UNICODE* unicodeText;
     Py_UNICODE* unicodeTextLower;
     const char* utf8Text;
     const char* utf8TextLower;
     size_t textLen;
+    unsigned int firstNonSpaceColumn;  // count of leading spaces in the line
     bool firstNonSpace;
     bool isWordStart;
     size_t wordLength;
-    size_t utf8WordLength;   // word length in bytes of utf8 code
-    char utf8Word[QUTEPART_MAX_WORD_LENGTH];
-    char utf8WordLower[QUTEPART_MAX_WORD_LENGTH];
+    size_t utf8WordLength;   // word length in bytes of utf8 code. The word starts at utf8Text
+    _MatchData* matchData;  // used by reg exps. Owned by the caller
 } TextToMatchObject_internal;
 
 typedef struct {
@@ -294,17 +326,39 @@ typedef struct {
     PyObject* textTypePython;
 } Context;
 
-typedef struct {
+/* Immutable context stack. Frames are linked from the top to the default context stack.
+ * Stacks are interned: every stack keeps a list of its alive children, therefore equal stacks are
+ * the same object, and stacks are compared by pointers
+ */
+typedef struct ContextStack {
     PyObject_HEAD
-    Context* _contexts[QUTEPART_MAX_CONTEXT_STACK_DEPTH];
-    _RegExpMatchGroups* _data[QUTEPART_MAX_CONTEXT_STACK_DEPTH];
+    struct ContextStack* _parent;  // NULL for the default context stack. Owned reference
+    struct ContextStack* _firstChild;  // Children are not owned. A child removes itself from the list, when deleted
+    struct ContextStack* _nextSibling;
+    Context* _context;
+    _RegExpMatchGroups* _data;
     size_t _size;
 } ContextStack;
 
+typedef struct {
+    size_t end;  // column after the last symbol of the run
+    Py_UCS4 textType;
+} _TextTypeRun;
+
+typedef struct {
+    PyObject_HEAD
+    size_t length;
+    size_t runCount;
+    size_t capacity;
+    _TextTypeRun* runs;
+} TextTypeMap;
+
 #define DELIMINATOR_SET_CACHE_SIZE 128
 
 typedef struct {
     PyObject* setAsUnicodeString;
+    Py_UNICODE* setUnicode;  // buffer of setAsUnicodeString. Is used without the GIL
+    Py_ssize_t setLen;
     bool cache[DELIMINATOR_SET_CACHE_SIZE];
 } DeliminatorSet;
 
@@ -319,16 +373,26 @@ typedef struct {
     Context* defaultContext;
     ContextStack* defaultContextStack;
     bool debugOutputEnabled;
+    _MatchData* matchData;  // reused by parsing calls. NULL, while a call uses it
 } Parser;
 
 
 /********************************************************************************
  *                                _RegExpMatchGroups
  ********************************************************************************/
+// group strings are allocated with the engine allocator for the legacy PCRE, see pcre_get_substring_list()
+#ifdef QUTEPART_PCRE2
+    #define _RegExpMatchGroups_mallocData PyMem_RawMalloc
+    #define _RegExpMatchGroups_freeData PyMem_RawFree
+#else
+    #define _RegExpMatchGroups_mallocData pcre_malloc
+    #define _RegExpMatchGroups_freeData pcre_free
+#endif
+
 static _RegExpMatchGroups*
 _RegExpMatchGroups_new(size_t size, const char** data)
 {
-    _RegExpMatchGroups* self = PyMem_Malloc(sizeof *self);
+    _RegExpMatchGroups* self = PyMem_RawMalloc(sizeof *self);  // might be called without the GIL
     self->refCount = 1;
     self->size = size;
     self->data = data;
@@ -346,8 +410,8 @@ _RegExpMatchGroups_release(_RegExpMatchGroups* self)
 
     if (0 == self->refCount)
     {
-        pcre_free((void*)self->data);
-        PyMem_Free(self);
+        _RegExpMatchGroups_freeData((void*)self->data);
+        PyMem_RawFree(self);
     }
 }
 
@@ -359,6 +423,26 @@ _RegExpMatchGroups_duplicate(_RegExpMatchGroups* self)
     return self;
 }
 
+static bool
+_RegExpMatchGroups_equal(_RegExpMatchGroups* self, _RegExpMatchGroups* other)
+{
+    size_t i;
+
+    if (self == other)
+        return true;
+
+    if (NULL == self || NULL == other || self->size != other->size)
+        return false;
+
+    for (i = 0; i < self->size; i++)
+    {
+        if (0 != strcmp(self->data[i], other->data[i]))
+            return false;
+    }
+
+    return true;
+}
+
 static size_t
 _RegExpMatchGroups_size(_RegExpMatchGroups* self)
 {
@@ -374,6 +458,495 @@ _RegExpMatchGroups_getItem(_RegExpMatchGroups* self, unsigned int index)
     return self->data[index];
 }
 
+/********************************************************************************
+ *                                Reg exp engine
+ ********************************************************************************/
+/* Both engines compile patterns anchored and in the UTF-8 mode.
+ * Functions are called without the GIL
+ */
+#ifdef QUTEPART_PCRE2
+
+/* Stop catastrophic backtracking of bad patterns. Such pattern doesn't match.
+ * A legitimate pattern needs more steps on a longer subject, therefore if the limits are hit,
+ * the match is retried with limits, which grow with length of the rest of the line.
+ * The base match limit can be set with QPART_REGEXP_MATCH_LIMIT environment variable
+ */
+#define QUTEPART_MATCH_LIMIT 100000
+#define QUTEPART_MATCH_DEPTH_LIMIT 10000
+#define QUTEPART_MATCH_LIMIT_PER_BYTE 100
+#define QUTEPART_MATCH_DEPTH_LIMIT_PER_BYTE 10
+
+static pcre2_match_context* _matchContext = NULL;  // shared by all threads. Created on module init
+static uint32_t _matchLimit = QUTEPART_MATCH_LIMIT;
+static int _matchLimitWarned = 0;  // the warning is logged once
+
+static void
+_setMatchLimits(pcre2_match_context* context, uint32_t matchLimit, uint32_t depthLimit)
+{
+    pcre2_set_match_limit(context, matchLimit);
+#if PCRE2_MAJOR > 10 || PCRE2_MINOR >= 30
+    pcre2_set_depth_limit(context, depthLimit);
+#else
+    pcre2_set_recursion_limit(context, depthLimit);
+#endif
+}
+
+static bool
+_RegExp_initEngine(void)
+{
+    const char* matchLimitString = getenv("QPART_REGEXP_MATCH_LIMIT");
+    if (NULL != matchLimitString)
+    {
+        unsigned long matchLimit = strtoul(matchLimitString, NULL, 10);
+        if (matchLimit > 0 && matchLimit <= UINT32_MAX)
+            _matchLimit = matchLimit;
+    }
+
+    _matchContext = pcre2_match_context_create(NULL);
+    if (NULL == _matchContext)
+        return false;
+
+    _setMatchLimits(_matchContext, _matchLimit, QUTEPART_MATCH_DEPTH_LIMIT);
+    return true;
+}
+
+static uint32_t
+_scaledLimit(uint32_t limit, uint32_t limitPerByte, size_t length)
+{
+    if (length >= (UINT32_MAX - limit) / limitPerByte)
+        return UINT32_MAX;
+    else
+        return limit + limitPerByte * length;
+}
+
+/* Log to the qutepart logger. Called without the GIL
+ */
+static void
+_warnMatchLimitOnce(size_t length)
+{
+    PyGILState_STATE gilState;
+    PyObject* logging;
+
+    if (_matchLimitWarned)
+        return;
+    _matchLimitWarned = 1;
+
+    gilState = PyGILState_Ensure();
+    logging = PyImport_ImportModule("logging");
+    if (NULL != logging)
+    {
+        PyObject* logger = PyObject_CallMethod(logging, "getLogger", "s", "qutepart");
+        if (NULL != logger)
+        {
+            PyObject* result = PyObject_CallMethod(logger, "warning", "sn",
+                                                   "Reg exp match limit exceeded on a line of %d bytes. "
+                                                   "The rule doesn't match. "
+                                                   "Set QPART_REGEXP_MATCH_LIMIT to increase the limit",
+                                                   (Py_ssize_t)length);
+            Py_XDECREF(result);
+            Py_DECREF(logger);
+        }
+        Py_DECREF(logging);
+    }
+    PyErr_Clear();
+    PyGILState_Release(gilState);
+}
+
+static _RegExp*
+_RegExp_compile(const char* utf8String, bool insensitive, bool minimal)
+{
+    int errorCode = 0;
+    PCRE2_SIZE errorOffset = 0;
+    pcre2_code* regExp;
+
+    uint32_t options = PCRE2_ANCHORED | PCRE2_UTF | PCRE2_NO_UTF_CHECK;
+    if (insensitive)
+        options |= PCRE2_CASELESS;
+
+    if (minimal)
+        options |= PCRE2_UNGREEDY;  // NOTE this flag works correctly only if reg exp patterns are greedy by default
+
+    regExp = pcre2_compile((PCRE2_SPTR)utf8String, PCRE2_ZERO_TERMINATED,
+                           options,
+                           &errorCode, &errorOffset, NULL);
+
+    if (NULL == regExp)
+    {
+        PCRE2_UCHAR message[256];
+        pcre2_get_error_message(errorCode, message, sizeof message);
+        fprintf(stderr, "Failed to compile reg exp. At pos %d: %s. Pattern: '%s'\n",
+                (int)errorOffset, (const char*)message, utf8String);
+        return NULL;
+    }
+
+    // the interpreter is used, if JIT is not supported on the platform
+    pcre2_jit_compile(regExp, PCRE2_JIT_COMPLETE);
+
+    return regExp;
+}
+
+static void
+_RegExp_free(_RegExp* self)
+{
+    if (NULL != self)
+        pcre2_code_free(self);
+}
+
+static _MatchData*
+_MatchData_new(void)
+{
+    return pcre2_match_data_create(QUTEPART_MAX_MATCH_GROUPS, NULL);
+}
+
+static void
+_MatchData_free(_MatchData* self)
+{
+    if (NULL != self)
+        pcre2_match_data_free(self);
+}
+
+/* Copy matched groups to one buffer, in the format of pcre_get_substring_list()
+ */
+static _RegExpMatchGroups*
+_makeMatchGroups(const char* utf8Text, PCRE2_SIZE* ovector, int count)
+{
+    size_t memsize = (count + 1) * sizeof(const char*);
+    const char** data;
+    char* freeSpaceForString;
+    int i;
+
+    for (i = 0; i < count; i++)
+    {
+        if (ovector[2 * i] != PCRE2_UNSET)
+            memsize += ovector[2 * i + 1] - ovector[2 * i];
+        memsize += 1;  // null char
+    }
+
+    data = _RegExpMatchGroups_mallocData(memsize);
+    if (NULL == data)
+        return NULL;
+
+    freeSpaceForString = (char*)(data + count + 1);
+    for (i = 0; i < count; i++)
+    {
+        size_t length = 0;
+        if (ovector[2 * i] != PCRE2_UNSET)
+        {
+            length = ovector[2 * i + 1] - ovector[2 * i];
+            memcpy(freeSpaceForString, utf8Text + ovector[2 * i], length);
+        }
+        freeSpaceForString[length] = '\0';
+        data[i] = freeSpaceForString;
+        freeSpaceForString += length + 1;
+    }
+    data[count] = NULL;
+
+    return _RegExpMatchGroups_new(count, data);
+}
+
+/* Call the engine. Returns count of groups in the match data, 0 if not matched
+ */
+static int
+_RegExp_exec(_RegExp* self, _MatchData* matchData,
+             const char* utf8Line, size_t lineLen, size_t startOffset)
+{
+    uint32_t options = PCRE2_NOTEMPTY | PCRE2_NO_UTF_CHECK;
+    int rc = pcre2_match(self, (PCRE2_SPTR)utf8Line, lineLen, startOffset, options, matchData, _matchContext);
+
+    if (rc == PCRE2_ERROR_JIT_STACKLIMIT)  // the interpreter doesn't use the JIT stack
+        rc = pcre2_match(self, (PCRE2_SPTR)utf8Line, lineLen, startOffset, options | PCRE2_NO_JIT,
+                         matchData, _matchContext);
+
+    if (rc == PCRE2_ERROR_MATCHLIMIT || rc == PCRE2_ERROR_DEPTHLIMIT)
+    {
+        pcre2_match_context* context = pcre2_match_context_copy(_matchContext);
+        if (NULL != context)
+        {
+            size_t length = lineLen - startOffset;
+            _setMatchLimits(context,
+                            _scaledLimit(_matchLimit, QUTEPART_MATCH_LIMIT_PER_BYTE, length),
+                            _scaledLimit(QUTEPART_MATCH_DEPTH_LIMIT, QUTEPART_MATCH_DEPTH_LIMIT_PER_BYTE, length));
+            rc = pcre2_match(self, (PCRE2_SPTR)utf8Line, lineLen, startOffset, options, matchData, context);
+            if (rc == PCRE2_ERROR_JIT_STACKLIMIT)
+                rc = pcre2_match(self, (PCRE2_SPTR)utf8Line, lineLen, startOffset, options | PCRE2_NO_JIT,
+                                 matchData, context);
+            pcre2_match_context_free(context);
+        }
+
+        if (rc == PCRE2_ERROR_MATCHLIMIT || rc == PCRE2_ERROR_DEPTHLIMIT)
+            _warnMatchLimitOnce(lineLen);
+    }
+
+    if (rc == 0)  // more groups than fit the match data
+    {
+        return pcre2_get_ovector_count(matchData);
+    }
+    else if (rc > 0)
+    {
+        return rc;
+    }
+    else
+    {
+        if (rc != PCRE2_ERROR_NOMATCH &&
+            rc != PCRE2_ERROR_MATCHLIMIT &&
+            rc != PCRE2_ERROR_DEPTHLIMIT)
+            fprintf(stderr, "Failed to call pcre2_match: error %d\n", rc);
+        return 0;
+    }
+}
+
+/* Match the line at startOffset. Offsets and lengths are in bytes.
+ * The line before startOffset is visible to ^, \b and look-behind assertions.
+ * Returns length of the match, 0 if not matched
+ */
+static int
+_RegExp_match(_RegExp* self, _MatchData* matchData,
+              const char* utf8Line, size_t lineLen, size_t startOffset,
+              _RegExpMatchGroups** pGroups)
+{
+    PCRE2_SIZE* ovector;
+    int count = _RegExp_exec(self, matchData, utf8Line, lineLen, startOffset);
+
+    if (0 == count)
+        return 0;
+
+    ovector = pcre2_get_ovector_pointer(matchData);
+    if (NULL != pGroups)
+        *pGroups = _makeMatchGroups(utf8Line, ovector, count);
+
+    return ovector[1] - ovector[0];
+}
+
+/* Match an alternation, which has a group per alternative, see RegExprAlternation.
+ * groupCounts contains count of groups of every alternative, including the group of the alternative.
+ * *pAlternative is set to index of the matched alternative, *pGroups to the groups of the alternative,
+ * as if its pattern was matched alone. Returns length of the match, 0 if not matched
+ */
+static int
+_RegExp_matchAlternation(_RegExp* self, _MatchData* matchData,
+                         const char* utf8Line, size_t lineLen, size_t startOffset,
+                         const int* groupIndexes, const int* groupCounts, size_t alternativeCount,
+                         size_t* pAlternative, _RegExpMatchGroups** pGroups)
+{
+    PCRE2_SIZE* ovector;
+    size_t i;
+    int count = _RegExp_exec(self, matchData, utf8Line, lineLen, startOffset);
+
+    if (0 == count)
+        return 0;
+
+    ovector = pcre2_get_ovector_pointer(matchData);
+    for (i = 0; i < alternativeCount; i++)
+    {
+        int index = groupIndexes[i];
+        if (index < count && ovector[2 * index] != PCRE2_UNSET)
+        {
+            // not set groups in the end are not counted by the engine
+            int groupCount = groupCounts[i] < count - index ? groupCounts[i] : count - index;
+            *pAlternative = i;
+            *pGroups = _makeMatchGroups(utf8Line, ovector + 2 * index, groupCount);
+            return ovector[1] - ovector[0];
+        }
+    }
+
+    return 0;
+}
+
+/* Index of a named group. Negative, if not found
+ */
+static int
+_RegExp_groupIndex(_RegExp* self, const char* name)
+{
+    return pcre2_substring_number_from_name(self, (PCRE2_SPTR)name);
+}
+
+/* Count of capturing groups of the pattern, not including the whole match
+ */
+static int
+_RegExp_captureCount(_RegExp* self)
+{
+    uint32_t captureCount = 0;
+    pcre2_pattern_info(self, PCRE2_INFO_CAPTURECOUNT, &captureCount);
+    return (int)captureCount;
+}
+
+#else  // legacy PCRE
+
+static bool
+_RegExp_initEngine(void)
+{
+    return true;
+}
+
+static _RegExp*
+_RegExp_compile(const char* utf8String, bool insensitive, bool minimal)
+{
+    const char* errptr = NULL;
+    int erroffset = 0;
+    _RegExp* regExp;
+    pcre* code;
+
+    int options = PCRE_ANCHORED | PCRE_UTF8 | PCRE_NO_UTF8_CHECK;
+    if (insensitive)
+        options |= PCRE_CASELESS;
+
+    if (minimal)
+        options |= PCRE_UNGREEDY;  // NOTE this flag works correctly only if reg exp patterns are greedy by default
+
+    code = pcre_compile(utf8String,
+                        options,
+                        &errptr, &erroffset, NULL);
+
+    if (NULL == code)
+    {
+        if (NULL != errptr)
+            fprintf(stderr, "Failed to compile reg exp. At pos %d: %s. Pattern: '%s'\n", erroffset, errptr, utf8String);
+        else
+            fprintf(stderr, "Failed to compile reg exp. Pattern: '%s'\n", utf8String);
+        return NULL;
+    }
+
+    regExp = PyMem_RawMalloc(sizeof *regExp);
+    if (NULL == regExp)
+    {
+        pcre_free(code);
+        return NULL;
+    }
+
+#if defined PCRE_STUDY_JIT_COMPILE
+    #define STUDY_OPTIONS PCRE_STUDY_JIT_COMPILE
+#else
+    #define STUDY_OPTIONS 0
+#endif
+    regExp->code = code;
+    regExp->extra = pcre_study(code, STUDY_OPTIONS, &errptr);
+
+    return regExp;
+}
+
+static void
+_RegExp_free(_RegExp* self)
+{
+    if (NULL == self)
+        return;
+
+    pcre_free(self->code);
+    if (NULL != self->extra)
+        pcre_free_study(self->extra);
+    PyMem_RawFree(self);
+}
+
+static _MatchData*
+_MatchData_new(void)
+{
+    return PyMem_RawMalloc(sizeof(_MatchData));
+}
+
+static void
+_MatchData_free(_MatchData* self)
+{
+    PyMem_RawFree(self);
+}
+
+/* Call the engine. See the PCRE2 version
+ */
+static int
+_RegExp_exec(_RegExp* self, _MatchData* matchData,
+             const char* utf8Line, size_t lineLen, size_t startOffset)
+{
+    int rc = pcre_exec(self->code, self->extra,
+                       utf8Line, lineLen,
+                       startOffset, PCRE_NOTEMPTY | PCRE_NO_UTF8_CHECK,
+                       matchData->ovector, sizeof matchData->ovector / sizeof matchData->ovector[0]);
+
+    if (rc > 0)
+    {
+        return rc;
+    }
+    else
+    {
+        if (rc < 0 && rc != PCRE_ERROR_NOMATCH)
+            fprintf(stderr, "Failed to call pcre_exec: error %d\n", rc);
+        return 0;
+    }
+}
+
+/* Match the line at startOffset. See the PCRE2 version
+ */
+static int
+_RegExp_match(_RegExp* self, _MatchData* matchData,
+              const char* utf8Line, size_t lineLen, size_t startOffset,
+              _RegExpMatchGroups** pGroups)
+{
+    int* ovector = matchData->ovector;
+    int count = _RegExp_exec(self, matchData, utf8Line, lineLen, startOffset);
+
+    if (0 == count)
+        return 0;
+
+    if (NULL != pGroups)
+    {
+        const char** data = NULL;
+        pcre_get_substring_list(utf8Line, ovector, count, &data);
+        *pGroups = _RegExpMatchGroups_new(count, data);
+    }
+
+    return ovector[1] - ovector[0];
+}
+
+/* Match an alternation. See the PCRE2 version
+ */
+static int
+_RegExp_matchAlternation(_RegExp* self, _MatchData* matchData,
+                         const char* utf8Line, size_t lineLen, size_t startOffset,
+                         const int* groupIndexes, const int* groupCounts, size_t alternativeCount,
+                         size_t* pAlternative, _RegExpMatchGroups** pGroups)
+{
+    int* ovector = matchData->ovector;
+    size_t i;
+    int count = _RegExp_exec(self, matchData, utf8Line, lineLen, startOffset);
+
+    if (0 == count)
+        return 0;
+
+    for (i = 0; i < alternativeCount; i++)
+    {
+        int index = groupIndexes[i];
+        if (index < count && ovector[2 * index] != -1)
+        {
+            const char** data = NULL;
+            int groupCount = groupCounts[i] < count - index ? groupCounts[i] : count - index;
+            pcre_get_substring_list(utf8Line, ovector + 2 * index, groupCount, &data);
+            *pAlternative = i;
+            *pGroups = _RegExpMatchGroups_new(groupCount, data);
+            return ovector[1] - ovector[0];
+        }
+    }
+
+    return 0;
+}
+
+/* Index of a named group. Negative, if not found
+ */
+static int
+_RegExp_groupIndex(_RegExp* self, const char* name)
+{
+    return pcre_get_stringnumber(self->code, name);
+}
+
+/* Count of capturing groups of the pattern. See the PCRE2 version
+ */
+static int
+_RegExp_captureCount(_RegExp* self)
+{
+    int captureCount = 0;
+    pcre_fullinfo(self->code, self->extra, PCRE_INFO_CAPTURECOUNT, &captureCount);
+    return captureCount;
+}
+
+#endif  // QUTEPART_PCRE2
+
+
 /********************************************************************************
  *                                _listToDynamicallyAllocatedArray
  ********************************************************************************/
@@ -396,13 +969,10 @@ _listToDynamicallyAllocatedArray(PyObject* list, size_t* size)
  *                                DeliminatorSet
  ********************************************************************************/
 static bool
-_isDeliminatorNoCache(Py_UNICODE character, PyObject* setAsUnicodeString)
+_isDeliminatorNoCache(Py_UNICODE character, Py_UNICODE* deliminatorSetUnicode, Py_ssize_t deliminatorSetLen)
 {
-    Py_ssize_t deliminatorSetLen = PyUnicode_GET_SIZE(setAsUnicodeString);
     Py_ssize_t i;
 
-    Py_UNICODE* deliminatorSetUnicode = PyUnicode_AS_UNICODE(setAsUnicodeString);
-
     for(i = 0; i < deliminatorSetLen; i++)
         if (deliminatorSetUnicode[i] == character)
             return true;
@@ -416,7 +986,7 @@ _isDeliminator(Py_UNICODE character, DeliminatorSet* deliminatorSet)
     if (character < DELIMINATOR_SET_CACHE_SIZE)
         return deliminatorSet->cache[character];
     else
-        return _isDeliminatorNoCache(character, deliminatorSet->setAsUnicodeString);
+        return _isDeliminatorNoCache(character, deliminatorSet->setUnicode, deliminatorSet->setLen);
 }
 
 static DeliminatorSet
@@ -424,8 +994,11 @@ _MakeDeliminatorSet(PyObject* setAsUnicodeString)
 {
     DeliminatorSet deliminatorSet;
     unsigned int i;
+
+    deliminatorSet.setUnicode = PyUnicode_AS_UNICODE(setAsUnicodeString);
+    deliminatorSet.setLen = PyUnicode_GET_SIZE(setAsUnicodeString);
     for (i = 0; i < DELIMINATOR_SET_CACHE_SIZE; i++)
-        deliminatorSet.cache[i] = _isDeliminatorNoCache(i, setAsUnicodeString);
+        deliminatorSet.cache[i] = _isDeliminatorNoCache(i, deliminatorSet.setUnicode, deliminatorSet.setLen);
 
     deliminatorSet.setAsUnicodeString = setAsUnicodeString;
     Py_INCREF(deliminatorSet.setAsUnicodeString);
@@ -529,14 +1102,25 @@ static PyMemberDef RuleTryMatchResult_members[] = {
 DECLARE_TYPE_WITHOUT_CONSTRUCTOR_WITH_MEMBERS(RuleTryMatchResult, NULL, "Rule.tryMatch() result structure");
 
 static RuleTryMatchResult*
-RuleTryMatchResult_new(PyObject* rule, size_t length)  // not a constructor, just C function
+RuleTryMatchResult_new(PyObject* rule, size_t length, _RegExpMatchGroups* data)  // not a constructor, just C function
 {
     RuleTryMatchResult* result = PyObject_New(RuleTryMatchResult, &RuleTryMatchResultType);
     result->rule = rule;
     Py_INCREF(result->rule);
     result->length = length;
-    result->data = Py_None;
-    Py_INCREF(result->data);
+
+    if (NULL != data)
+    {
+        size_t i;
+        result->data = PyTuple_New(data->size);
+        for (i = 0; i < data->size; i++)
+            PyTuple_SET_ITEM(result->data, i, PyUnicode_FromString(data->data[i]));
+    }
+    else
+    {
+        result->data = Py_None;
+        Py_INCREF(result->data);
+    }
 
     return result;
 }
@@ -562,6 +1146,21 @@ _utf8TextCharacterLength(char character)
     return 1;
 }
 
+static size_t
+_utf8CharacterCount(const char* utf8Text, int byteCount)
+{
+    size_t count = 0;
+    int i;
+
+    for (i = 0; i < byteCount; i++)
+    {
+        if ((utf8Text[i] & 0xc0) != 0x80)  // not a continuation byte
+            count++;
+    }
+
+    return count;
+}
+
 static void
 _utf8CharacterLengthTable_init(void)
 {
@@ -574,6 +1173,7 @@ static TextToMatchObject_internal
 TextToMatchObject_internal_make(unsigned int column, PyObject* unicodeText, _RegExpMatchGroups* contextData)
 {
     TextToMatchObject_internal textToMatchObject;
+    Py_UNICODE* unicodeBuffer = PyUnicode_AS_UNICODE(unicodeText);
 
     textToMatchObject.wholeLineLen = PyUnicode_GET_SIZE(unicodeText);
     textToMatchObject.currentColumnIndex = column;
@@ -581,16 +1181,25 @@ TextToMatchObject_internal_make(unsigned int column, PyObject* unicodeText, _Reg
     textToMatchObject.wholeLineUnicodeTextLower = PyObject_CallMethod(unicodeText, "lower", "");
     textToMatchObject.wholeLineUtf8Text = PyUnicode_AsUTF8String(unicodeText);
     textToMatchObject.wholeLineUtf8TextLower = PyUnicode_AsUTF8String(textToMatchObject.wholeLineUnicodeTextLower);
-    textToMatchObject.utf8Text = PyBytes_AsString(textToMatchObject.wholeLineUtf8Text);
+    textToMatchObject.wholeLineUtf8Buffer = PyBytes_AsString(textToMatchObject.wholeLineUtf8Text);
+    textToMatchObject.wholeLineUtf8Len = PyBytes_Size(textToMatchObject.wholeLineUtf8Text);
+    textToMatchObject.utf8Text = textToMatchObject.wholeLineUtf8Buffer;
     textToMatchObject.utf8TextLower = PyBytes_AsString(textToMatchObject.wholeLineUtf8TextLower);
+    textToMatchObject.wholeLineUnicodeBuffer = unicodeBuffer;
+    textToMatchObject.wholeLineUnicodeBufferLower = PyUnicode_AS_UNICODE(textToMatchObject.wholeLineUnicodeTextLower);
+
+    textToMatchObject.firstNonSpaceColumn = 0;
+    while (textToMatchObject.firstNonSpaceColumn < textToMatchObject.wholeLineLen &&
+           Py_UNICODE_ISSPACE(unicodeBuffer[textToMatchObject.firstNonSpaceColumn]))
+        textToMatchObject.firstNonSpaceColumn++;
 
     // text and textLen is updated in the loop
     textToMatchObject.textLen = textToMatchObject.wholeLineLen;
-    textToMatchObject.firstNonSpace = true;  // updated in the loop
-    // isWordStart, wordLength is updated in the loop
+    // firstNonSpace, isWordStart, wordLength is updated in the loop
     textToMatchObject.firstNonSpace = true;
     textToMatchObject.isWordStart = true;
     textToMatchObject.contextData = contextData;
+    textToMatchObject.matchData = NULL;
 
     return textToMatchObject;
 }
@@ -611,8 +1220,8 @@ TextToMatchObject_internal_update(TextToMatchObject_internal* self,
     unsigned int i;
     unsigned int prevTextLen;
     unsigned int step;
-    Py_UNICODE* wholeLineUnicodeBuffer = PyUnicode_AS_UNICODE(self->wholeLineUnicodeText);
-    Py_UNICODE* wholeLineUnicodeBufferLower = PyUnicode_AS_UNICODE(self->wholeLineUnicodeTextLower);
+    Py_UNICODE* wholeLineUnicodeBuffer = self->wholeLineUnicodeBuffer;
+    Py_UNICODE* wholeLineUnicodeBufferLower = self->wholeLineUnicodeBufferLower;
 
    // update text, textLen, column
     self->unicodeText = wholeLineUnicodeBuffer + currentColumnIndex;
@@ -630,14 +1239,13 @@ TextToMatchObject_internal_update(TextToMatchObject_internal* self,
         self->utf8TextLower += firstCharacterLength;
     }
 
+    self->firstNonSpace = currentColumnIndex <= self->firstNonSpaceColumn;
+
     if (currentColumnIndex > 0)
     {
         Py_UNICODE prevChar = wholeLineUnicodeBuffer[currentColumnIndex - 1];
         bool previousCharIsSpace = Py_UNICODE_ISSPACE(prevChar);
 
-        // update firstNonSpace
-        self->firstNonSpace = self->firstNonSpace && previousCharIsSpace;
-
         // update isWordStart and wordLength
         self->isWordStart = previousCharIsSpace ||
                             _isDeliminator(prevChar, deliminatorSet);
@@ -663,46 +1271,6 @@ TextToMatchObject_internal_update(TextToMatchObject_internal* self,
                 self->wordLength++;
                 self->utf8WordLength += _utf8CharacterLengthTable[(unsigned char)self->utf8Text[self->utf8WordLength]];
             }
-
-            if (self->utf8WordLength > QUTEPART_MAX_WORD_LENGTH)
-            {
-                self->utf8WordLength = 0;
-            }
-            else if (self->utf8WordLength <= sizeof(_StringHash) &&
-                     self->textLen >= sizeof(_StringHash))  // may use optimized version of strncpy
-            {
-                static const char maskForDifferenceChar[8][8] =
-                {
-                    {0xff, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00},
-                    {0xff, 0xff, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00},
-                    {0xff, 0xff, 0xff, 0x00, 0x00, 0x00, 0x00, 0x00},
-                    {0xff, 0xff, 0xff, 0xff, 0x00, 0x00, 0x00, 0x00},
-                    {0xff, 0xff, 0xff, 0xff, 0xff, 0x00, 0x00, 0x00},
-                    {0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x00, 0x00},
-                    {0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x00},
-                    {0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff}
-                };
-
-                _StringHash* pMask = (_StringHash*)maskForDifferenceChar[self->utf8WordLength - 1];
-                _StringHash mask = *pMask;
-
-                _StringHash* pUtf8Word = (_StringHash*)self->utf8Word;
-                _StringHash* pUtf8WordLower = (_StringHash*)self->utf8WordLower;
-                _StringHash* pUtf8Text = (_StringHash*)self->utf8Text;
-                _StringHash* pUtf8TextLower = (_StringHash*)self->utf8TextLower;
-                *pUtf8Word = *pUtf8Text & mask;
-                *pUtf8WordLower = *pUtf8TextLower & mask;
-            }
-            else
-            {
-                memset(self->utf8Word, 0, sizeof(_StringHash));
-                strncpy(self->utf8Word, self->utf8Text, self->utf8WordLength);  // without \0
-                self->utf8Word[self->utf8WordLength] = '\0';
-
-                memset(self->utf8WordLower, 0, sizeof(_StringHash));
-                strncpy(self->utf8WordLower, self->utf8TextLower, self->utf8WordLength);  // without \0
-                self->utf8WordLower[self->utf8WordLength] = '\0';
-            }
         }
     }
     else
@@ -717,6 +1285,7 @@ TextToMatchObject_dealloc(TextToMatchObject* self)
 {
     Py_XDECREF(self->internal.wholeLineUnicodeText);
     _RegExpMatchGroups_release(self->internal.contextData);
+    _MatchData_free(self->internal.matchData);
     TextToMatchObject_internal_free(&self->internal);
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
@@ -763,7 +1332,7 @@ TextToMatchObject_init(TextToMatchObject*self, PyObject *args, PyObject *kwds)
             memsize += PyBytes_Size(utf8String) + 1; // + null char
             Py_XDECREF(utf8String);
         }
-        data = pcre_malloc(memsize);
+        data = _RegExpMatchGroups_mallocData(memsize);
 
         freeSpaceForString = data + ((size + 1) * sizeof(char*));
         charPointers = (const char**)data;
@@ -786,6 +1355,12 @@ TextToMatchObject_init(TextToMatchObject*self, PyObject *args, PyObject *kwds)
     }
 
     self->internal = TextToMatchObject_internal_make(column, text, contextData);
+    self->internal.matchData = _MatchData_new();
+    if (NULL == self->internal.matchData)
+    {
+        PyErr_NoMemory();
+        return -1;
+    }
 
     deliminatorSet = _MakeDeliminatorSet(deliminatorSetAsUnicodeString);
 
@@ -992,7 +1567,8 @@ AbstractRule_tryMatch(AbstractRule* self, PyObject *args, PyObject *kwds)
     }
     else
     {
-        retVal = (PyObject*)RuleTryMatchResult_new((PyObject*)internalResult.rule, internalResult.length);
+        retVal = (PyObject*)RuleTryMatchResult_new((PyObject*)internalResult.rule, internalResult.length,
+                                                   internalResult.data);
     }
     RuleTryMatchResult_internal_free(&internalResult);
 
@@ -1141,6 +1717,8 @@ typedef struct {
     AbstractRule_HEAD
     /* Type-specific fields go here. */
     PyObject* string;
+    Py_UNICODE* unicode;  // buffer of string
+    Py_ssize_t size;
 } AnyChar;
 
 
@@ -1154,13 +1732,11 @@ static RuleTryMatchResult_internal
 AnyChar_tryMatch(AnyChar* self, TextToMatchObject_internal* textToMatchObject)
 {
     Py_ssize_t i;
-    Py_ssize_t size = PyUnicode_GET_SIZE(self->string);
-    Py_UNICODE* unicode = PyUnicode_AS_UNICODE(self->string);
     Py_UNICODE char_ = textToMatchObject->unicodeText[0];
 
-    for (i = 0; i < size; i++)
+    for (i = 0; i < self->size; i++)
     {
-        if (unicode[i] == char_)
+        if (self->unicode[i] == char_)
             return MakeTryMatchResult(self, 1, NULL);
     }
 
@@ -1183,6 +1759,8 @@ AnyChar_init(AnyChar *self, PyObject *args, PyObject *kwds)
 
     ASSIGN_FIELD(AbstractRuleParams, abstractRuleParams);
     ASSIGN_PYOBJECT_FIELD(string);
+    self->unicode = PyUnicode_AS_UNICODE(string);
+    self->size = PyUnicode_GET_SIZE(string);
 
     return 0;
 }
@@ -1341,142 +1919,257 @@ DECLARE_RULE_METHODS_AND_TYPE(WordDetect);
  *                                keyword
  ********************************************************************************/
 
-/* Words are grouped by length
- * Every item contains list of words of equal length, separated with \0
- * First 8 bytes of string (sizeof _StringHash) are used as hash value
- * If word length is less, than size of _StringHash, rest is filled with 0
+/* Words of a keyword list. Created by the loader once per list and shared by the keyword rules.
+ * Open addressing hash table of UTF-8 words. Lookup doesn't copy the word from the text
  */
 typedef struct {
-    char* words[QUTEPART_MAX_WORD_LENGTH];
-    size_t wordCount[QUTEPART_MAX_WORD_LENGTH];
-} _WordTree;
+    const char* utf8Word;  // in the buffer. NULL, if the item is empty
+    size_t utf8WordLength;
+    size_t hash;
+} _KeywordSetItem;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject* words;  // list of unique words, for iteration
+    char* buffer;  // UTF-8 words
+    _KeywordSetItem* table;  // size is a power of 2, at least a half of items is empty
+    size_t tableMask;
+    size_t minUtf8WordLength;  // words of other lengths are rejected without hashing
+    size_t maxUtf8WordLength;
+} KeywordSet;
+
 
 static size_t
-_WordTree_wordBufferSize(size_t wordLength)
+_hashUtf8Word(const char* utf8Word, size_t utf8WordLength)
 {
-    // +1 for \0
-    if (wordLength + 1 < sizeof(_StringHash))
-        return sizeof(_StringHash);
-    else
-        return wordLength + 1;
+    // FNV-1a
+    size_t hash = 2166136261u;
+    size_t i;
+
+    for (i = 0; i < utf8WordLength; i++)
+    {
+        hash ^= (unsigned char)utf8Word[i];
+        hash *= 16777619u;
+    }
+
+    return hash;
 }
 
-static void
-_WordTree_init(_WordTree* self, PyObject* listOfUnicodeStrings)
+static _KeywordSetItem*
+KeywordSet_findItem(KeywordSet* self, const char* utf8Word, size_t utf8WordLength, size_t hash)
 {
-    Py_ssize_t wordLength;
-    Py_ssize_t i;
-    Py_ssize_t totalWordCount = PyList_Size(listOfUnicodeStrings);
-    Py_ssize_t currentWordIndex[QUTEPART_MAX_WORD_LENGTH];
+    size_t index;
 
-    memset(self->wordCount, 0, sizeof(size_t) * QUTEPART_MAX_WORD_LENGTH);
-
-    // first pass, calculate length
-    for (i = 0; i < totalWordCount; i++)
+    for (index = hash & self->tableMask;
+         NULL != self->table[index].utf8Word;
+         index = (index + 1) & self->tableMask)
     {
-        Py_ssize_t wordLength;
+        _KeywordSetItem* item = &(self->table[index]);
+        if (item->hash == hash &&
+            item->utf8WordLength == utf8WordLength &&
+            0 == memcmp(item->utf8Word, utf8Word, utf8WordLength))
+            break;
+    }
 
-        PyObject* unicodeWord = PyList_GetItem(listOfUnicodeStrings, i);
-        PyObject* utf8Word = PyUnicode_AsUTF8String(unicodeWord);
-        wordLength = PyBytes_Size(utf8Word);
+    return &(self->table[index]);  // the empty item, if not found
+}
 
-        if (wordLength <= QUTEPART_MAX_WORD_LENGTH)
-            self->wordCount[wordLength]++;
-        else
-            fprintf(stderr, "Too long word '%s'\n", PyBytes_AsString(utf8Word));
+static bool
+KeywordSet_contains_internal(KeywordSet* self, const char* utf8Word, size_t utf8WordLength)
+{
+    _KeywordSetItem* item;
 
-        Py_XDECREF(utf8Word);
-    }
+    if (NULL == self->table ||  // not initialized
+        utf8WordLength < self->minUtf8WordLength ||
+        utf8WordLength > self->maxUtf8WordLength)
+        return false;
+
+    item = KeywordSet_findItem(self, utf8Word, utf8WordLength,
+                                                _hashUtf8Word(utf8Word, utf8WordLength));
+    return NULL != item->utf8Word;
+}
+
+static void
+KeywordSet_dealloc(KeywordSet* self)
+{
+    Py_XDECREF(self->words);
+    PyMem_Free(self->buffer);
+    PyMem_Free(self->table);
 
-    // allocate the buffers
-    for (wordLength = 0; wordLength < QUTEPART_MAX_WORD_LENGTH; wordLength++)
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int
+KeywordSet_init(KeywordSet *self, PyObject *args, PyObject *kwds)
+{
+    PyObject* words = NULL;
+    PyObject* wordList;
+    Py_ssize_t wordCount;
+    Py_ssize_t i;
+    size_t tableSize = 1;
+    size_t bufferSize = 0;
+    char* freeSpace;
+
+    if (! PyArg_ParseTuple(args, "|O", &words))
+        return -1;
+
+    // __init__ might be called again
+    Py_CLEAR(self->words);
+    PyMem_Free(self->buffer);
+    self->buffer = NULL;
+    PyMem_Free(self->table);
+    self->table = NULL;
+    self->minUtf8WordLength = 1;
+    self->maxUtf8WordLength = 0;  // empty set doesn't contain any word
+
+    if (NULL != words)
+        wordList = PySequence_List(words);
+    else
+        wordList = PyList_New(0);
+    if (NULL == wordList)
+        return -1;
+
+    wordCount = PyList_Size(wordList);
+    for (i = 0; i < wordCount; i++)
     {
-        if (self->wordCount[wordLength] > 0)
+        Py_ssize_t utf8WordLength;
+        PyObject* word = PyList_GetItem(wordList, i);
+        if ( ! PyUnicode_Check(word))
         {
-            size_t bufferSize = _WordTree_wordBufferSize(wordLength) * self->wordCount[wordLength];
-            self->words[wordLength] = PyMem_Malloc(bufferSize);
+            PyErr_SetString(PyExc_TypeError, "words must be unicode");
+            Py_DECREF(wordList);
+            return -1;
         }
-        else
+
+        if (NULL == PyUnicode_AsUTF8AndSize(word, &utf8WordLength))
         {
-            self->words[wordLength] = NULL;
+            Py_DECREF(wordList);
+            return -1;
         }
+        bufferSize += utf8WordLength;
     }
 
-    memset(currentWordIndex, 0, sizeof(Py_ssize_t) * QUTEPART_MAX_WORD_LENGTH);
+    while (tableSize < (size_t)wordCount * 2 + 1)
+        tableSize *= 2;
 
-    // second pass, copy data
-    for (i = 0; i < totalWordCount; i++)
+    self->words = PyList_New(0);
+    self->buffer = PyMem_Malloc(bufferSize + 1);
+    self->table = PyMem_Calloc(tableSize, sizeof(_KeywordSetItem));
+    self->tableMask = tableSize - 1;
+    if (NULL == self->words || NULL == self->buffer || NULL == self->table)
     {
-        size_t wordLength;
-        size_t wordIndex;
-        size_t wordOffset;
-        char* wordPointer;
+        Py_DECREF(wordList);
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    freeSpace = self->buffer;
+    for (i = 0; i < wordCount; i++)
+    {
+        Py_ssize_t utf8WordLength;
+        PyObject* word = PyList_GetItem(wordList, i);
+        const char* utf8Word = PyUnicode_AsUTF8AndSize(word, &utf8WordLength);
+        size_t hash = _hashUtf8Word(utf8Word, utf8WordLength);
+        _KeywordSetItem* item = KeywordSet_findItem(self, utf8Word, utf8WordLength, hash);
+
+        if (NULL != item->utf8Word)  // duplicate
+            continue;
 
-        PyObject* unicodeWord = PyList_GetItem(listOfUnicodeStrings, i);
-        PyObject* utf8Word = PyUnicode_AsUTF8String(unicodeWord);
-        wordLength = PyBytes_Size(utf8Word);
+        if (0 != PyList_Append(self->words, word))
+        {
+            Py_DECREF(wordList);
+            return -1;
+        }
 
-        wordIndex = currentWordIndex[wordLength];
-        wordOffset = _WordTree_wordBufferSize(wordLength) * wordIndex;
-        wordPointer = self->words[wordLength] + wordOffset;
-        memset(wordPointer, 0, _WordTree_wordBufferSize(wordLength));
-        strncpy(wordPointer, PyBytes_AsString(utf8Word), wordLength);  // copy without zero
-        wordPointer += _WordTree_wordBufferSize(wordLength);
-        currentWordIndex[wordLength]++;
+        memcpy(freeSpace, utf8Word, utf8WordLength);
+        item->utf8Word = freeSpace;
+        item->utf8WordLength = utf8WordLength;
+        item->hash = hash;
+        freeSpace += utf8WordLength;
 
-        Py_XDECREF(utf8Word);
+        if (PyList_Size(self->words) == 1 || (size_t)utf8WordLength < self->minUtf8WordLength)
+            self->minUtf8WordLength = utf8WordLength;
+        if (PyList_Size(self->words) == 1 || (size_t)utf8WordLength > self->maxUtf8WordLength)
+            self->maxUtf8WordLength = utf8WordLength;
     }
 
+    Py_DECREF(wordList);
+
+    return 0;
 }
 
-static void
-_WordTree_free(_WordTree* self)
+static Py_ssize_t
+KeywordSet_length(KeywordSet* self)
 {
-    size_t i;
-    for (i = 0; i < QUTEPART_MAX_WORD_LENGTH; i++)
-    {
-        if (NULL != self->words[i])
-            PyMem_Free(self->words[i]);
-    }
+    if (NULL == self->words)  // not initialized
+        return 0;
+    return PyList_Size(self->words);
 }
 
-static bool
-_WordTree_contains(_WordTree* self, const char* utf8Word, size_t wordLength)
+static int
+KeywordSet_sequenceContains(KeywordSet* self, PyObject* word)
 {
-    size_t step;
-    const char* outOfStringPointer;
-    const char* wordPointer;
+    Py_ssize_t utf8WordLength;
+    const char* utf8Word;
 
-    if (NULL == self->words[wordLength]) // no any words
-        return false;
+    if ( ! PyUnicode_Check(word))
+        return 0;
 
-    step = _WordTree_wordBufferSize(wordLength);
-    outOfStringPointer = self->words[wordLength] + (step * self->wordCount[wordLength]);
+    utf8Word = PyUnicode_AsUTF8AndSize(word, &utf8WordLength);
+    if (NULL == utf8Word)
+        return -1;
 
-    for(wordPointer = self->words[wordLength]; wordPointer != outOfStringPointer; wordPointer += step)
-    {
-        if (*(_StringHash*)wordPointer == *(_StringHash*)utf8Word &&
-            0 == strncmp(wordPointer, utf8Word, wordLength))
-        {
-            return true;
-        }
-    }
+    return KeywordSet_contains_internal(self, utf8Word, utf8WordLength);
+}
 
-    return false;
+static PyObject*
+KeywordSet_iter(KeywordSet* self)
+{
+    PyObject* emptyTuple;
+    PyObject* iterator;
+
+    if (NULL != self->words)
+        return PyObject_GetIter(self->words);
+
+    // not initialized
+    emptyTuple = PyTuple_New(0);
+    if (NULL == emptyTuple)
+        return NULL;
+    iterator = PyObject_GetIter(emptyTuple);
+    Py_DECREF(emptyTuple);
+    return iterator;
 }
 
+static PySequenceMethods KeywordSet_sequenceMethods = {
+    (lenfunc)KeywordSet_length,
+    0,
+    0,
+    0,
+    0,
+    0,
+    0,
+    (objobjproc)KeywordSet_sequenceContains,
+};
+
+DECLARE_TYPE(KeywordSet, NULL, "Words of a keyword list");
+
+
 typedef struct {
     AbstractRule_HEAD
     /* Type-specific fields go here. */
-    _WordTree wordTree;
+    KeywordSet* words;
     bool insensitive;
 } keyword;
 
+static PyMemberDef keyword_members[] = {
+    {"words", T_OBJECT_EX, offsetof(keyword, words), READONLY, "KeywordSet"},
+    {NULL}
+};
 
 static void
 keyword_dealloc_fields(keyword* self)
 {
-    _WordTree_free(&(self->wordTree));
+    Py_XDECREF(self->words);
 }
 
 static RuleTryMatchResult_internal
@@ -1488,12 +2181,12 @@ keyword_tryMatch(keyword* self, TextToMatchObject_internal* textToMatchObject)
         return MakeEmptyTryMatchResult();
 
     if (self->insensitive)
-        utf8Word = textToMatchObject->utf8WordLower;
+        utf8Word = textToMatchObject->utf8TextLower;
     else
-        utf8Word = textToMatchObject->utf8Word;
+        utf8Word = textToMatchObject->utf8Text;
 
-    if (_WordTree_contains(&(self->wordTree), utf8Word, textToMatchObject->utf8WordLength))
-        return MakeTryMatchResult(self, textToMatchObject->utf8WordLength, NULL);
+    if (KeywordSet_contains_internal(self->words, utf8Word, textToMatchObject->utf8WordLength))
+        return MakeTryMatchResult(self, textToMatchObject->wordLength, NULL);
     else
         return MakeEmptyTryMatchResult();
 }
@@ -1512,26 +2205,33 @@ keyword_init(keyword *self, PyObject *args, PyObject *kwds)
         return -1;
 
     TYPE_CHECK(abstractRuleParams, AbstractRuleParams, -1);
-    LIST_CHECK(words, -1);
+    TYPE_CHECK(words, KeywordSet, -1);
     BOOL_CHECK(insensitive, -1);
 
     ASSIGN_FIELD(AbstractRuleParams, abstractRuleParams);
+    ASSIGN_FIELD(KeywordSet, words);
     ASSIGN_BOOL_FIELD(insensitive);
 
     parentParser = AbstractRule_parentParser(self->abstractRuleParams);
     self->insensitive = self->insensitive || ( ! parentParser->keywordsCaseSensitive);
 
-    _WordTree_init(&(self->wordTree), words);
-
     return 0;
 }
 
-DECLARE_RULE_METHODS_AND_TYPE(keyword);
+DECLARE_RULE_METHODS_AND_TYPE_WITH_MEMBERS(keyword);
 
 
 /********************************************************************************
  *                                RegExpr
  ********************************************************************************/
+// Count of compiled reg exps, which a dynamic rule keeps for recently substituted patterns
+#define QUTEPART_DYNAMIC_REG_EXP_CACHE_SIZE 16
+
+typedef struct {
+    char* pattern;  // substituted pattern
+    _RegExp* regExp;  // NULL, if the pattern is invalid
+} _CachedRegExp;
+
 typedef struct {
     AbstractRule_HEAD
     /* Type-specific fields go here. */
@@ -1539,142 +2239,131 @@ typedef struct {
     size_t stringLen;
     bool insensitive;
     bool minimal;
-    bool wordStart;
-    bool lineStart;
-    pcre* regExp;
-    pcre_extra* extra;
+    _RegExp* regExp;
+    // Reg exps of a dynamic rule. The most recently used is the first
+    _CachedRegExp cache[QUTEPART_DYNAMIC_REG_EXP_CACHE_SIZE];
+    size_t cacheSize;
+    PyThread_type_lock cacheLock;  // the rule is used by several threads without the GIL
+    unsigned long cacheHitCount;
+    unsigned long cacheMissCount;
 } RegExpr;
 
+static PyMemberDef RegExpr_members[] = {
+    {"cacheHitCount", T_ULONG, offsetof(RegExpr, cacheHitCount), READONLY,
+            "Count of dynamic reg exps found in the cache"},
+    {"cacheMissCount", T_ULONG, offsetof(RegExpr, cacheMissCount), READONLY,
+            "Count of dynamic reg exps compiled"},
+    {NULL}
+};
+
 static void
-RegExpr_dealloc_fields(RegExpr* self)
+_CachedRegExp_free(_CachedRegExp* self)
 {
-    PyMem_Free(self->utf8String);
-
-    if (NULL != self->regExp)
-        pcre_free(self->regExp);
-    if (NULL != self->extra)
-        pcre_free(self->extra);
+    PyMem_RawFree(self->pattern);
+    _RegExp_free(self->regExp);
 }
 
-static pcre*
-_compileRegExp(const char* utf8String, bool insensitive, bool minimal, pcre_extra** pExtra)
+static void
+RegExpr_dealloc_fields(RegExpr* self)
 {
-    const char* errptr = NULL;
-    int erroffset = 0;
-    pcre* regExp;
-
-    int options = PCRE_ANCHORED | PCRE_UTF8 | PCRE_NO_UTF8_CHECK;
-    if (insensitive)
-        options |= PCRE_CASELESS;
-
-    if (minimal)
-        options |= PCRE_UNGREEDY;  // NOTE this flag works correctly only if reg exp patterns are greedy by default
-
-    regExp = pcre_compile(utf8String,
-                          options,
-                          &errptr, &erroffset, NULL);
-
-    if (NULL == regExp)
-    {
-        if (NULL != errptr)
-            fprintf(stderr, "Failed to compile reg exp. At pos %d: %s. Pattern: '%s'\n", erroffset, errptr, utf8String);
-        else
-            fprintf(stderr, "Failed to compile reg exp. Pattern: '%s'\n", utf8String);
-    }
+    size_t i;
 
-#if defined PCRE_STUDY_JIT_COMPILE
-    #define STUDY_OPTIONS PCRE_STUDY_JIT_COMPILE
-#else
-    #define STUDY_OPTIONS 0
-#endif
-    if (NULL != pExtra)
-        *pExtra = pcre_study(regExp, STUDY_OPTIONS, &errptr);
+    PyMem_Free(self->utf8String);
+    _RegExp_free(self->regExp);
 
-    return regExp;
+    for (i = 0; i < self->cacheSize; i++)
+        _CachedRegExp_free(&(self->cache[i]));
+    if (NULL != self->cacheLock)
+        PyThread_free_lock(self->cacheLock);
 }
 
-static int
-_matchRegExp(pcre* regExp, pcre_extra* extra, const char* utf8Text, size_t textLen, _RegExpMatchGroups** pGroups)
+/* Find compiled reg exp of a dynamic rule in the cache, or compile it and put to the cache.
+ * The least recently used reg exp is dropped, if the cache is full.
+ * Must be called with cacheLock acquired. Returns NULL, if out of memory
+ */
+static _CachedRegExp*
+RegExpr_cachedRegExp(RegExpr* self, const char* pattern)
 {
-    int ovector[30];
-    int rc = pcre_exec(regExp, extra,
-                       utf8Text, textLen,
-                       0, PCRE_NOTEMPTY | PCRE_NO_UTF8_CHECK,
-                       ovector, sizeof ovector / sizeof ovector[0]);
+    _CachedRegExp entry;
+    size_t index;
 
-    if (rc > 0)
+    for (index = 0; index < self->cacheSize; index++)
     {
-        if (NULL != pGroups)
-        {
-            const char** data = NULL;
-            pcre_get_substring_list(utf8Text, ovector, rc, &data);
-            *pGroups = _RegExpMatchGroups_new(rc, data);
-        }
-
-        return ovector[1] - ovector[0];
+        if (0 == strcmp(self->cache[index].pattern, pattern))
+            break;
     }
-    else if (rc < 0 && rc != -1)
+
+    if (index < self->cacheSize)
     {
-        fprintf(stderr, "Failed to call pcre_exec: error %d\n", rc);
-        return 0;
+        self->cacheHitCount++;
+        entry = self->cache[index];
     }
     else
     {
-        return 0;
+        self->cacheMissCount++;
+        entry.pattern = PyMem_RawMalloc(strlen(pattern) + 1);
+        if (NULL == entry.pattern)
+            return NULL;
+        strcpy(entry.pattern, pattern);
+        entry.regExp = _RegExp_compile(pattern, self->insensitive, self->minimal);
+
+        if (self->cacheSize == QUTEPART_DYNAMIC_REG_EXP_CACHE_SIZE)
+        {
+            index = self->cacheSize - 1;
+            _CachedRegExp_free(&(self->cache[index]));
+        }
+        else
+        {
+            index = self->cacheSize++;
+        }
     }
+
+    memmove(&(self->cache[1]), &(self->cache[0]), index * sizeof entry);
+    self->cache[0] = entry;
+    return &(self->cache[0]);
 }
 
 static RuleTryMatchResult_internal
 RegExpr_tryMatch(RegExpr* self, TextToMatchObject_internal* textToMatchObject)
 {
     size_t matchLen;
-    pcre* regExp = NULL;
-    pcre_extra* extra = NULL;
+    _RegExp* regExp = NULL;
     _RegExpMatchGroups* groups = NULL;
 
-    // Special case. if pattern starts with \b, we have to check it manually,
-    //because string is passed to .match(..) without beginning
-    if (self->wordStart &&
-        ( ! textToMatchObject->isWordStart))
-            return MakeEmptyTryMatchResult();
-
-    //Special case. If pattern starts with ^ - check column number manually
-    if (self->lineStart &&
-        textToMatchObject->currentColumnIndex > 0)
-        return MakeEmptyTryMatchResult();
-
     if (self->abstractRuleParams->dynamic)
     {
         char buffer[QUTEPART_DYNAMIC_STRING_MAX_LENGTH];
-        size_t stringLen = _makeDynamicSubstitutions(self->utf8String, self->stringLen,
-                                                     buffer, sizeof buffer - 1,
-                                                     textToMatchObject->contextData,
-                                                     true);
+        _CachedRegExp* cachedRegExp;
+        int stringLen = _makeDynamicSubstitutions(self->utf8String, self->stringLen,
+                                                  buffer, sizeof buffer - 1,
+                                                  textToMatchObject->contextData,
+                                                  true);
         if (stringLen <= 0)
             return MakeEmptyTryMatchResult();
 
-        regExp = _compileRegExp(buffer, self->insensitive, self->minimal, NULL);
+        // the lock is held while matching, because other thread might drop the reg exp from the cache
+        PyThread_acquire_lock(self->cacheLock, WAIT_LOCK);
+        cachedRegExp = RegExpr_cachedRegExp(self, buffer);
+        if (NULL != cachedRegExp)
+            regExp = cachedRegExp->regExp;
     }
     else
     {
         regExp = self->regExp;
-        extra = self->extra;
     }
 
-    if (NULL == regExp)
-        return MakeEmptyTryMatchResult();
+    int matchLenUtf8 = 0;
+    if (NULL != regExp)
+        matchLenUtf8 = _RegExp_match(
+            regExp, textToMatchObject->matchData,
+            textToMatchObject->wholeLineUtf8Buffer, textToMatchObject->wholeLineUtf8Len,
+            textToMatchObject->utf8Text - textToMatchObject->wholeLineUtf8Buffer,
+            &groups);
 
-    int matchLenUtf8 = _matchRegExp(
-        regExp, extra,
-        textToMatchObject->utf8Text, textToMatchObject->textLen,
-        &groups);
+    if (self->abstractRuleParams->dynamic)
+        PyThread_release_lock(self->cacheLock);
 
-    PyObject* unicodeText = PyUnicode_DecodeUTF8(textToMatchObject->utf8Text, matchLenUtf8, NULL);
-    if (unicodeText == NULL) {
-        return MakeEmptyTryMatchResult();
-    }
-    matchLen = PyUnicode_GET_SIZE(unicodeText);
-    Py_DECREF(unicodeText);
+    matchLen = _utf8CharacterCount(textToMatchObject->utf8Text, matchLenUtf8);
 
     if (matchLen != 0) {
         return MakeTryMatchResult(self, matchLen, groups);
@@ -1690,29 +2379,23 @@ RegExpr_init(RegExpr *self, PyObject *args, PyObject *kwds)
     PyObject* string = NULL;
     PyObject* insensitive = NULL;
     PyObject* minimal = NULL;
-    PyObject* wordStart = NULL;
-    PyObject* lineStart = NULL;
     PyObject* utf8String;
 
     self->_tryMatch = RegExpr_tryMatch;
 
-    if (! PyArg_ParseTuple(args, "|OOOOOO", &abstractRuleParams,
-                           &string, &insensitive, &minimal, &wordStart, &lineStart))
+    if (! PyArg_ParseTuple(args, "|OOOO", &abstractRuleParams,
+                           &string, &insensitive, &minimal))
         return -1;
 
     TYPE_CHECK(abstractRuleParams, AbstractRuleParams, -1);
     UNICODE_CHECK(string, -1);
     BOOL_CHECK(insensitive, -1);
     BOOL_CHECK(minimal, -1);
-    BOOL_CHECK(wordStart, -1);
-    BOOL_CHECK(lineStart, -1);
 
     ASSIGN_FIELD(AbstractRuleParams, abstractRuleParams);
 
     ASSIGN_BOOL_FIELD(insensitive);
     ASSIGN_BOOL_FIELD(minimal);
-    ASSIGN_BOOL_FIELD(wordStart);
-    ASSIGN_BOOL_FIELD(lineStart);
 
     utf8String = PyUnicode_AsUTF8String(string);
     if (self->abstractRuleParams->dynamic)
@@ -1720,17 +2403,165 @@ RegExpr_init(RegExpr *self, PyObject *args, PyObject *kwds)
         self->stringLen = PyBytes_Size(utf8String);
         self->utf8String = PyMem_Malloc(self->stringLen + 1);
         strcpy(self->utf8String, PyBytes_AsString(utf8String));
+        self->cacheLock = PyThread_allocate_lock();
+        if (NULL == self->cacheLock)
+        {
+            Py_DECREF(utf8String);
+            PyErr_NoMemory();
+            return -1;
+        }
     }
     else
     {
-        self->regExp = _compileRegExp(PyBytes_AsString(utf8String), self->insensitive, self->minimal, &(self->extra));
+        self->regExp = _RegExp_compile(PyBytes_AsString(utf8String), self->insensitive, self->minimal);
+    }
+    Py_DECREF(utf8String);
+
+    return 0;
+}
+
+DECLARE_RULE_METHODS_AND_TYPE_WITH_MEMBERS(RegExpr);
+
+
+/********************************************************************************
+ *                                RegExprAlternation
+ ********************************************************************************/
+/* Consecutive RegExpr rules, folded by the loader into one reg exp.
+ * The pattern is an alternation with a group per rule, the group of the N-th rule is named _rN.
+ * Alternatives are tried in order, therefore the first matching rule wins as usual
+ */
+typedef struct {
+    AbstractRule_HEAD
+    /* Type-specific fields go here. */
+    PyObject* rules;
+    AbstractRule** rulesC;
+    size_t rulesSize;
+    _RegExp* regExp;  // NULL, if the pattern is invalid. Then the rules are tried one by one
+    int* groupIndexes;  // group of every rule
+    int* groupCounts;  // count of groups of every rule, including the group of the rule
+} RegExprAlternation;
+
+static PyMemberDef RegExprAlternation_members[] = {
+    {"rules", T_OBJECT_EX, offsetof(RegExprAlternation, rules), READONLY, "Folded RegExpr rules"},
+    {NULL}
+};
+
+static void
+RegExprAlternation_dealloc_fields(RegExprAlternation* self)
+{
+    Py_XDECREF(self->rules);
+    PyMem_Free(self->rulesC);
+    _RegExp_free(self->regExp);
+    PyMem_Free(self->groupIndexes);
+    PyMem_Free(self->groupCounts);
+}
+
+static RuleTryMatchResult_internal
+RegExprAlternation_tryMatchRules(RegExprAlternation* self, TextToMatchObject_internal* textToMatchObject)
+{
+    size_t i;
+    for (i = 0; i < self->rulesSize; i++)
+    {
+        RuleTryMatchResult_internal ruleTryMatchResult = AbstractRule_tryMatch_internal(self->rulesC[i], textToMatchObject);
+        if (NULL != ruleTryMatchResult.rule)
+            return ruleTryMatchResult;
     }
+
+    return MakeEmptyTryMatchResult();
+}
+
+static RuleTryMatchResult_internal
+RegExprAlternation_tryMatch(RegExprAlternation* self, TextToMatchObject_internal* textToMatchObject)
+{
+    RuleTryMatchResult_internal result;
+    _RegExpMatchGroups* groups = NULL;
+    size_t alternative = 0;
+    int matchLenUtf8;
+
+    if (NULL == self->regExp)
+        return RegExprAlternation_tryMatchRules(self, textToMatchObject);
+
+    matchLenUtf8 = _RegExp_matchAlternation(
+        self->regExp, textToMatchObject->matchData,
+        textToMatchObject->wholeLineUtf8Buffer, textToMatchObject->wholeLineUtf8Len,
+        textToMatchObject->utf8Text - textToMatchObject->wholeLineUtf8Buffer,
+        self->groupIndexes, self->groupCounts, self->rulesSize,
+        &alternative, &groups);
+
+    if (0 == matchLenUtf8)
+        return MakeEmptyTryMatchResult();
+
+    // the result is made by the matched rule, as if the rule was tried alone
+    result = MakeTryMatchResult(self->rulesC[alternative],
+                                _utf8CharacterCount(textToMatchObject->utf8Text, matchLenUtf8),
+                                groups);
+    _RegExpMatchGroups_release(groups);
+    return result;
+}
+
+static int
+RegExprAlternation_init(RegExprAlternation *self, PyObject *args, PyObject *kwds)
+{
+    PyObject* abstractRuleParams = NULL;
+    PyObject* rules = NULL;
+    PyObject* string = NULL;
+    PyObject* insensitive = NULL;
+    PyObject* minimal = NULL;
+    PyObject* utf8String;
+    size_t i;
+
+    self->_tryMatch = RegExprAlternation_tryMatch;
+
+    if (! PyArg_ParseTuple(args, "|OOOOO", &abstractRuleParams,
+                           &rules, &string, &insensitive, &minimal))
+        return -1;
+
+    TYPE_CHECK(abstractRuleParams, AbstractRuleParams, -1);
+    LIST_CHECK(rules, -1);
+    UNICODE_CHECK(string, -1);
+    BOOL_CHECK(insensitive, -1);
+    BOOL_CHECK(minimal, -1);
+
+    ASSIGN_FIELD(AbstractRuleParams, abstractRuleParams);
+    ASSIGN_PYOBJECT_FIELD(rules);
+
+    self->rulesC = (AbstractRule**)_listToDynamicallyAllocatedArray(rules, &self->rulesSize);
+
+    utf8String = PyUnicode_AsUTF8String(string);
+    self->regExp = _RegExp_compile(PyBytes_AsString(utf8String), Py_True == insensitive, Py_True == minimal);
     Py_DECREF(utf8String);
 
+    if (NULL == self->regExp)
+        return 0;
+
+    self->groupIndexes = PyMem_Malloc(self->rulesSize * sizeof self->groupIndexes[0]);
+    for (i = 0; i < self->rulesSize; i++)
+    {
+        char name[32];
+        sprintf(name, "_r%d", (int)i);
+        self->groupIndexes[i] = _RegExp_groupIndex(self->regExp, name);
+        if (self->groupIndexes[i] < 0 ||
+            self->groupIndexes[i] >= QUTEPART_MAX_MATCH_GROUPS)
+        {
+            PyErr_Format(PyExc_ValueError, "Invalid group %s of the alternation", name);
+            return -1;
+        }
+    }
+
+    // groups of a rule follow the group of the rule, until the group of the next rule
+    self->groupCounts = PyMem_Malloc(self->rulesSize * sizeof self->groupCounts[0]);
+    for (i = 0; i < self->rulesSize; i++)
+    {
+        int nextIndex = (i + 1 < self->rulesSize) ?
+                            self->groupIndexes[i + 1] :
+                            _RegExp_captureCount(self->regExp) + 1;
+        self->groupCounts[i] = nextIndex - self->groupIndexes[i];
+    }
+
     return 0;
 }
 
-DECLARE_RULE_METHODS_AND_TYPE(RegExpr);
+DECLARE_RULE_METHODS_AND_TYPE_WITH_MEMBERS(RegExprAlternation);
 
 
 /********************************************************************************
@@ -1852,16 +2683,14 @@ AbstractNumberRule_tryMatch(AbstractRule* self,
         return MakeEmptyTryMatchResult();
 
     matchEndIndex = textToMatchObject->currentColumnIndex + index;
-    if (matchEndIndex < PyUnicode_GET_SIZE(textToMatchObject->wholeLineUnicodeText))
+    if (matchEndIndex < textToMatchObject->wholeLineLen)
     {
         size_t i;
         bool haveMatch = false;
         Parser* parentParser;
 
-        TextToMatchObject_internal newTextToMatchObject =
-                TextToMatchObject_internal_make(textToMatchObject->currentColumnIndex + index,
-                                                textToMatchObject->wholeLineUnicodeText,
-                                                textToMatchObject->contextData);
+        // the copy shares the line buffers with the original object. Do not free it
+        TextToMatchObject_internal newTextToMatchObject = *textToMatchObject;
 
         parentParser = AbstractRule_parentParser(self->abstractRuleParams);
         TextToMatchObject_internal_update(&newTextToMatchObject,
@@ -1880,8 +2709,6 @@ AbstractNumberRule_tryMatch(AbstractRule* self,
             }
             // child rule context and attribute is ignored
         }
-
-        TextToMatchObject_internal_free(&newTextToMatchObject);
     }
 
     return MakeTryMatchResult(self, index, NULL);
@@ -2445,85 +3272,393 @@ DetectSpaces_dealloc_fields(DetectSpaces* self)
 static RuleTryMatchResult_internal
 DetectSpaces_tryMatch(DetectSpaces* self, TextToMatchObject_internal* textToMatchObject)
 {
-    size_t spaceLen = 0;
-    while (spaceLen < textToMatchObject->textLen &&
-          Py_UNICODE_ISSPACE(textToMatchObject->unicodeText[spaceLen]))
-        spaceLen++;
+    size_t spaceLen = 0;
+    while (spaceLen < textToMatchObject->textLen &&
+          Py_UNICODE_ISSPACE(textToMatchObject->unicodeText[spaceLen]))
+        spaceLen++;
+
+    if (spaceLen > 0)
+        return MakeTryMatchResult(self, spaceLen, NULL);
+    else
+        return MakeEmptyTryMatchResult();
+}
+
+static int
+DetectSpaces_init(DetectSpaces *self, PyObject *args, PyObject *kwds)
+{
+    PyObject* abstractRuleParams = NULL;
+
+    self->_tryMatch = DetectSpaces_tryMatch;
+
+    if (! PyArg_ParseTuple(args, "|O", &abstractRuleParams))
+        return -1;
+
+    TYPE_CHECK(abstractRuleParams, AbstractRuleParams, -1);
+    ASSIGN_FIELD(AbstractRuleParams, abstractRuleParams);
+
+    return 0;
+}
+
+DECLARE_RULE_METHODS_AND_TYPE(DetectSpaces);
+
+
+/********************************************************************************
+ *                                DetectIdentifier
+ ********************************************************************************/
+typedef struct {
+    AbstractRule_HEAD
+    /* Type-specific fields go here. */
+} DetectIdentifier;
+
+
+static void
+DetectIdentifier_dealloc_fields(DetectIdentifier* self)
+{
+}
+
+static RuleTryMatchResult_internal
+DetectIdentifier_tryMatch(DetectIdentifier* self, TextToMatchObject_internal* textToMatchObject)
+{
+    if (Py_UNICODE_ISALPHA(textToMatchObject->unicodeText[0]))
+    {
+        size_t index = 1;
+        while (index < textToMatchObject->textLen &&
+               (Py_UNICODE_ISALPHA(textToMatchObject->unicodeText[index]) ||
+                Py_UNICODE_ISDIGIT(textToMatchObject->unicodeText[index]) ||
+               textToMatchObject->unicodeText[index] == '_'))
+            index ++;
+
+        return MakeTryMatchResult(self, index, NULL);
+    }
+
+    return MakeEmptyTryMatchResult();
+}
+
+static int
+DetectIdentifier_init(DetectIdentifier *self, PyObject *args, PyObject *kwds)
+{
+    PyObject* abstractRuleParams = NULL;
+
+    self->_tryMatch = DetectIdentifier_tryMatch;
+
+    if (! PyArg_ParseTuple(args, "|O", &abstractRuleParams))
+        return -1;
+
+    TYPE_CHECK(abstractRuleParams, AbstractRuleParams, -1);
+    ASSIGN_FIELD(AbstractRuleParams, abstractRuleParams);
+
+    return 0;
+}
+
+DECLARE_RULE_METHODS_AND_TYPE(DetectIdentifier);
+
+
+/********************************************************************************
+ *                                TextTypeMap
+ ********************************************************************************/
+
+/* Text type of every column of a line. Run-length encoded, lookup is O(log runs).
+ * Map is built by the parser with TextTypeMap_append() and is immutable after it.
+ * The parser appends runs without the GIL, therefore the raw allocator is used
+ */
+
+static void
+TextTypeMap_dealloc(TextTypeMap* self)
+{
+    PyMem_RawFree(self->runs);
+
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+/* Returns false, if there is no memory. Python exception is not set, it is a caller's job
+ */
+static bool
+TextTypeMap_append(TextTypeMap* self, size_t count, Py_UCS4 textType)
+{
+    if (0 == count)
+        return true;
+
+    if (self->runCount > 0 &&
+        self->runs[self->runCount - 1].textType == textType)
+    {
+        self->runs[self->runCount - 1].end += count;
+    }
+    else
+    {
+        if (self->runCount == self->capacity)
+        {
+            size_t newCapacity = self->capacity > 0 ? self->capacity * 2 : 8;
+            _TextTypeRun* newRuns = PyMem_RawRealloc(self->runs, newCapacity * sizeof(_TextTypeRun));
+            if (NULL == newRuns)
+                return false;
+
+            self->runs = newRuns;
+            self->capacity = newCapacity;
+        }
+
+        self->runs[self->runCount].end = self->length + count;
+        self->runs[self->runCount].textType = textType;
+        self->runCount++;
+    }
+
+    self->length += count;
+    return true;
+}
+
+/* Set length of the map. New columns are code. Free not used memory
+ */
+static void
+TextTypeMap_finish(TextTypeMap* self, size_t length)
+{
+    if (length > self->length)
+    {
+        if ( ! TextTypeMap_append(self, length - self->length, ' '))
+            PyErr_NoMemory();
+    }
+    else
+    {
+        while (self->runCount > 0 &&
+               (self->runCount == 1 ? 0 : self->runs[self->runCount - 2].end) >= length)
+            self->runCount--;
+        if (self->runCount > 0)
+            self->runs[self->runCount - 1].end = length;
+        self->length = length;
+    }
+
+    if (self->capacity > self->runCount)
+    {
+        if (0 == self->runCount)
+        {
+            PyMem_RawFree(self->runs);
+            self->runs = NULL;
+        }
+        else
+        {
+            _TextTypeRun* newRuns = PyMem_RawRealloc(self->runs, self->runCount * sizeof(_TextTypeRun));
+            if (NULL != newRuns)
+                self->runs = newRuns;
+        }
+        self->capacity = self->runCount;
+    }
+}
+
+static PyTypeObject TextTypeMapType;
+
+static TextTypeMap*
+TextTypeMap_new(void)  // not a constructor, just C function
+{
+    TextTypeMap* textTypeMap = PyObject_New(TextTypeMap, &TextTypeMapType);
+    if (NULL == textTypeMap)
+        return NULL;
+
+    textTypeMap->length = 0;
+    textTypeMap->runCount = 0;
+    textTypeMap->capacity = 0;
+    textTypeMap->runs = NULL;
+
+    return textTypeMap;
+}
+
+static int
+TextTypeMap_init(TextTypeMap *self, PyObject *args, PyObject *kwds)
+{
+    PyObject* textTypes = NULL;
+    Py_ssize_t i;
+
+    if (! PyArg_ParseTuple(args, "|U", &textTypes))
+        return -1;
+
+    self->length = 0;
+    self->runCount = 0;
+
+    if (NULL != textTypes)
+    {
+        for (i = 0; i < PyUnicode_GET_LENGTH(textTypes); i++)
+        {
+            if ( ! TextTypeMap_append(self, 1, PyUnicode_READ_CHAR(textTypes, i)))
+            {
+                PyErr_NoMemory();
+                return -1;
+            }
+        }
+        TextTypeMap_finish(self, self->length);
+    }
+
+    return PyErr_Occurred() ? -1 : 0;
+}
+
+static Py_UCS4
+TextTypeMap_textType(TextTypeMap* self, size_t column)
+{
+    size_t low = 0;
+    size_t high = self->runCount - 1;
+
+    while (low < high)
+    {
+        size_t middle = (low + high) / 2;
+        if (self->runs[middle].end > column)
+            high = middle;
+        else
+            low = middle + 1;
+    }
+
+    return self->runs[low].textType;
+}
+
+static Py_ssize_t
+TextTypeMap_length(TextTypeMap* self)
+{
+    return self->length;
+}
+
+static PyObject*
+TextTypeMap_item(TextTypeMap* self, Py_ssize_t index)
+{
+    Py_UCS4 textType;
 
-    if (spaceLen > 0)
-        return MakeTryMatchResult(self, spaceLen, NULL);
-    else
-        return MakeEmptyTryMatchResult();
+    if (index < 0 || (size_t)index >= self->length)
+    {
+        PyErr_SetString(PyExc_IndexError, "TextTypeMap index out of range");
+        return NULL;
+    }
+
+    textType = TextTypeMap_textType(self, index);
+    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, &textType, 1);
 }
 
-static int
-DetectSpaces_init(DetectSpaces *self, PyObject *args, PyObject *kwds)
+static PyObject*
+TextTypeMap_concat(TextTypeMap* self, PyObject* other)
 {
-    PyObject* abstractRuleParams = NULL;
+    TextTypeMap* result;
+    TextTypeMap* maps[2];
+    size_t i, j;
 
-    self->_tryMatch = DetectSpaces_tryMatch;
+    TYPE_CHECK(other, TextTypeMap, NULL);
 
-    if (! PyArg_ParseTuple(args, "|O", &abstractRuleParams))
-        return -1;
+    result = TextTypeMap_new();
+    if (NULL == result)
+        return NULL;
 
-    TYPE_CHECK(abstractRuleParams, AbstractRuleParams, -1);
-    ASSIGN_FIELD(AbstractRuleParams, abstractRuleParams);
+    maps[0] = self;
+    maps[1] = (TextTypeMap*)other;
+    for (i = 0; i < 2; i++)
+    {
+        size_t start = 0;
+        for (j = 0; j < maps[i]->runCount; j++)
+        {
+            if ( ! TextTypeMap_append(result, maps[i]->runs[j].end - start, maps[i]->runs[j].textType))
+            {
+                Py_DECREF(result);
+                return PyErr_NoMemory();
+            }
+            start = maps[i]->runs[j].end;
+        }
+    }
+    TextTypeMap_finish(result, result->length);
 
-    return 0;
+    if (PyErr_Occurred())
+    {
+        Py_DECREF(result);
+        return NULL;
+    }
+
+    return (PyObject*)result;
 }
 
-DECLARE_RULE_METHODS_AND_TYPE(DetectSpaces);
+static PyObject*
+TextTypeMap_str(TextTypeMap* self)
+{
+    PyObject* result;
+    Py_UCS4 maxChar = 127;
+    size_t i, start;
 
+    for (i = 0; i < self->runCount; i++)
+        maxChar = Py_MAX(maxChar, self->runs[i].textType);
 
-/********************************************************************************
- *                                DetectIdentifier
- ********************************************************************************/
-typedef struct {
-    AbstractRule_HEAD
-    /* Type-specific fields go here. */
-} DetectIdentifier;
+    result = PyUnicode_New(self->length, maxChar);
+    if (NULL == result)
+        return NULL;
 
+    start = 0;
+    for (i = 0; i < self->runCount; i++)
+    {
+        PyUnicode_Fill(result, start, self->runs[i].end - start, self->runs[i].textType);
+        start = self->runs[i].end;
+    }
 
-static void
-DetectIdentifier_dealloc_fields(DetectIdentifier* self)
-{
+    return result;
 }
 
-static RuleTryMatchResult_internal
-DetectIdentifier_tryMatch(DetectIdentifier* self, TextToMatchObject_internal* textToMatchObject)
+static PyObject*
+TextTypeMap_repr(TextTypeMap* self)
 {
-    if (Py_UNICODE_ISALPHA(textToMatchObject->unicodeText[0]))
-    {
-        size_t index = 1;
-        while (index < textToMatchObject->textLen &&
-               (Py_UNICODE_ISALPHA(textToMatchObject->unicodeText[index]) ||
-                Py_UNICODE_ISDIGIT(textToMatchObject->unicodeText[index]) ||
-               textToMatchObject->unicodeText[index] == '_'))
-            index ++;
+    PyObject* string = TextTypeMap_str(self);
+    PyObject* result;
 
-        return MakeTryMatchResult(self, index, NULL);
-    }
+    if (NULL == string)
+        return NULL;
 
-    return MakeEmptyTryMatchResult();
+    result = PyUnicode_FromFormat("TextTypeMap(%R)", string);
+    Py_DECREF(string);
+    return result;
 }
 
-static int
-DetectIdentifier_init(DetectIdentifier *self, PyObject *args, PyObject *kwds)
+static PyObject*
+TextTypeMap_richcompare(TextTypeMap* self, PyObject* other, int op)
 {
-    PyObject* abstractRuleParams = NULL;
+    TextTypeMap* otherMap = (TextTypeMap*)other;
+    bool equal;
+    size_t i;
 
-    self->_tryMatch = DetectIdentifier_tryMatch;
+    if ((op != Py_EQ && op != Py_NE) ||
+        ! PyObject_TypeCheck(other, &TextTypeMapType))
+        Py_RETURN_NOTIMPLEMENTED;
 
-    if (! PyArg_ParseTuple(args, "|O", &abstractRuleParams))
-        return -1;
+    equal = self->length == otherMap->length &&
+            self->runCount == otherMap->runCount;
+    for (i = 0; equal && i < self->runCount; i++)
+        equal = self->runs[i].end == otherMap->runs[i].end &&
+                self->runs[i].textType == otherMap->runs[i].textType;
 
-    TYPE_CHECK(abstractRuleParams, AbstractRuleParams, -1);
-    ASSIGN_FIELD(AbstractRuleParams, abstractRuleParams);
+    if (equal == (op == Py_EQ))
+        Py_RETURN_TRUE;
+    else
+        Py_RETURN_FALSE;
+}
 
-    return 0;
+static PyObject*
+TextTypeMap_reduce(TextTypeMap* self, PyObject* unused)
+{
+    return Py_BuildValue("O(N)", Py_TYPE(self), TextTypeMap_str(self));
 }
 
-DECLARE_RULE_METHODS_AND_TYPE(DetectIdentifier);
+static PyObject*
+TextTypeMap_runCount(TextTypeMap* self, PyObject* unused)
+{
+    return PyLong_FromSize_t(self->runCount);
+}
+
+static PyObject*
+TextTypeMap_sizeof(TextTypeMap* self, PyObject* unused)
+{
+    return PyLong_FromSize_t(sizeof(TextTypeMap) + self->capacity * sizeof(_TextTypeRun));
+}
+
+static PyMethodDef TextTypeMap_methods[] = {
+    {"__reduce__", (PyCFunction)TextTypeMap_reduce, METH_NOARGS, "Pickle support"},
+    {"__sizeof__", (PyCFunction)TextTypeMap_sizeof, METH_NOARGS, "Size in memory"},
+    {"runCount", (PyCFunction)TextTypeMap_runCount, METH_NOARGS, "Count of runs of the same text type"},
+    {NULL}  /* Sentinel */
+};
+
+static PySequenceMethods TextTypeMap_sequenceMethods = {
+    (lenfunc)TextTypeMap_length,
+    (binaryfunc)TextTypeMap_concat,
+    0,
+    (ssizeargfunc)TextTypeMap_item,
+};
+
+DECLARE_TYPE(TextTypeMap, TextTypeMap_methods, "Text type of every column of a line");
 
 
 /********************************************************************************
@@ -2532,41 +3667,93 @@ DECLARE_RULE_METHODS_AND_TYPE(DetectIdentifier);
 static void
 ContextStack_dealloc(ContextStack* self)
 {
-    size_t i;
-    for (i = 0; i < self->_size; i++)
-        _RegExpMatchGroups_release(self->_data[i]);
+    if (NULL != self->_parent)
+    {
+        ContextStack** pChild = &self->_parent->_firstChild;
+        while (*pChild != self)
+            pChild = &(*pChild)->_nextSibling;
+        *pChild = self->_nextSibling;
+
+        Py_DECREF(self->_parent);
+    }
+
+    _RegExpMatchGroups_release(self->_data);
 
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
 DECLARE_TYPE_WITHOUT_CONSTRUCTOR(ContextStack, NULL, "Context stack");
 
+/* Create a stack. Use ContextStack_append() to create interned stacks
+ */
 static ContextStack*
-ContextStack_new(Context** contexts, _RegExpMatchGroups** data, size_t size)  // not a constructor, just C function
+ContextStack_new(ContextStack* parent, Context* context, _RegExpMatchGroups* data)  // not a constructor, just C function
 {
-    size_t i;
     ContextStack* contextStack = PyObject_New(ContextStack, &ContextStackType);
 
-    for (i = 0; i < size; i++)
+    contextStack->_parent = parent;
+    contextStack->_firstChild = NULL;
+    contextStack->_nextSibling = NULL;
+    contextStack->_context = context;
+    contextStack->_data = _RegExpMatchGroups_duplicate(data);
+    contextStack->_size = 1;
+
+    if (NULL != parent)
+    {
+        Py_INCREF(parent);
+        contextStack->_nextSibling = parent->_firstChild;
+        parent->_firstChild = contextStack;
+        contextStack->_size = parent->_size + 1;
+    }
+
+    return contextStack;
+}
+
+/* Returns new reference to the stack with a new frame on the top
+ */
+static ContextStack*
+ContextStack_append(ContextStack* self, Context* context, _RegExpMatchGroups* data)
+{
+    ContextStack* child;
+
+    for (child = self->_firstChild; child != NULL; child = child->_nextSibling)
     {
-        contextStack->_contexts[i] = contexts[i];
-        contextStack->_data[i] = _RegExpMatchGroups_duplicate(data[i]);
+        if (child->_context == context &&
+            _RegExpMatchGroups_equal(child->_data, data))
+        {
+            Py_INCREF(child);
+            return child;
+        }
     }
-    contextStack->_size = size;
 
+    return ContextStack_new(self, context, data);
+}
+
+/* Returns new reference to the stack without count frames on the top
+ */
+static ContextStack*
+ContextStack_pop(ContextStack* self, size_t count)
+{
+    ContextStack* contextStack = self;
+    size_t i;
+
+    for (i = 0; i < count; i++)
+        contextStack = contextStack->_parent;
+
+    Py_INCREF(contextStack);
     return contextStack;
 }
 
 static Context*
 ContextStack_currentContext(ContextStack* self)
 {
-    return self->_contexts[self->_size - 1];
+    return self->_context;
 }
 
 static _RegExpMatchGroups*
 ContextStack_currentData(ContextStack* self)
 {
-    return self->_data[self->_size - 1];
+    return self->_data;
 }
 
 /********************************************************************************
@@ -2598,41 +3785,38 @@ ContextSwitcher_init(ContextSwitcher *self, PyObject *args, PyObject *kwds)
 
 DECLARE_TYPE(ContextSwitcher, NULL, "Context switcher");
 
+/* Returns new reference to the next context stack.
+ * It is the same object as contextStack, if the stack is not changed
+ */
 static ContextStack*
 ContextSwitcher_getNextContextStack(ContextSwitcher* self, ContextStack* contextStack, _RegExpMatchGroups* data)
 {
     bool haveContextToSwitch = Py_None != (PyObject*)self->_contextToSwitch;
     ContextStack* newContextStack;
 
-    if (contextStack->_size - self->_popsCount < 0 ||
-        (contextStack->_size - self->_popsCount == 0 &&
-         ( ! haveContextToSwitch)))
+    if (contextStack->_size <= (size_t)self->_popsCount)
     {
 #if 0  // Trace disabled because happens to often. It seems like it is normal behavior.
         fprintf(stderr, "Attempt to pop the last context\n");
 #endif
-        return ContextStack_new(contextStack->_contexts,
-                                contextStack->_data,
-                                1);
+        newContextStack = ContextStack_pop(contextStack, contextStack->_size - 1);
+    }
+    else
+    {
+        newContextStack = ContextStack_pop(contextStack, self->_popsCount);
     }
-
-    newContextStack = ContextStack_new(contextStack->_contexts,
-                                       contextStack->_data,
-                                       contextStack->_size - self->_popsCount);
 
     if (haveContextToSwitch)
     {
         if (newContextStack->_size < QUTEPART_MAX_CONTEXT_STACK_DEPTH)
         {
             Context* contextToSwitch = (Context*)self->_contextToSwitch;
-            newContextStack->_contexts[newContextStack->_size] = contextToSwitch;
-
-            if (contextToSwitch->dynamic)
-                newContextStack->_data[newContextStack->_size] = _RegExpMatchGroups_duplicate(data);
-            else
-                newContextStack->_data[newContextStack->_size] = NULL;
-
-            newContextStack->_size++;
+            ContextStack* appendedContextStack =
+                ContextStack_append(newContextStack,
+                                    contextToSwitch,
+                                    contextToSwitch->dynamic ? data : NULL);
+            Py_DECREF(newContextStack);
+            newContextStack = appendedContextStack;
         }
         else
         {
@@ -2642,7 +3826,8 @@ ContextSwitcher_getNextContextStack(ContextSwitcher* self, ContextStack* context
                 fprintf(stderr, "qutepart: Max context stack depth %d reached\n", QUTEPART_MAX_CONTEXT_STACK_DEPTH);
                 messageShown = true;
             }
-            Py_XDECREF(newContextStack);
+            Py_DECREF(newContextStack);
+            Py_INCREF(contextStack);
             return contextStack;
         }
     }
@@ -2771,31 +3956,110 @@ static PyMethodDef Context_methods[] = {
 
 DECLARE_TYPE_WITH_MEMBERS(Context, Context_methods, "Parsing context");
 
+/* Results of parsing of a line and the state of the parsing thread.
+ * The line is parsed without the GIL, it is acquired only to switch context stacks.
+ * Results are converted to Python objects, when the line is parsed
+ */
+typedef struct {
+    size_t length;
+    PyObject* format;  // borrowed reference. Formats are owned by rules and contexts
+} _Segment;
+
+typedef struct {
+    bool returnSegments;  // only context stack is necessary, if false
+    _Segment* segments;
+    size_t segmentCount;
+    size_t segmentCapacity;
+    TextTypeMap* textTypeMap;  // NULL, if returnSegments is false
+    bool noMemory;
+    PyThreadState* threadState;  // saved, while the GIL is released
+} _ParseState;
+
+static void
+_ParseState_releaseGil(_ParseState* self)
+{
+    self->threadState = PyEval_SaveThread();
+}
+
 static void
-Context_appendSegment(PyObject* segmentList, size_t count, PyObject* format)
+_ParseState_acquireGil(_ParseState* self)
 {
-    if (Py_None != segmentList)
+    PyEval_RestoreThread(self->threadState);
+    self->threadState = NULL;
+}
+
+static void
+_ParseState_append(_ParseState* self, size_t count, PyObject* format, Py_UNICODE textType)
+{
+    if ( ! self->returnSegments)
+        return;
+
+    if (self->segmentCount == self->segmentCapacity)
     {
-        PyObject* segment = Py_BuildValue("iO", count, format);
-        PyList_Append(segmentList, segment);
+        size_t newCapacity = self->segmentCapacity > 0 ? self->segmentCapacity * 2 : 16;
+        _Segment* newSegments = PyMem_RawRealloc(self->segments, newCapacity * sizeof(_Segment));
+        if (NULL == newSegments)
+        {
+            self->noMemory = true;
+            return;
+        }
+        self->segments = newSegments;
+        self->segmentCapacity = newCapacity;
     }
+
+    self->segments[self->segmentCount].length = count;
+    self->segments[self->segmentCount].format = format;
+    self->segmentCount++;
+
+    if ( ! TextTypeMap_append(self->textTypeMap, count, textType))
+        self->noMemory = true;
 }
 
-static void
-Context_appendTextType(size_t fromIndex, size_t count, PyObject* textTypeMap, Py_UNICODE textType)
+/* Returns new reference to the list of (length, format) segments
+ */
+static PyObject*
+_ParseState_segmentList(_ParseState* self)
 {
+    PyObject* segmentList;
     size_t i;
-    for (i = fromIndex; i < fromIndex + count; i++)
-        PyUnicode_WriteChar(textTypeMap, i, textType);
+
+    segmentList = PyList_New(self->segmentCount);
+    if (NULL == segmentList)
+        return NULL;
+
+    for (i = 0; i < self->segmentCount; i++)
+    {
+        PyObject* segment = Py_BuildValue("nO", (Py_ssize_t)self->segments[i].length, self->segments[i].format);
+        if (NULL == segment)
+        {
+            Py_DECREF(segmentList);
+            return NULL;
+        }
+        PyList_SET_ITEM(segmentList, i, segment);
+    }
+
+    return segmentList;
+}
+
+static void
+_ParseState_free(_ParseState* self)
+{
+    PyMem_RawFree(self->segments);
+    self->segments = NULL;
 }
 
 
+/* Parse text from currentColumnIndex until endColumnIndex, or until context is switched.
+ * textToMatchObject is created once per line and shared by all contexts, which parse the line.
+ * Segments and text types of parsed symbols are appended to the parse state.
+ * Called without the GIL. Do not touch Python objects without _ParseState_acquireGil()
+ */
 static size_t
 Context_parseBlock(Context* self,
                    size_t currentColumnIndex,
-                   PyObject* unicodeText,
-                   PyObject* segmentList,
-                   PyObject* textTypeMap,
+                   size_t endColumnIndex,
+                   TextToMatchObject_internal* pTextToMatchObject,
+                   _ParseState* parseState,
                    ContextStack** pContextStack,
                    bool* pLineContinue)
 {
@@ -2803,12 +4067,9 @@ Context_parseBlock(Context* self,
     size_t wholeLineLen;
     size_t countOfNotMatchedSymbols = 0;
 
-    TextToMatchObject_internal textToMatchObject =
-                    TextToMatchObject_internal_make(currentColumnIndex,
-                                                    unicodeText,
-                                                    ContextStack_currentData(*pContextStack));
+    pTextToMatchObject->contextData = ContextStack_currentData(*pContextStack);
 
-    wholeLineLen = PyUnicode_GET_SIZE(textToMatchObject.wholeLineUnicodeText);
+    wholeLineLen = pTextToMatchObject->wholeLineLen;
 
     *pLineContinue = false;
 
@@ -2816,31 +4077,32 @@ Context_parseBlock(Context* self,
     {
         if ((PyObject*)self->lineEmptyContext != Py_None)
         {
-            ContextStack* newContextStack =
-                    ContextSwitcher_getNextContextStack((ContextSwitcher*)self->lineEmptyContext,
-                                                        *pContextStack,
-                                                        NULL);
-            if (newContextStack != *pContextStack)
-            {
-                ASSIGN_VALUE(ContextStack, *pContextStack, newContextStack);
-            }
+            ContextStack* newContextStack;
+
+            _ParseState_acquireGil(parseState);
+            newContextStack = ContextSwitcher_getNextContextStack((ContextSwitcher*)self->lineEmptyContext,
+                                                                  *pContextStack,
+                                                                  NULL);
+            Py_DECREF(*pContextStack);
+            *pContextStack = newContextStack;
+            _ParseState_releaseGil(parseState);
         }
     }
     else
     {
-        while (currentColumnIndex < wholeLineLen)
+        while (currentColumnIndex < endColumnIndex)
         {
             size_t i;
             RuleTryMatchResult_internal result;
 
             Parser* parentParser = (Parser*)self->parser;
-            TextToMatchObject_internal_update(&textToMatchObject, currentColumnIndex, &parentParser->deliminatorSet);
+            TextToMatchObject_internal_update(pTextToMatchObject, currentColumnIndex, &parentParser->deliminatorSet);
 
             result.rule = NULL;
 
             for (i = 0; i < self->rulesSize; i++)
             {
-                result = AbstractRule_tryMatch_internal((AbstractRule*)self->rulesC[i], &textToMatchObject);
+                result = AbstractRule_tryMatch_internal((AbstractRule*)self->rulesC[i], pTextToMatchObject);
 
                 if (NULL != result.rule)
                     break;
@@ -2850,69 +4112,74 @@ Context_parseBlock(Context* self,
             {
                 PyObject* format;
                 Py_UNICODE textType;
+                bool contextSwitched = false;
+                bool haveContextToSwitch = Py_None != (PyObject*)result.rule->abstractRuleParams->context;
                 *pLineContinue = result.lineContinue;
 
                 if (parentParser->debugOutputEnabled)
                 {
+                    _ParseState_acquireGil(parseState);
                     fprintf(stderr, "qutepart: \t");
                     PyObject_Print(self->name, stderr, 0);
                     fprintf(stderr, ": matched rule %zu at %zu\n", i, currentColumnIndex);
+                    _ParseState_releaseGil(parseState);
                 }
 
                 if (countOfNotMatchedSymbols > 0)
                 {
-                    Context_appendSegment(segmentList, countOfNotMatchedSymbols, self->format);
-                    Context_appendTextType(currentColumnIndex - countOfNotMatchedSymbols, countOfNotMatchedSymbols,
-                                           textTypeMap, self->textType);
+                    _ParseState_append(parseState, countOfNotMatchedSymbols, self->format, self->textType);
                     countOfNotMatchedSymbols = 0;
                 }
 
-                ContextStack* newContextStack = NULL;
-                if (Py_None != (PyObject*)result.rule->abstractRuleParams->context)
+                if (haveContextToSwitch)
                 {
-                    newContextStack =
-                        ContextSwitcher_getNextContextStack(result.rule->abstractRuleParams->context,
-                                                            *pContextStack,
-                                                            result.data);
-                } else
+                    // match groups might be shared with the new context stack now. Released with the GIL
+                    ContextStack* newContextStack;
+
+                    _ParseState_acquireGil(parseState);
+                    newContextStack = ContextSwitcher_getNextContextStack(result.rule->abstractRuleParams->context,
+                                                                          *pContextStack,
+                                                                          result.data);
+                    RuleTryMatchResult_internal_free(&result);
+                    if (newContextStack != *pContextStack)
+                    {
+                        Py_DECREF(*pContextStack);
+                        *pContextStack = newContextStack;
+                        contextSwitched = true;
+                    }
+                    else
+                    {
+                        Py_DECREF(newContextStack);
+                    }
+                    _ParseState_releaseGil(parseState);
+                }
+                else
                 {
-                    newContextStack = *pContextStack;
+                    RuleTryMatchResult_internal_free(&result);  // match groups are not shared
                 }
 
                 if (Py_None != result.rule->abstractRuleParams->attribute)
                     format = result.rule->abstractRuleParams->format;
                 else
-                    format = ContextStack_currentContext(newContextStack)->format;
+                    format = ContextStack_currentContext(*pContextStack)->format;
 
                 if ('\0' != result.rule->abstractRuleParams->textType)
                     textType = result.rule->abstractRuleParams->textType;
                 else
-                    textType = ContextStack_currentContext(newContextStack)->textType;
-
-                Context_appendSegment(segmentList,
-                                      result.length,
-                                      format);
-                Context_appendTextType(currentColumnIndex, result.length,
-                                       textTypeMap,
-                                       textType);
+                    textType = ContextStack_currentContext(*pContextStack)->textType;
+
+                _ParseState_append(parseState, result.length, format, textType);
                 currentColumnIndex += result.length;
 
-                if (Py_None != (PyObject*)result.rule->abstractRuleParams->context)
-                {
-                    RuleTryMatchResult_internal_free(&result);
+                if (contextSwitched)
+                    break; // while
 
-                    if (newContextStack != *pContextStack)
-                    {
-                        ASSIGN_VALUE(ContextStack, *pContextStack, newContextStack);
-                        break; // while
-                    }
-                    else if (0 == result.length)
-                    {
-                        // Parsed didn't switch context or consume character. The same situation will occur on next step
-                        fprintf(stderr, "qutepart: loop detected\n");
-                        currentColumnIndex ++;  // parsing bug. But avoid freeze
-                        countOfNotMatchedSymbols ++;
-                    }
+                if (haveContextToSwitch && 0 == result.length)
+                {
+                    // Parsed didn't switch context or consume character. The same situation will occur on next step
+                    fprintf(stderr, "qutepart: loop detected\n");
+                    currentColumnIndex ++;  // parsing bug. But avoid freeze
+                    countOfNotMatchedSymbols ++;
                 }
             }
             else // no match
@@ -2920,15 +4187,27 @@ Context_parseBlock(Context* self,
                 *pLineContinue = false;
                 if ((PyObject*)self->fallthroughContext != Py_None)
                 {
-                    ContextStack* newContextStack =
-                            ContextSwitcher_getNextContextStack(self->fallthroughContext,
-                                                                *pContextStack,
-                                                                NULL);
+                    ContextStack* newContextStack;
+                    bool contextSwitched = false;
+
+                    _ParseState_acquireGil(parseState);
+                    newContextStack = ContextSwitcher_getNextContextStack(self->fallthroughContext,
+                                                                          *pContextStack,
+                                                                          NULL);
                     if (newContextStack != *pContextStack)
                     {
-                        ASSIGN_VALUE(ContextStack, *pContextStack, newContextStack);
-                        break; // while
+                        Py_DECREF(*pContextStack);
+                        *pContextStack = newContextStack;
+                        contextSwitched = true;
+                    }
+                    else
+                    {
+                        Py_DECREF(newContextStack);
                     }
+                    _ParseState_releaseGil(parseState);
+
+                    if (contextSwitched)
+                        break; // while
                 }
 
                 countOfNotMatchedSymbols++;
@@ -2940,15 +4219,10 @@ Context_parseBlock(Context* self,
 
     if (countOfNotMatchedSymbols > 0)
     {
-        Context_appendSegment(segmentList, countOfNotMatchedSymbols, self->format);
-        Context_appendTextType(currentColumnIndex - countOfNotMatchedSymbols, countOfNotMatchedSymbols,
-                               textTypeMap, self->textType);
-
+        _ParseState_append(parseState, countOfNotMatchedSymbols, self->format, self->textType);
         countOfNotMatchedSymbols = 0;
     }
 
-    TextToMatchObject_internal_free(&textToMatchObject);
-
     return currentColumnIndex - startColumnIndex;
 }
 
@@ -2960,7 +4234,7 @@ static PyMemberDef Parser_members[] = {
     {"contexts", T_OBJECT_EX, offsetof(Parser, contexts), READONLY, "List of contexts"},
     {"syntax", T_OBJECT_EX, offsetof(Parser, syntax), READONLY, "Parent Syntax object"},
     {"defaultContext", T_OBJECT_EX, offsetof(Parser, defaultContext), READONLY, "Default context"},
-    {"lists", T_OBJECT_EX, offsetof(Parser, lists), READONLY, "Dictionary of lists of keywords"},
+    {"lists", T_OBJECT_EX, offsetof(Parser, lists), READONLY, "Dictionary of keyword sets"},
     {"deliminatorSet", T_OBJECT_EX, offsetof(Parser, deliminatorSet.setAsUnicodeString), READONLY,
                 "Set of deliminator characters (as string)"},
     {NULL}
@@ -2975,6 +4249,7 @@ Parser_dealloc(Parser* self)
     Py_XDECREF(self->contexts);
     Py_XDECREF(self->defaultContext);
     Py_XDECREF(self->defaultContextStack);
+    _MatchData_free(self->matchData);
 
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
@@ -3009,9 +4284,7 @@ Parser_init(Parser *self, PyObject *args, PyObject *kwds)
 static ContextStack*
 _makeDefaultContextStack(Context* defaultContext)
 {
-    _RegExpMatchGroups* data = NULL;
-
-    return ContextStack_new(&defaultContext, &data, 1);
+    return ContextStack_new(NULL, defaultContext, NULL);
 }
 
 
@@ -3046,23 +4319,44 @@ Parser_contextStackEqualToDefault(Context* defaultContext, ContextStack* context
 }
 
 
+/* Parse the line, or its part, if returnPart is set.
+ * The part starts at fromColumnIndex and ends after a rule match or a context switch, which reaches
+ * fromColumnIndex + maxLength
+ */
 static PyObject*
-Parser_parseBlock_internal(Parser *self, PyObject *args, bool returnSegments)
+Parser_parseBlock_internal(Parser *self, PyObject *args, bool returnSegments, bool returnPart)
 {
     PyObject* unicodeText = NULL;
     ContextStack* prevContextStack = NULL;
     Context* currentContext;
     PyObject* segmentList = NULL;
+    _ParseState parseState;
     bool lineContinue = false;
+    Py_ssize_t fromColumnIndex = 0;
+    Py_ssize_t maxLength = 0;
     size_t currentColumnIndex = 0;
+    size_t endColumnIndex;
     size_t textLen;
-    PyObject* textTypeMap;
+    TextTypeMap* textTypeMap;
     ContextStack* contextStack;
+    TextToMatchObject_internal textToMatchObject;
 
-    if (! PyArg_ParseTuple(args, "|OO",
-                           &unicodeText,
-                           &prevContextStack))
-        return NULL;
+    if (returnPart)
+    {
+        if (! PyArg_ParseTuple(args, "OOnn",
+                               &unicodeText,
+                               &prevContextStack,
+                               &fromColumnIndex,
+                               &maxLength))
+            return NULL;
+    }
+    else
+    {
+        if (! PyArg_ParseTuple(args, "|OO",
+                               &unicodeText,
+                               &prevContextStack))
+            return NULL;
+    }
 
     UNICODE_CHECK(unicodeText, NULL);
     if (Py_None != (PyObject*)(prevContextStack))
@@ -3077,44 +4371,104 @@ Parser_parseBlock_internal(Parser *self, PyObject *args, bool returnSegments)
 
     currentContext = ContextStack_currentContext(contextStack);
 
-    segmentList = NULL;
-    if (returnSegments)
+    textLen = PyUnicode_GET_SIZE(unicodeText);
+
+    if (returnPart)
     {
-        segmentList = PyList_New(0);
+        if (fromColumnIndex < 0 || (size_t)fromColumnIndex > textLen || maxLength <= 0)
+        {
+            PyErr_SetString(PyExc_ValueError, "Invalid line part");
+            Py_DECREF(contextStack);
+            return NULL;
+        }
+
+        currentColumnIndex = fromColumnIndex;
+        endColumnIndex = Py_MIN(textLen, currentColumnIndex + maxLength);
     }
     else
     {
-        segmentList = Py_None;
-        Py_INCREF(Py_None);
+        endColumnIndex = textLen;
     }
 
-    textLen = PyUnicode_GET_SIZE(unicodeText);
-    textTypeMap = PyUnicode_New(textLen, 65535);
-    if (textLen > 0)
-        PyUnicode_Fill(textTypeMap, 0, textLen, ' ');
+    // parseBlock() doesn't fill text type map. See Syntax.parseBlock()
+    textTypeMap = TextTypeMap_new();
+    if (NULL == textTypeMap)
+    {
+        Py_DECREF(contextStack);
+        return NULL;
+    }
+
+    parseState.returnSegments = returnSegments;
+    parseState.segments = NULL;
+    parseState.segmentCount = 0;
+    parseState.segmentCapacity = 0;
+    parseState.textTypeMap = textTypeMap;
+    parseState.noMemory = false;
+
+    textToMatchObject = TextToMatchObject_internal_make(0, unicodeText, NULL);
+    // other thread might use the parser at the same time. It allocates own match data
+    textToMatchObject.matchData = NULL != self->matchData ? self->matchData : _MatchData_new();
+    self->matchData = NULL;
+    if (NULL == textToMatchObject.matchData)
+    {
+        TextToMatchObject_internal_free(&textToMatchObject);
+        Py_DECREF(textTypeMap);
+        Py_DECREF(contextStack);
+        return PyErr_NoMemory();
+    }
+
+    // Other threads may run while the line is parsed. The line buffers are private, rules are not changed
+    _ParseState_releaseGil(&parseState);
 
     do {
         size_t length;
 
         if (self->debugOutputEnabled)
         {
+            _ParseState_acquireGil(&parseState);
             fprintf(stderr, "In context ");
             PyObject_Print(currentContext->name, stderr, 0);
             fprintf(stderr, "\n");
+            _ParseState_releaseGil(&parseState);
         }
 
         length = Context_parseBlock( currentContext,
                                      currentColumnIndex,
-                                     unicodeText,
-                                     segmentList,
-                                     textTypeMap,
+                                     endColumnIndex,
+                                     &textToMatchObject,
+                                     &parseState,
                                      &contextStack,
                                      &lineContinue);
         currentColumnIndex += length;
         currentContext = ContextStack_currentContext(contextStack);
-    } while (currentColumnIndex < textLen);
+    } while (currentColumnIndex < endColumnIndex);
+
+    _ParseState_acquireGil(&parseState);
+
+    if (NULL == self->matchData)
+        self->matchData = textToMatchObject.matchData;
+    else
+        _MatchData_free(textToMatchObject.matchData);
+    TextToMatchObject_internal_free(&textToMatchObject);
+
+    if (returnSegments)
+    {
+        segmentList = _ParseState_segmentList(&parseState);
+        // text type map covers only the parsed part
+        TextTypeMap_finish(textTypeMap, currentColumnIndex - fromColumnIndex);
+    }
+    else
+    {
+        segmentList = Py_None;
+        Py_INCREF(Py_None);
+    }
+    _ParseState_free(&parseState);
 
-    if ( ! lineContinue)
+    if (parseState.noMemory)
+        PyErr_NoMemory();
+
+    if (currentColumnIndex >= textLen &&  // the whole line is parsed, not a part
+        ! lineContinue)
     {
         while (currentContext->lineEndContext != Py_None)
         {
@@ -3122,7 +4476,8 @@ Parser_parseBlock_internal(Parser *self, PyObject *args, bool returnSegments)
                            ContextSwitcher_getNextContextStack((ContextSwitcher*)currentContext->lineEndContext,
                                                                contextStack,
                                                                NULL);
-            ASSIGN_VALUE(ContextStack, contextStack, newContextStack);
+            Py_DECREF(contextStack);
+            contextStack = newContextStack;
 
             if (currentContext == ContextStack_currentContext(contextStack))
             {
@@ -3141,7 +4496,8 @@ Parser_parseBlock_internal(Parser *self, PyObject *args, bool returnSegments)
                            ContextSwitcher_getNextContextStack((ContextSwitcher*)currentContext->lineBeginContext,
                                                                contextStack,
                                                                NULL);
-            ASSIGN_VALUE(ContextStack, contextStack, newContextStack);
+            Py_DECREF(contextStack);
+            contextStack = newContextStack;
 
             currentContext = ContextStack_currentContext(contextStack);
         }
@@ -3151,6 +4507,7 @@ Parser_parseBlock_internal(Parser *self, PyObject *args, bool returnSegments)
     {
         Py_DECREF(contextStack);
         Py_DECREF(textTypeMap);
+        Py_XDECREF(segmentList);
         return NULL;
     }
     else
@@ -3169,12 +4526,17 @@ Parser_parseBlock_internal(Parser *self, PyObject *args, bool returnSegments)
             Py_DECREF(contextStack);
         }
 
-        retContextData = Py_BuildValue("OO", retStack, textTypeMap);
+        retContextData = Py_BuildValue("NN", retStack, textTypeMap);
 
-        if (Py_None != segmentList)
-            return Py_BuildValue("OO", retContextData, segmentList);
+        if (returnPart)
+            return Py_BuildValue("NNn", retContextData, segmentList, currentColumnIndex);
+        else if (Py_None != segmentList)
+            return Py_BuildValue("NN", retContextData, segmentList);
         else
+        {
+            Py_DECREF(segmentList);
             return retContextData;
+        }
     }
 }
 
@@ -3182,13 +4544,19 @@ Parser_parseBlock_internal(Parser *self, PyObject *args, bool returnSegments)
 static PyObject*
 Parser_parseBlock(Parser *self, PyObject *args)
 {
-    return Parser_parseBlock_internal(self, args, false);
+    return Parser_parseBlock_internal(self, args, false, false);
 }
 
 static PyObject*
 Parser_highlightBlock(Parser *self, PyObject *args)
 {
-    return Parser_parseBlock_internal(self, args, true);
+    return Parser_parseBlock_internal(self, args, true, false);
+}
+
+static PyObject*
+Parser_highlightBlockPart(Parser *self, PyObject *args)
+{
+    return Parser_parseBlock_internal(self, args, true, true);
 }
 
 static PyMethodDef Parser_methods[] = {
@@ -3196,6 +4564,8 @@ static PyMethodDef Parser_methods[] = {
     {"parseBlock", (PyCFunction)Parser_parseBlock, METH_VARARGS,  "Parse line of text and return line data"},
     {"highlightBlock", (PyCFunction)Parser_highlightBlock, METH_VARARGS,
             "Parse line of text and return line data and highlighted segments"},
+    {"highlightBlockPart", (PyCFunction)Parser_highlightBlockPart, METH_VARARGS,
+            "Parse part of line of text and return line data, highlighted segments and column, where parsing stopped"},
     {NULL}  /* Sentinel */
 };
 
@@ -3232,8 +4602,15 @@ PyInit_cParser(void)
     PyObject* m;
 
     _utf8CharacterLengthTable_init();
+    if ( ! _RegExp_initEngine())
+        return PyErr_NoMemory();
 
     m = PyModule_Create(&moduledef);
+#ifdef QUTEPART_PCRE2
+    PyModule_AddStringConstant(m, "regExpEngine", "PCRE2");
+#else
+    PyModule_AddStringConstant(m, "regExpEngine", "PCRE");
+#endif
 
     REGISTER_TYPE(AbstractRuleParams)
 
@@ -3247,6 +4624,7 @@ PyInit_cParser(void)
     REGISTER_TYPE(WordDetect)
     REGISTER_TYPE(keyword)
     REGISTER_TYPE(RegExpr)
+    REGISTER_TYPE(RegExprAlternation)
     REGISTER_TYPE(Int)
     REGISTER_TYPE(Float)
     REGISTER_TYPE(HlCOct)
@@ -3259,6 +4637,16 @@ PyInit_cParser(void)
     REGISTER_TYPE(DetectSpaces)
     REGISTER_TYPE(DetectIdentifier)
 
+    KeywordSetType.tp_as_sequence = &KeywordSet_sequenceMethods;
+    KeywordSetType.tp_iter = (getiterfunc)KeywordSet_iter;
+    REGISTER_TYPE(KeywordSet)
+
+    TextTypeMapType.tp_as_sequence = &TextTypeMap_sequenceMethods;
+    TextTypeMapType.tp_str = (reprfunc)TextTypeMap_str;
+    TextTypeMapType.tp_repr = (reprfunc)TextTypeMap_repr;
+    TextTypeMapType.tp_richcompare = (richcmpfunc)TextTypeMap_richcompare;
+    TextTypeMapType.tp_hash = PyObject_HashNotImplemented;
+    REGISTER_TYPE(TextTypeMap)
     REGISTER_TYPE(ContextStack)
     REGISTER_TYPE(Context)
     REGISTER_TYPE(ContextSwitcher)
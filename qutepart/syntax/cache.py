@@ -0,0 +1,127 @@
+"""On-disk cache of syntax definitions.
+
+Parsing Kate XML files is slow. Definitions, returned by qutepart.syntax.loader.loadDefinition(),
+are saved to the cache directory in a compact binary form and loaded from it next time.
+
+A cache file is valid while the XML file has the same modification time and size, or the same
+SHA-1 hash, and CACHE_VERSION is not changed.
+
+The cache directory is ~/.cache/qutepart/syntax (%LOCALAPPDATA%\\qutepart\\syntax on Windows).
+It might be changed with QPART_SYNTAX_CACHE_DIR environment variable. An empty value disables the cache
+"""
+
+import logging
+import marshal
+import os
+import os.path
+import struct
+import sys
+
+
+_logger = logging.getLogger('qutepart')
+
+
+# Increase, if cache file layout or definition structure is changed
+CACHE_VERSION = 2
+
+_MAGIC = b'QPSD'
+# magic, CACHE_VERSION, marshal.version, XML modification time (ns), XML size, XML SHA-1
+_HEADER = struct.Struct('<4sHHqq20s')
+
+
+def defaultDirectory():
+    """Cache directory. None, if cache is disabled
+    """
+    if 'QPART_SYNTAX_CACHE_DIR' in os.environ:
+        return os.environ['QPART_SYNTAX_CACHE_DIR'] or None
+
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(base, 'qutepart', 'syntax')
+
+
+def _hash(data):
+    import hashlib  # delayed import. Reduces qutepart import time
+    return hashlib.sha1(data).digest()
+
+
+class DefinitionCache:
+    """Cache of syntax definitions in a directory.
+    If directory is None, nothing is loaded and saved
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _cacheFilePath(self, xmlFilePath):
+        return os.path.join(self.directory, os.path.basename(xmlFilePath) + '.cache')
+
+    def load(self, xmlFilePath):
+        """Load definition of the XML file.
+        Returns None, if it is not cached or cache is outdated
+        """
+        if self.directory is None:
+            return None
+
+        try:
+            with open(self._cacheFilePath(xmlFilePath), 'rb') as cacheFile:
+                data = cacheFile.read()
+            xmlStat = os.stat(xmlFilePath)
+        except OSError:
+            return None
+
+        if len(data) < _HEADER.size:
+            return None
+
+        magic, cacheVersion, marshalVersion, mtime, size, digest = _HEADER.unpack_from(data)
+        if magic != _MAGIC or \
+           cacheVersion != CACHE_VERSION or \
+           marshalVersion != marshal.version:
+            return None
+
+        if mtime != xmlStat.st_mtime_ns or size != xmlStat.st_size:
+            # the file might have been touched or copied. Check contents
+            try:
+                with open(xmlFilePath, 'rb') as xmlFile:
+                    if _hash(xmlFile.read()) != digest:
+                        return None
+            except OSError:
+                return None
+
+        try:
+            return marshal.loads(data[_HEADER.size:])
+        except (EOFError, ValueError, TypeError):
+            _logger.warning('Broken syntax cache file for %s', xmlFilePath)
+            return None
+
+    def save(self, xmlFilePath, definition):
+        """Save definition of the XML file.
+        Errors are ignored, the cache is only an optimization
+        """
+        if self.directory is None:
+            return
+
+        try:
+            with open(xmlFilePath, 'rb') as xmlFile:
+                xmlFileData = xmlFile.read()
+                xmlStat = os.fstat(xmlFile.fileno())
+
+            header = _HEADER.pack(_MAGIC, CACHE_VERSION, marshal.version,
+                                  xmlStat.st_mtime_ns, xmlStat.st_size, _hash(xmlFileData))
+            data = header + marshal.dumps(definition)
+
+            os.makedirs(self.directory, exist_ok=True)
+            # write to a temporary file and rename it, because other processes might read the cache
+            import tempfile  # delayed import. Reduces qutepart import time
+            fd, tmpFilePath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as cacheFile:
+                    cacheFile.write(data)
+                os.replace(tmpFilePath, self._cacheFilePath(xmlFilePath))
+            except Exception:
+                os.remove(tmpFilePath)
+                raise
+        except (OSError, ValueError) as ex:
+            _logger.debug('Failed to save syntax cache for %s: %s', xmlFilePath, ex)
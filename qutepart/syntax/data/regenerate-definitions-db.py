@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import os.path
-import json
 
 import sys
 
@@ -11,12 +10,46 @@ sys.path.insert(0, os.path.join(_MY_PATH, '..', '..', '..'))
 
 from qutepart.syntax.loader import loadSyntax
 from qutepart.syntax import SyntaxManager, Syntax
+from qutepart.syntax import database
 
 
 def _add_php(targetFileName, srcFileName):
     os.system("./generate-php.pl > xml/{} < xml/{}".format(targetFileName, srcFileName))
 
 
+_GLOB_CHARACTERS = '*?['
+
+
+def _isGlob(pattern):
+    return any(char in pattern for char in _GLOB_CHARACTERS)
+
+
+def _indexFileNameGlobs(globToXmlFileName, xmlFileNameToPriority):
+    """Split file name globs for quick search by SyntaxManager:
+        * exact file names. 'Makefile'
+        * suffixes. '.py' for '*.py'
+        * other globs. List of (glob, xmlFileName) sorted by priority
+    """
+    fileNameToXmlFileName = {}
+    suffixToXmlFileName = {}
+    fileNameGlobs = []
+
+    for glob, xmlFileName in globToXmlFileName.items():
+        if not _isGlob(glob):
+            fileNameToXmlFileName[glob] = xmlFileName
+        elif glob.startswith('*.') and not _isGlob(glob[1:]):
+            suffixToXmlFileName[glob[1:]] = xmlFileName
+        else:
+            fileNameGlobs.append((glob, xmlFileName))
+
+    fileNameGlobs.sort(key=lambda item: (-xmlFileNameToPriority[item[1]], item[0]))
+
+    return fileNameToXmlFileName, suffixToXmlFileName, fileNameGlobs
+
+
+_GENERATED_FILE_NAMES = ('javascript-php.xml', 'css-php.xml', 'html-php.xml')
+
+
 def main():
     os.chdir(_MY_PATH)
     _add_php('javascript-php.xml', 'javascript.xml')
@@ -24,18 +57,23 @@ def main():
     _add_php('html-php.xml', 'html.xml')
 
     xmlFilesPath = os.path.join(_MY_PATH, 'xml')
-    xmlFileNames = [fileName for fileName in os.listdir(xmlFilesPath) \
-                        if fileName.endswith('.xml')]
+    # sorted, because the first file wins, if priorities are equal.
+    # Generated PHP files must not override original ones
+    xmlFileNames = sorted([fileName for fileName in os.listdir(xmlFilesPath) \
+                               if fileName.endswith('.xml')],
+                          key=lambda fileName: (fileName in _GENERATED_FILE_NAMES, fileName))
 
     syntaxNameToXmlFileName = {}
     mimeTypeToXmlFileName = {}
     extensionToXmlFileName = {}
     firstLineToXmlFileName = {}
+    xmlFileNameToPriority = {}
 
     for xmlFileName in xmlFileNames:
         xmlFilePath = os.path.join(xmlFilesPath, xmlFileName)
         syntax = Syntax(None)
         loadSyntax(syntax, xmlFilePath)
+        xmlFileNameToPriority[xmlFileName] = syntax.priority
         if not syntax.name in syntaxNameToXmlFileName or \
            syntaxNameToXmlFileName[syntax.name][0] < syntax.priority:
             syntaxNameToXmlFileName[syntax.name] = (syntax.priority, xmlFileName)
@@ -72,15 +110,20 @@ def main():
     # Fix up php first line pattern. It contains <?php, but it is generated from html, and html doesn't contain it
     firstLineToXmlFileName['<?php*'] = 'html-php.xml'
 
+    fileNameToXmlFileName, suffixToXmlFileName, fileNameGlobs = \
+        _indexFileNameGlobs(extensionToXmlFileName, xmlFileNameToPriority)
+
     result = {
         'syntaxNameToXmlFileName' : syntaxNameToXmlFileName,
         'mimeTypeToXmlFileName' : mimeTypeToXmlFileName,
-        'extensionToXmlFileName' : extensionToXmlFileName,
-        'firstLineToXmlFileName' : firstLineToXmlFileName,
+        'fileNameToXmlFileName' : fileNameToXmlFileName,
+        'suffixToXmlFileName' : suffixToXmlFileName,
+        'fileNameGlobs' : fileNameGlobs,
+        'firstLineGlobs' : sorted(firstLineToXmlFileName.items()),
+        'xmlFileNameToPriority' : xmlFileNameToPriority,
     }
 
-    with open('syntax_db.json', 'w', encoding='utf-8') as syntaxDbFile:
-        json.dump(result, syntaxDbFile, sort_keys=True, indent=4)
+    database.write('syntax_db.bin', result)
 
     print('Done. Do not forget to commit the changes')
 
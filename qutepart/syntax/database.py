@@ -0,0 +1,236 @@
+"""Syntax database. Maps language names, MIME types, file names and first lines to XML files.
+
+The database is generated by data/regenerate-definitions-db.py and saved in a compact binary format.
+SyntaxManager is created when qutepart is imported, therefore the database is not loaded, but
+memory-mapped, and only the looked up records are decoded.
+
+File layout. All numbers are little endian:
+
+    header          magic 'QPDB', version (uint16), sections count (uint16)
+    offsets         absolute offset of every section (uint32)
+    xml files       count (uint32), count * (name offset (uint32), name length (uint16), priority (int16))
+    hash tables     buckets count (uint32, power of 2),
+                    buckets count * (key offset (uint32), key length (uint16), xml file index (uint16))
+                    Key offset 0 marks an empty bucket. Collisions are resolved with linear probing
+    glob lists      count (uint32), count * (glob offset (uint32), glob length (uint16), xml file index (uint16))
+    strings         UTF-8 strings, referenced by offset and length
+"""
+
+import mmap
+import struct
+import zlib
+
+
+_MAGIC = b'QPDB'
+_VERSION = 1
+
+_HEADER = struct.Struct('<4sHH')
+_UINT32 = struct.Struct('<I')
+_RECORD = struct.Struct('<IHH')
+_XML_FILE_RECORD = struct.Struct('<IHh')
+
+# Sections in the file order
+SYNTAX_NAME_TO_XML_FILE_NAME = 'syntaxNameToXmlFileName'
+MIME_TYPE_TO_XML_FILE_NAME = 'mimeTypeToXmlFileName'
+FILE_NAME_TO_XML_FILE_NAME = 'fileNameToXmlFileName'
+SUFFIX_TO_XML_FILE_NAME = 'suffixToXmlFileName'
+FILE_NAME_GLOBS = 'fileNameGlobs'
+FIRST_LINE_GLOBS = 'firstLineGlobs'
+XML_FILE_NAME_TO_PRIORITY = 'xmlFileNameToPriority'
+
+_HASH_TABLES = (SYNTAX_NAME_TO_XML_FILE_NAME,
+                MIME_TYPE_TO_XML_FILE_NAME,
+                FILE_NAME_TO_XML_FILE_NAME,
+                SUFFIX_TO_XML_FILE_NAME,
+                XML_FILE_NAME_TO_PRIORITY)
+_GLOB_LISTS = (FILE_NAME_GLOBS,
+               FIRST_LINE_GLOBS)
+# xml files section is the first one
+_SECTIONS_COUNT = 1 + len(_HASH_TABLES) + len(_GLOB_LISTS)
+
+
+def _hash(keyBytes):
+    return zlib.crc32(keyBytes)
+
+
+class _HashTable:
+    """Read-only dictionary, which decodes records on access
+    """
+    def __init__(self, database, offset, isPriorityTable):
+        self._database = database
+        self._data = database._data
+        self._bucketsCount, = _UINT32.unpack_from(self._data, offset)
+        self._bucketsOffset = offset + _UINT32.size
+        self._isPriorityTable = isPriorityTable
+
+    def _find(self, key):
+        """Returns xml file index or None
+        """
+        if self._bucketsCount == 0:
+            return None
+
+        keyBytes = key.encode('utf-8')
+        mask = self._bucketsCount - 1
+        index = _hash(keyBytes) & mask
+        while True:
+            keyOffset, keyLength, xmlFileIndex = _RECORD.unpack_from(self._data,
+                                                                     self._bucketsOffset + index * _RECORD.size)
+            if keyOffset == 0:
+                return None
+            if keyLength == len(keyBytes) and \
+               self._data[keyOffset:keyOffset + keyLength] == keyBytes:
+                return xmlFileIndex
+            index = (index + 1) & mask
+
+    def __getitem__(self, key):
+        xmlFileIndex = self._find(key)
+        if xmlFileIndex is None:
+            raise KeyError(key)
+
+        xmlFileName, priority = self._database._xmlFile(xmlFileIndex)
+        return priority if self._isPriorityTable else xmlFileName
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def keys(self):
+        """Decode all the keys. Slow, use it only for debugging
+        """
+        keys = []
+        for index in range(self._bucketsCount):
+            keyOffset, keyLength, xmlFileIndex = _RECORD.unpack_from(self._data,
+                                                                     self._bucketsOffset + index * _RECORD.size)
+            if keyOffset != 0:
+                keys.append(self._database._string(keyOffset, keyLength))
+        return sorted(keys)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+
+class SyntaxDatabase:
+    """Memory-mapped syntax database
+    """
+    def __init__(self, filePath):
+        with open(filePath, 'rb') as dbFile:
+            try:
+                self._data = mmap.mmap(dbFile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):  # i.e. file system doesn't support mmap
+                self._data = dbFile.read()
+
+        magic, version, sectionsCount = _HEADER.unpack_from(self._data)
+        if magic != _MAGIC or version != _VERSION or sectionsCount != _SECTIONS_COUNT:
+            raise ValueError('Invalid syntax database file ' + filePath)
+
+        offsets = struct.unpack_from('<%dI' % sectionsCount, self._data, _HEADER.size)
+        self._xmlFilesOffset = offsets[0]
+
+        for name, offset in zip(_HASH_TABLES, offsets[1:]):
+            setattr(self, name, _HashTable(self, offset, name == XML_FILE_NAME_TO_PRIORITY))
+
+        self._globListOffsets = dict(zip(_GLOB_LISTS, offsets[1 + len(_HASH_TABLES):]))
+        self._globLists = {}
+
+    def _string(self, offset, length):
+        return bytes(self._data[offset:offset + length]).decode('utf-8')
+
+    def _xmlFile(self, index):
+        """(xmlFileName, priority)
+        """
+        offset = self._xmlFilesOffset + _UINT32.size + index * _XML_FILE_RECORD.size
+        nameOffset, nameLength, priority = _XML_FILE_RECORD.unpack_from(self._data, offset)
+        return self._string(nameOffset, nameLength), priority
+
+    def globs(self, name):
+        """List of (glob, xmlFileName) in the database order.
+        Decoded on first access
+        """
+        if not name in self._globLists:
+            offset = self._globListOffsets[name]
+            count, = _UINT32.unpack_from(self._data, offset)
+            globs = []
+            for index in range(count):
+                globOffset, globLength, xmlFileIndex = \
+                    _RECORD.unpack_from(self._data, offset + _UINT32.size + index * _RECORD.size)
+                globs.append((self._string(globOffset, globLength), self._xmlFile(xmlFileIndex)[0]))
+            self._globLists[name] = globs
+
+        return self._globLists[name]
+
+
+def write(filePath, db):
+    """Write database. db is a dictionary of
+        * hash tables. Dictionaries {key: xmlFileName} or {xmlFileName: priority}
+        * glob lists. Lists of (glob, xmlFileName)
+    """
+    xmlFileNames = sorted(db[XML_FILE_NAME_TO_PRIORITY].keys())
+    xmlFileIndexes = {xmlFileName: index for index, xmlFileName in enumerate(xmlFileNames)}
+
+    strings = bytearray()
+    stringOffsets = {}
+
+    def _addString(text):
+        if not text in stringOffsets:
+            stringOffsets[text] = len(strings)
+            strings.extend(text.encode('utf-8'))
+        return stringOffsets[text], len(text.encode('utf-8'))
+
+    # strings are placed after the sections. Offsets are fixed up later
+    sections = []
+
+    # xml files
+    records = [(_addString(xmlFileName), db[XML_FILE_NAME_TO_PRIORITY][xmlFileName]) \
+                    for xmlFileName in xmlFileNames]
+    sections.append(('xmlFiles', records))
+
+    for name in _HASH_TABLES:
+        table = db[name]
+        bucketsCount = 1
+        while bucketsCount < len(table) * 2:
+            bucketsCount *= 2
+        buckets = [None] * bucketsCount
+        for key in sorted(table.keys()):
+            value = key if name == XML_FILE_NAME_TO_PRIORITY else table[key]
+            index = _hash(key.encode('utf-8')) & (bucketsCount - 1)
+            while buckets[index] is not None:
+                index = (index + 1) & (bucketsCount - 1)
+            buckets[index] = (_addString(key), xmlFileIndexes[value])
+        sections.append(('hashTable', buckets))
+
+    for name in _GLOB_LISTS:
+        records = [(_addString(glob), xmlFileIndexes[xmlFileName]) for glob, xmlFileName in db[name]]
+        sections.append(('globList', records))
+
+    # calculate offsets
+    offset = _HEADER.size + _UINT32.size * _SECTIONS_COUNT
+    sectionOffsets = []
+    for kind, records in sections:
+        sectionOffsets.append(offset)
+        recordSize = _XML_FILE_RECORD.size if kind == 'xmlFiles' else _RECORD.size
+        offset += _UINT32.size + recordSize * len(records)
+    stringsOffset = offset
+
+    data = bytearray()
+    data += _HEADER.pack(_MAGIC, _VERSION, _SECTIONS_COUNT)
+    data += struct.pack('<%dI' % _SECTIONS_COUNT, *sectionOffsets)
+    for kind, records in sections:
+        data += _UINT32.pack(len(records))
+        for record in records:
+            if kind == 'xmlFiles':
+                (stringOffset, stringLength), priority = record
+                data += _XML_FILE_RECORD.pack(stringsOffset + stringOffset, stringLength, priority)
+            elif record is None:  # empty bucket
+                data += _RECORD.pack(0, 0, 0)
+            else:
+                (stringOffset, stringLength), xmlFileIndex = record
+                data += _RECORD.pack(stringsOffset + stringOffset, stringLength, xmlFileIndex)
+    data += strings
+
+    with open(filePath, 'wb') as dbFile:
+        dbFile.write(data)
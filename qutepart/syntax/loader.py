@@ -1,4 +1,11 @@
 """This module is a set of functions, which load Parser from Kate XML files
+
+Loading is done in 2 steps:
+
+* loadDefinition() parses XML file and returns a definition. Definition is a tree of dicts,
+  lists, tuples, strings, numbers and bools. It doesn't depend on the parser implementation,
+  therefore it might be cached on disk. See qutepart.syntax.cache
+* applyDefinition() creates Parser, contexts and rules from the definition
 """
 
 import os
@@ -11,9 +18,6 @@ import logging
 from qutepart.syntax.colortheme import ColorTheme
 from qutepart.syntax import TextFormat
 
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QTextCharFormat, QColor, QFont
-
 
 _logger = logging.getLogger('qutepart')
 
@@ -29,6 +33,9 @@ if os.environ.get('QPART_CPARSER', 'Y') in ('Y', 'y', '1'):
 if binaryParserAvailable == False:
     import qutepart.syntax.parser as _parserModule
 
+# Fold consecutive RegExpr rules of a context into one reg exp. See _combineRegExprRules()
+combineRegExprRules = os.environ.get('QPART_COMBINE_REGEXPR', 'N') in ('Y', 'y', '1')
+
 
 _seqReplacer = re.compile('\\\\.')
 
@@ -56,6 +63,10 @@ def _processEscapeSequences(replaceText):
 
 
 def _convertFormat(format):
+    # delayed import. Headless syntaxes don't use Qt
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtGui import QTextCharFormat, QColor, QFont
+
     if format == TextFormat():
         return None  # Do not apply default format. Performance optimization
 
@@ -78,6 +89,16 @@ def _convertFormat(format):
     return qtFormat
 
 
+def _qtFormat(attribute, format):
+    return _convertFormat(format)
+
+
+def _headlessFormat(attribute, format):
+    """Headless syntaxes return attribute names as segment formats
+    """
+    return attribute
+
+
 _DEFAULT_ATTRIBUTE_TO_STYLE_MAP = \
 {
     'alert' : 'dsAlert',
@@ -179,57 +200,33 @@ def _makeContextSwitcher(contextOperation, parser):
 ################################################################################
 ##                               Rules
 ################################################################################
+"""Rule definition is a tuple
+    (tag, attribute, contextOperation, lookAhead, firstNonSpace, dynamic, column, arguments, childRules)
+where arguments is a tuple of rule specific parameters, and childRules is a tuple of rule definitions
+"""
 
-def _loadIncludeRules(parentContext, xmlElement, attributeToFormatMap):
+def _parseIncludeRules(xmlElement, dynamic):
     contextName = _safeGetRequiredAttribute(xmlElement, "context", None)
+    return (contextName,)
 
-    context = _getContext(contextName, parentContext.parser, parentContext.parser.defaultContext)
-
-    abstractRuleParams = _loadAbstractRuleParams(parentContext,
-                                                 xmlElement,
-                                                 attributeToFormatMap)
-    return _parserModule.IncludeRules(abstractRuleParams, context)
-
-def _simpleLoader(classObject):
-    def _load(parentContext, xmlElement, attributeToFormatMap):
-        abstractRuleParams = _loadAbstractRuleParams(parentContext,
-                                                     xmlElement,
-                                                     attributeToFormatMap)
-        return classObject(abstractRuleParams)
-    return _load
-
-def _loadChildRules(context, xmlElement, attributeToFormatMap):
-    """Extract rules from Context or Rule xml element
+def _parseChildRules(xmlElement):
+    """Extract rule definitions from Context or Rule xml element
     """
     rules = []
     for ruleElement in xmlElement.getchildren():
-        if not ruleElement.tag in _ruleClassDict:
+        if not ruleElement.tag in _ruleParserDict:
             raise ValueError("Not supported rule '%s'" % ruleElement.tag)
-        rule = _ruleClassDict[ruleElement.tag](context, ruleElement, attributeToFormatMap)
-        rules.append(rule)
-    return rules
+        rules.append(_parseRule(ruleElement))
+    return tuple(rules)
 
-def _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap):
+def _parseRule(xmlElement):
     # attribute
     attribute = xmlElement.attrib.get("attribute", None)
     if attribute is not None:
         attribute = attribute.lower()  # not case sensitive
-        try:
-            format = attributeToFormatMap[attribute]
-            textType = format.textType if format is not None else ' '
-            if format is not None:
-                format = _convertFormat(format)
-        except KeyError:
-            _logger.warning('Unknown rule attribute %s', attribute)
-            format = parentContext.format
-            textType = parentContext.textType
-    else:
-        format = None
-        textType = None
 
     # context
-    contextText = xmlElement.attrib.get("context", '#stay')
-    context = _makeContextSwitcher(contextText, parentContext.parser)
+    contextOperation = xmlElement.attrib.get("context", '#stay')
 
     lookAhead = _parseBoolAttribute(xmlElement.attrib.get("lookAhead", "false"))
     firstNonSpace = _parseBoolAttribute(xmlElement.attrib.get("firstNonSpace", "false"))
@@ -244,17 +241,26 @@ def _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap):
     else:
         column = -1
 
-    return _parserModule.AbstractRuleParams(parentContext, format, textType, attribute, context, lookAhead, firstNonSpace, dynamic, column)
+    arguments = _ruleParserDict[xmlElement.tag](xmlElement, dynamic)
+
+    if xmlElement.tag in ('Int', 'Float'):
+        childRules = _parseChildRules(xmlElement)
+    else:
+        childRules = ()
+
+    return (xmlElement.tag, attribute, contextOperation, lookAhead, firstNonSpace, dynamic, column,
+            arguments, childRules)
 
-def _loadDetectChar(parentContext, xmlElement, attributeToFormatMap):
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
+def _parseNoArguments(xmlElement, dynamic):
+    return ()
 
+def _parseDetectChar(xmlElement, dynamic):
     char = _safeGetRequiredAttribute(xmlElement, "char", None)
     if char is not None:
         char = _processEscapeSequences(char)
 
     index = 0
-    if abstractRuleParams.dynamic:
+    if dynamic:
         try:
             index = int(char)
         except ValueError:
@@ -265,9 +271,9 @@ def _loadDetectChar(parentContext, xmlElement, attributeToFormatMap):
             _logger.warning('Too little DetectChar index %d', index)
             index = 0
 
-    return _parserModule.DetectChar(abstractRuleParams, str(char), index)
+    return (str(char), index)
 
-def _loadDetect2Chars(parentContext, xmlElement, attributeToFormatMap):
+def _parseDetect2Chars(xmlElement, dynamic):
     char = _safeGetRequiredAttribute(xmlElement, 'char', None)
     char1 = _safeGetRequiredAttribute(xmlElement, 'char1', None)
     if char is None or char1 is None:
@@ -275,44 +281,27 @@ def _loadDetect2Chars(parentContext, xmlElement, attributeToFormatMap):
     else:
         string = _processEscapeSequences(char) + _processEscapeSequences(char1)
 
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
-    return _parserModule.Detect2Chars(abstractRuleParams, string)
+    return (string,)
 
-def _loadAnyChar(parentContext, xmlElement, attributeToFormatMap):
+def _parseAnyChar(xmlElement, dynamic):
     string = _safeGetRequiredAttribute(xmlElement, 'String', '')
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
-    return _parserModule.AnyChar(abstractRuleParams, string)
+    return (string,)
 
-def _loadStringDetect(parentContext, xmlElement, attributeToFormatMap):
+def _parseStringDetect(xmlElement, dynamic):
     string = _safeGetRequiredAttribute(xmlElement, 'String', None)
+    return (string,)
 
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
-    return _parserModule.StringDetect(abstractRuleParams,
-                                      string)
-
-def _loadWordDetect(parentContext, xmlElement, attributeToFormatMap):
+def _parseWordDetect(xmlElement, dynamic):
     word = _safeGetRequiredAttribute(xmlElement, "String", "")
     insensitive = _parseBoolAttribute(xmlElement.attrib.get("insensitive", "false"))
+    return (word, insensitive)
 
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
-
-    return _parserModule.WordDetect(abstractRuleParams, word, insensitive)
-
-def _loadKeyword(parentContext, xmlElement, attributeToFormatMap):
+def _parseKeyword(xmlElement, dynamic):
     string = _safeGetRequiredAttribute(xmlElement, 'String', None)
-    try:
-        words = parentContext.parser.lists[string]
-    except KeyError:
-        _logger.warning("List '%s' not found", string)
-
-        words = list()
-
     insensitive = _parseBoolAttribute(xmlElement.attrib.get("insensitive", "false"))
+    return (string, insensitive)
 
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
-    return _parserModule.keyword(abstractRuleParams, words, insensitive)
-
-def _loadRegExpr(parentContext, xmlElement, attributeToFormatMap):
+def _parseRegExpr(xmlElement, dynamic):
     def _processCraracterCodes(text):
         """QRegExp use \0ddd notation for character codes, where d in octal digit
         i.e. \0377 is character with code 255 in the unicode table
@@ -332,40 +321,139 @@ def _loadRegExpr(parentContext, xmlElement, attributeToFormatMap):
     if string is not None:
         string = _processCraracterCodes(string)
 
-        strippedString = string.strip('(')
+    return (string, insensitive, minimal)
+
+def _parseRangeDetect(xmlElement, dynamic):
+    char = _safeGetRequiredAttribute(xmlElement, "char", 'char is not set')
+    char1 = _safeGetRequiredAttribute(xmlElement, "char1", 'char1 is not set')
+    return (char, char1)
+
+
+_ruleParserDict = \
+{
+    'DetectChar': _parseDetectChar,
+    'Detect2Chars': _parseDetect2Chars,
+    'AnyChar': _parseAnyChar,
+    'StringDetect': _parseStringDetect,
+    'WordDetect': _parseWordDetect,
+    'RegExpr': _parseRegExpr,
+    'keyword': _parseKeyword,
+    'Int': _parseNoArguments,
+    'Float': _parseNoArguments,
+    'HlCOct': _parseNoArguments,
+    'HlCHex': _parseNoArguments,
+    'HlCStringChar': _parseNoArguments,
+    'HlCChar': _parseNoArguments,
+    'RangeDetect': _parseRangeDetect,
+    'LineContinue': _parseNoArguments,
+    'IncludeRules': _parseIncludeRules,
+    'DetectSpaces': _parseNoArguments,
+    'DetectIdentifier': _parseNoArguments
+}
 
-        wordStart = strippedString.startswith('\\b')
-        lineStart = strippedString.startswith('^')
-        if len(strippedString) > 1 and strippedString[1] == '|':  # ^|blabla   This condition is not ideal but will cover majority of cases
-            wordStart = False
-            lineStart = False
+
+def _loadIncludeRules(parentContext, ruleDefinition, attributeToFormatMap):
+    contextName, = ruleDefinition[7]
+
+    context = _getContext(contextName, parentContext.parser, parentContext.parser.defaultContext)
+
+    abstractRuleParams = _loadAbstractRuleParams(parentContext,
+                                                 ruleDefinition,
+                                                 attributeToFormatMap)
+    return _parserModule.IncludeRules(abstractRuleParams, context)
+
+def _simpleLoader(classObject):
+    def _load(parentContext, ruleDefinition, attributeToFormatMap):
+        abstractRuleParams = _loadAbstractRuleParams(parentContext,
+                                                     ruleDefinition,
+                                                     attributeToFormatMap)
+        return classObject(abstractRuleParams)
+    return _load
+
+def _loadChildRules(context, ruleDefinitions, attributeToFormatMap):
+    """Create rules for Context or Rule
+    """
+    return [_ruleClassDict[ruleDefinition[0]](context, ruleDefinition, attributeToFormatMap) \
+                for ruleDefinition in ruleDefinitions]
+
+def _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap):
+    tag, attribute, contextOperation, lookAhead, firstNonSpace, dynamic, column = ruleDefinition[:7]
+
+    # attribute
+    if attribute is not None:
+        try:
+            textFormat, format = attributeToFormatMap[attribute]
+            textType = textFormat.textType
+        except KeyError:
+            _logger.warning('Unknown rule attribute %s', attribute)
+            format = parentContext.format
+            textType = parentContext.textType
     else:
-        wordStart = False
-        lineStart = False
+        format = None
+        textType = None
 
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
-    return _parserModule.RegExpr(abstractRuleParams,
-                                 string, insensitive, minimal, wordStart, lineStart)
+    # context
+    context = _makeContextSwitcher(contextOperation, parentContext.parser)
+
+    return _parserModule.AbstractRuleParams(parentContext, format, textType, attribute, context, lookAhead, firstNonSpace, dynamic, column)
+
+def _loadDetectChar(parentContext, ruleDefinition, attributeToFormatMap):
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
+    char, index = ruleDefinition[7]
+    return _parserModule.DetectChar(abstractRuleParams, char, index)
+
+def _loadDetect2Chars(parentContext, ruleDefinition, attributeToFormatMap):
+    string, = ruleDefinition[7]
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
+    return _parserModule.Detect2Chars(abstractRuleParams, string)
 
-def _loadAbstractNumberRule(rule, parentContext, xmlElement):
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
-    return _parserModule.NumberRule(abstractRuleParams, childRules)
+def _loadAnyChar(parentContext, ruleDefinition, attributeToFormatMap):
+    string, = ruleDefinition[7]
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
+    return _parserModule.AnyChar(abstractRuleParams, string)
+
+def _loadStringDetect(parentContext, ruleDefinition, attributeToFormatMap):
+    string, = ruleDefinition[7]
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
+    return _parserModule.StringDetect(abstractRuleParams,
+                                      string)
+
+def _loadWordDetect(parentContext, ruleDefinition, attributeToFormatMap):
+    word, insensitive = ruleDefinition[7]
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
+    return _parserModule.WordDetect(abstractRuleParams, word, insensitive)
+
+def _loadKeyword(parentContext, ruleDefinition, attributeToFormatMap):
+    string, insensitive = ruleDefinition[7]
+    try:
+        words = parentContext.parser.lists[string]
+    except KeyError:
+        _logger.warning("List '%s' not found", string)
+
+        words = _parserModule.KeywordSet()
 
-def _loadInt(parentContext, xmlElement, attributeToFormatMap):
-    childRules = _loadChildRules(parentContext, xmlElement, attributeToFormatMap)
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
+    return _parserModule.keyword(abstractRuleParams, words, insensitive)
+
+def _loadRegExpr(parentContext, ruleDefinition, attributeToFormatMap):
+    string, insensitive, minimal = ruleDefinition[7]
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
+    return _parserModule.RegExpr(abstractRuleParams,
+                                 string, insensitive, minimal)
+
+def _loadInt(parentContext, ruleDefinition, attributeToFormatMap):
+    childRules = _loadChildRules(parentContext, ruleDefinition[8], attributeToFormatMap)
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
     return _parserModule.Int(abstractRuleParams, childRules)
 
-def _loadFloat(parentContext, xmlElement, attributeToFormatMap):
-    childRules = _loadChildRules(parentContext, xmlElement, attributeToFormatMap)
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
+def _loadFloat(parentContext, ruleDefinition, attributeToFormatMap):
+    childRules = _loadChildRules(parentContext, ruleDefinition[8], attributeToFormatMap)
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
     return _parserModule.Float(abstractRuleParams, childRules)
 
-def _loadRangeDetect(parentContext, xmlElement, attributeToFormatMap):
-    char = _safeGetRequiredAttribute(xmlElement, "char", 'char is not set')
-    char1 = _safeGetRequiredAttribute(xmlElement, "char1", 'char1 is not set')
-
-    abstractRuleParams = _loadAbstractRuleParams(parentContext, xmlElement, attributeToFormatMap)
+def _loadRangeDetect(parentContext, ruleDefinition, attributeToFormatMap):
+    char, char1 = ruleDefinition[7]
+    abstractRuleParams = _loadAbstractRuleParams(parentContext, ruleDefinition, attributeToFormatMap)
     return _parserModule.RangeDetect(abstractRuleParams, char, char1)
 
 
@@ -391,21 +479,119 @@ _ruleClassDict = \
     'DetectIdentifier': _simpleLoader(_parserModule.DetectIdentifier)
 }
 
+# Patterns, which can't be a part of an alternation. Back references and calls by group number
+# refer to other groups, named groups and inline flags affect other alternatives,
+# backtracking control verbs stop trying other alternatives
+_notCombinableRegExp = re.compile(r"\\[1-9gk]|\(\?(P[<=>]|<[A-Za-z_]|'|\(|[-+]?\d|&|[a-zA-Z-]+\))|\(\*")
+
+# Groups of an alternation, excluding the whole match. The C parser supports up to 64 groups
+_MAX_ALTERNATION_GROUP_COUNT = 63
+
+def _regExprGroupCount(ruleDefinition):
+    """Count of groups in the pattern of a RegExpr rule, which might be a part of an alternation.
+    None for other rules
+    """
+    tag, attribute, contextOperation, lookAhead, firstNonSpace, dynamic, column = ruleDefinition[:7]
+    if tag != 'RegExpr' or dynamic or firstNonSpace or column != -1:
+        return None
+
+    string, insensitive, minimal = ruleDefinition[7]
+    if not string or \
+       _notCombinableRegExp.search(string) is not None:
+        return None
+
+    try:
+        return re.compile(string).groups
+    except (re.error, AssertionError):
+        return None
+
+def _makeRegExprAlternation(parentContext, alternatives, insensitive, minimal):
+    """Make rule of the alternatives, which is a list of (string, rule)
+    """
+    if len(alternatives) == 1:
+        return alternatives[0][1]
+
+    string = '|'.join(['(?P<_r%d>%s)' % (index, string) \
+                            for index, (string, rule) in enumerate(alternatives)])
+    rules = [rule for string, rule in alternatives]
+    abstractRuleParams = _parserModule.AbstractRuleParams(parentContext, None, None, None, None,
+                                                          False, False, False, -1)
+    return _parserModule.RegExprAlternation(abstractRuleParams, rules, string, insensitive, minimal)
+
+def _combineRegExprRules(parentContext, ruleDefinitions, rules):
+    """Fold runs of consecutive RegExpr rules with the same flags into RegExprAlternation rules.
+    A context tries one reg exp instead of every rule of the run
+    """
+    result = []
+    alternatives = []
+    flags = None
+    groupCount = 0
+    for ruleDefinition, rule in zip(ruleDefinitions, rules):
+        ruleGroupCount = _regExprGroupCount(ruleDefinition)
+        if ruleGroupCount is not None:
+            string, insensitive, minimal = ruleDefinition[7]
+            ruleFlags = (insensitive, minimal)
+        else:
+            ruleFlags = None
+
+        if alternatives and \
+           (ruleFlags != flags or
+            groupCount + 1 + ruleGroupCount > _MAX_ALTERNATION_GROUP_COUNT):
+            result.append(_makeRegExprAlternation(parentContext, alternatives, *flags))
+            alternatives = []
+            groupCount = 0
+
+        if ruleFlags is not None:
+            alternatives.append((string, rule))
+            flags = ruleFlags
+            groupCount += 1 + ruleGroupCount
+        else:
+            result.append(rule)
+
+    if alternatives:
+        result.append(_makeRegExprAlternation(parentContext, alternatives, *flags))
+
+    return result
+
 ################################################################################
 ##                               Context
 ################################################################################
+"""Context definition is a tuple
+    (name, attribute, lineEndContext, lineBeginContext, lineEmptyContext, fallthroughContext, dynamic, rules)
+"""
 
-
-def _loadContexts(highlightingElement, parser, attributeToFormatMap):
+def _parseContexts(highlightingElement):
     contextsElement = highlightingElement.find('contexts')
+    return [_parseContext(xmlElement) for xmlElement in contextsElement.findall('context')]
+
+
+def _parseContext(xmlElement):
+    name = _safeGetRequiredAttribute(xmlElement,
+                                     'name',
+                                     'Error: context name is not set!!!')
+    attribute = _safeGetRequiredAttribute(xmlElement, 'attribute', '<not set>').lower()
+
+    lineEndContext = xmlElement.attrib.get('lineEndContext', '#stay')
+    lineBeginContext = xmlElement.attrib.get('lineBeginContext', '#stay')
+    lineEmptyContext = xmlElement.attrib.get('lineEmptyContext', '#stay')
+
+    if _parseBoolAttribute(xmlElement.attrib.get('fallthrough', 'false')):
+        fallthroughContext = _safeGetRequiredAttribute(xmlElement, 'fallthroughContext', '#stay')
+    else:
+        fallthroughContext = None
+
+    dynamic = _parseBoolAttribute(xmlElement.attrib.get('dynamic', 'false'))
+
+    rules = _parseChildRules(xmlElement)
+
+    return (name, attribute, lineEndContext, lineBeginContext, lineEmptyContext, fallthroughContext,
+            dynamic, rules)
 
-    xmlElementList = contextsElement.findall('context')
+
+def _loadContexts(contextDefinitions, parser, attributeToFormatMap, formatConverter):
     contextList = []
-    for xmlElement in xmlElementList:
-        name = _safeGetRequiredAttribute(xmlElement,
-                                         'name',
-                                         'Error: context name is not set!!!')
-        context = _parserModule.Context(parser, name)
+    for contextDefinition in contextDefinitions:
+        context = _parserModule.Context(parser, contextDefinition[0])
         contextList.append(context)
 
     defaultContext = contextList[0]
@@ -417,48 +603,51 @@ def _loadContexts(highlightingElement, parser, attributeToFormatMap):
     parser.setContexts(contextDict, defaultContext)
 
     # parse contexts stage 2: load contexts
-    for xmlElement, context in zip(xmlElementList, contextList):
-        _loadContext(context, xmlElement, attributeToFormatMap)
+    for contextDefinition, context in zip(contextDefinitions, contextList):
+        _loadContext(context, contextDefinition, attributeToFormatMap, formatConverter)
+
+    # parse contexts stage 3: build first character dispatch tables. Only Python parser uses them
+    if not binaryParserAvailable:
+        for context in contextList:
+            context.compileDispatchTable()
 
 
-def _loadContext(context, xmlElement, attributeToFormatMap):
-    """Construct context from XML element
+def _loadContext(context, contextDefinition, attributeToFormatMap, formatConverter):
+    """Load context from its definition
     Contexts are at first constructed, and only then loaded, because when loading context,
     _makeContextSwitcher must have references to all defined contexts
     """
-    attribute = _safeGetRequiredAttribute(xmlElement, 'attribute', '<not set>').lower()
+    name, attribute, lineEndContextText, lineBeginContextText, lineEmptyContextText, \
+        fallthroughContextText, dynamic, ruleDefinitions = contextDefinition
+
     if attribute != '<not set>':  # there are no attributes for internal contexts, used by rules. See perl.xml
         try:
-            format = attributeToFormatMap[attribute]
+            textFormat, format = attributeToFormatMap[attribute]
         except KeyError:
             _logger.warning('Unknown context attribute %s', attribute)
-            format = TextFormat()
+            textFormat = TextFormat()
+            format = formatConverter(attribute, textFormat)
+            attributeToFormatMap[attribute] = (textFormat, format)
+        textType = textFormat.textType
     else:
         format = None
+        textType = ' '
 
-    textType = format.textType if format is not None else ' '
-    if format is not None:
-        format = _convertFormat(format)
-
-    lineEndContextText = xmlElement.attrib.get('lineEndContext', '#stay')
     lineEndContext = _makeContextSwitcher(lineEndContextText,  context.parser)
-    lineBeginContextText = xmlElement.attrib.get('lineBeginContext', '#stay')
     lineBeginContext = _makeContextSwitcher(lineBeginContextText, context.parser)
-    lineEmptyContextText = xmlElement.attrib.get('lineEmptyContext', '#stay')
     lineEmptyContext = _makeContextSwitcher(lineEmptyContextText, context.parser)
 
-    if _parseBoolAttribute(xmlElement.attrib.get('fallthrough', 'false')):
-        fallthroughContextText = _safeGetRequiredAttribute(xmlElement, 'fallthroughContext', '#stay')
+    if fallthroughContextText is not None:
         fallthroughContext = _makeContextSwitcher(fallthroughContextText, context.parser)
     else:
         fallthroughContext = None
 
-    dynamic = _parseBoolAttribute(xmlElement.attrib.get('dynamic', 'false'))
-
     context.setValues(attribute, format, lineEndContext, lineBeginContext, lineEmptyContext, fallthroughContext, dynamic, textType)
 
     # load rules
-    rules = _loadChildRules(context, xmlElement, attributeToFormatMap)
+    rules = _loadChildRules(context, ruleDefinitions, attributeToFormatMap)
+    if combineRegExprRules:
+        rules = _combineRegExprRules(context, ruleDefinitions, rules)
     context.setRules(rules)
 
 ################################################################################
@@ -508,7 +697,17 @@ def _makeFormat(defaultTheme, defaultStyleName, textType, item=None):
 
     return format
 
-def _loadAttributeToFormatMap(highlightingElement):
+def _formatToDefinition(format):
+    return (format.color, format.background, format.selectionColor,
+            format.italic, format.bold, format.underline, format.strikeOut, format.spellChecking,
+            format.textType)
+
+def _formatFromDefinition(formatDefinition):
+    format = TextFormat(*formatDefinition[:-1])
+    format.textType = formatDefinition[-1]
+    return format
+
+def _parseAttributeToFormatMap(highlightingElement):
     defaultTheme = ColorTheme(TextFormat)
     attributeToFormatMap = {}
 
@@ -537,9 +736,10 @@ def _loadAttributeToFormatMap(highlightingElement):
         attributeToFormatMap['string'] = _makeFormat(defaultTheme, 'dsString',
                                                      _textTypeForDefStyleName('string', 'dsString'))
 
-    return attributeToFormatMap
+    return {attribute: _formatToDefinition(format) \
+                for attribute, format in attributeToFormatMap.items()}
 
-def _loadLists(root, highlightingElement):
+def _parseLists(root, highlightingElement):
     lists = {}  # list name: list
     for listElement in highlightingElement.findall('list'):
         # Sometimes item.text is none. Broken xml files
@@ -557,24 +757,32 @@ def _makeKeywordsLowerCase(listDict):
         for index, keyword in enumerate(keywordList):
             keywordList[index] = keyword.lower()
 
-def _loadSyntaxDescription(root, syntax):
-    syntax.name = _safeGetRequiredAttribute(root, 'name', 'Error: .parser name is not set!!!')
-    syntax.section = _safeGetRequiredAttribute(root, 'section', 'Error: Section is not set!!!')
-    syntax.extensions = [_f for _f in _safeGetRequiredAttribute(root, 'extensions', '').split(';') if _f]
-    syntax.firstLineGlobs = [_f for _f in root.attrib.get('firstLineGlobs', '').split(';') if _f]
-    syntax.mimetype = [_f for _f in root.attrib.get('mimetype', '').split(';') if _f]
-    syntax.version = root.attrib.get('version', None)
-    syntax.kateversion = root.attrib.get('kateversion', None)
-    syntax.priority = int(root.attrib.get('priority', '0'))
-    syntax.author = root.attrib.get('author', None)
-    syntax.license = root.attrib.get('license', None)
-    syntax.hidden = _parseBoolAttribute(root.attrib.get('hidden', 'false'))
+def _parseSyntaxDescription(root):
+    description = {}
+    description['name'] = _safeGetRequiredAttribute(root, 'name', 'Error: .parser name is not set!!!')
+    description['section'] = _safeGetRequiredAttribute(root, 'section', 'Error: Section is not set!!!')
+    description['extensions'] = [_f for _f in _safeGetRequiredAttribute(root, 'extensions', '').split(';') if _f]
+    description['firstLineGlobs'] = [_f for _f in root.attrib.get('firstLineGlobs', '').split(';') if _f]
+    description['mimetype'] = [_f for _f in root.attrib.get('mimetype', '').split(';') if _f]
+    description['version'] = root.attrib.get('version', None)
+    description['kateversion'] = root.attrib.get('kateversion', None)
+    description['priority'] = int(root.attrib.get('priority', '0'))
+    description['author'] = root.attrib.get('author', None)
+    description['license'] = root.attrib.get('license', None)
+    description['hidden'] = _parseBoolAttribute(root.attrib.get('hidden', 'false'))
 
     # not documented
-    syntax.indenter = root.attrib.get('indenter', None)
+    description['indenter'] = root.attrib.get('indenter', None)
 
+    return description
 
-def loadSyntax(syntax, filePath = None):
+
+def loadDefinition(filePath):
+    """Parse Kate XML file. Returns syntax definition.
+
+    Definition contains only dicts, lists, tuples, strings, numbers, bools and None.
+    Increase qutepart.syntax.cache.CACHE_VERSION if its structure is changed
+    """
     _logger.debug("Loading syntax %s", filePath)
     with open(filePath, 'r', encoding='utf-8') as definitionFile:
         try:
@@ -585,12 +793,12 @@ def loadSyntax(syntax, filePath = None):
 
     highlightingElement = root.find('highlighting')
 
-    _loadSyntaxDescription(root, syntax)
+    description = _parseSyntaxDescription(root)
 
     deliminatorSet = set(_DEFAULT_DELIMINATOR)
 
     # parse lists
-    lists = _loadLists(root, highlightingElement)
+    lists = _parseLists(root, highlightingElement)
 
     # parse itemData
     keywordsCaseSensitive = True
@@ -617,15 +825,90 @@ def loadSyntax(syntax, filePath = None):
 
         if indentationElement is not None and \
            'mode' in indentationElement.attrib:
-            syntax.indenter = indentationElement.attrib['mode']
+            description['indenter'] = indentationElement.attrib['mode']
+
+    return {'description': description,
+            'deliminatorSet': ''.join(sorted(deliminatorSet)),
+            'lists': lists,
+            'keywordsCaseSensitive': keywordsCaseSensitive,
+            'formats': _parseAttributeToFormatMap(highlightingElement),
+            'contexts': _parseContexts(highlightingElement)}
+
+
+def _includedSyntaxName(contextOperation):
+    """Get syntax name from context operation like '#pop!##Python' or 'context##Python'
+    """
+    if contextOperation is None:
+        return None
+
+    rest = contextOperation
+    while rest.startswith('#pop'):
+        rest = rest[len('#pop'):]
+        if rest.startswith('!'):
+            rest = rest[1:]
+
+    if rest.count('##') == 1:
+        return rest.split('##')[1]
+    else:
+        return None
+
+
+def includedSyntaxNames(definition):
+    """Names of syntaxes, which contexts are used by the definition
+    """
+    contextOperations = []
+
+    def _addRules(ruleDefinitions):
+        for ruleDefinition in ruleDefinitions:
+            contextOperations.append(ruleDefinition[2])
+            if ruleDefinition[0] == 'IncludeRules':
+                contextOperations.append(ruleDefinition[7][0])
+            _addRules(ruleDefinition[8])
+
+    for contextDefinition in definition['contexts']:
+        contextOperations.extend(contextDefinition[2:6])
+        _addRules(contextDefinition[7])
+
+    names = set()
+    for contextOperation in contextOperations:
+        name = _includedSyntaxName(contextOperation)
+        if name:
+            names.add(name)
+    return names
+
+
+def applyDefinition(syntax, definition, headless=False):
+    """Create parser, contexts and rules for the syntax from its definition
+
+    Highlighted segments of a headless syntax contain attribute names instead of QTextCharFormat.
+    Headless syntax doesn't use Qt
+    """
+    for name, value in definition['description'].items():
+        setattr(syntax, name, value)
+
+    # keyword sets are built once per list and shared by the keyword rules, which use the list
+    lists = {name: _parserModule.KeywordSet(items) for name, items in definition['lists'].items()}
 
-    deliminatorSetAsString = ''.join(list(deliminatorSet))
     debugOutputEnabled = _logger.isEnabledFor(logging.DEBUG)  # for cParser
-    parser = _parserModule.Parser(syntax, deliminatorSetAsString, lists, keywordsCaseSensitive, debugOutputEnabled)
+    parser = _parserModule.Parser(syntax, definition['deliminatorSet'], lists,
+                                  definition['keywordsCaseSensitive'], debugOutputEnabled)
     syntax._setParser(parser)
-    attributeToFormatMap = _loadAttributeToFormatMap(highlightingElement)
+    # QTextCharFormat is created once for an attribute and shared by the rules.
+    # attribute: (TextFormat, QTextCharFormat or attribute name)
+    formatConverter = _headlessFormat if headless else _qtFormat
+    attributeToFormatMap = {}
+    for attribute, formatDefinition in definition['formats'].items():
+        format = _formatFromDefinition(formatDefinition)
+        attributeToFormatMap[attribute] = (format, formatConverter(attribute, format))
 
     # parse contexts
-    _loadContexts(highlightingElement, syntax.parser, attributeToFormatMap)
+    _loadContexts(definition['contexts'], syntax.parser, attributeToFormatMap, formatConverter)
+
+    syntax._attributeToFormatMap = {attribute: format \
+                                        for attribute, (textFormat, format) in attributeToFormatMap.items()}
 
     return syntax
+
+
+def loadSyntax(syntax, filePath = None):
+    return applyDefinition(syntax, loadDefinition(filePath))
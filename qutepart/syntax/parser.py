@@ -13,48 +13,210 @@ but value from itemDatas section (style name)
 contain not a text value, but ContextSwitcher object
 """
 
+import array
+import bisect
+import collections
+import itertools
 import re
 import logging
+import weakref
 
 _logger = logging.getLogger('qutepart')
 
 _numSeqReplacer = re.compile('%\d+')
 
+# Context dispatch tables cover only ASCII. Rules for other characters are looked up in the full list
+_DISPATCH_TABLE_SIZE = 128
+_DISPATCH_TABLE_CHARACTERS = [chr(code) for code in range(_DISPATCH_TABLE_SIZE)]
+
+# Count of compiled reg exps, which a dynamic RegExpr rule keeps for recently substituted patterns
+_DYNAMIC_REG_EXP_CACHE_SIZE = 16
+
+
+def _matchingCharacters(predicate):
+    """Set of characters from the dispatch table range, for which predicate is true
+    """
+    return {char for char in _DISPATCH_TABLE_CHARACTERS if predicate(char)}
+
+
+def _rulesStartCharacters(rules, visitedContexts):
+    """Union of start characters of the rules. None, if any of rules may start with any character
+    """
+    result = set()
+    for rule in rules:
+        startCharacters = rule._startCharacters(visitedContexts)
+        if startCharacters is None:
+            return None
+        result |= startCharacters
+    return result
+
+
+class TextTypeMap:
+    """Text type of every column of a line. Run-length encoded, lookup is O(log runs).
+    Behaves like an immutable string of text type characters.
+    Created from a string, or by the parser with _fromRuns()
+
+    _textTypes is a string of text types of runs. _ends is an array of end columns of runs,
+    or an integer length, if the map contains one run or is empty, which is the most often case
+    """
+    __slots__ = ('_ends', '_textTypes')
+
+    def __init__(self, textTypes=''):
+        self._setRuns([(textType, len(list(group))) for textType, group in itertools.groupby(textTypes)])
+
+    @classmethod
+    def _fromRuns(cls, runs):
+        """Create map from list of (textType, length). Neighbour runs might have the same text type
+        """
+        textTypeMap = cls.__new__(cls)
+        textTypeMap._setRuns(runs)
+        return textTypeMap
+
+    def _setRuns(self, runs):
+        ends = array.array('I')
+        textTypes = []
+        end = 0
+        for textType, length in runs:
+            if length == 0:
+                continue
+            end += length
+            if textTypes and textTypes[-1] == textType:
+                ends[-1] = end
+            else:
+                ends.append(end)
+                textTypes.append(textType)
+
+        if len(textTypes) <= 1:
+            self._ends = end
+        else:
+            self._ends = ends
+        self._textTypes = ''.join(textTypes)
+
+    def _runs(self):
+        if isinstance(self._ends, int):
+            if self._ends:
+                yield self._textTypes, self._ends
+            return
+
+        start = 0
+        for end, textType in zip(self._ends, self._textTypes):
+            yield textType, end - start
+            start = end
+
+    def runCount(self):
+        """Count of runs of the same text type
+        """
+        return len(self._textTypes)
+
+    def __len__(self):
+        if isinstance(self._ends, int):
+            return self._ends
+        return self._ends[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return str(self)[index]
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('TextTypeMap index out of range')
+
+        if isinstance(self._ends, int):
+            return self._textTypes
+        return self._textTypes[bisect.bisect_right(self._ends, index)]
+
+    def __iter__(self):
+        for textType, length in self._runs():
+            for i in range(length):
+                yield textType
+
+    def __add__(self, other):
+        if not isinstance(other, TextTypeMap):
+            return NotImplemented
+        return TextTypeMap._fromRuns(list(self._runs()) + list(other._runs()))
+
+    def __eq__(self, other):
+        if not isinstance(other, TextTypeMap):
+            return NotImplemented
+        return self._ends == other._ends and self._textTypes == other._textTypes
+
+    __hash__ = None
+
+    def __str__(self):
+        return ''.join([textType * length for textType, length in self._runs()])
+
+    def __repr__(self):
+        return 'TextTypeMap(%r)' % str(self)
+
+    def __reduce__(self):
+        return (TextTypeMap, (str(self),))
+
+    def __sizeof__(self):
+        """One character strings and small integers are shared by Python and are not counted
+        """
+        size = object.__sizeof__(self)
+        if len(self._textTypes) > 1:
+            size += self._textTypes.__sizeof__()
+        if not isinstance(self._ends, int) or self._ends > 256:
+            size += self._ends.__sizeof__()
+        return size
+
 
 class ContextStack:
-    def __init__(self, contexts, data):
+    """Immutable context stack. Frames are linked from the top to the default context stack.
+    Stacks are interned: every stack keeps its alive children, therefore equal stacks are the same object,
+    and stacks are compared by identity
+    """
+    __slots__ = ('_parent', '_context', '_data', '_size', '_children', '__weakref__')
+
+    def __init__(self, context, data=None, parent=None):
         """Create default context stack for syntax
-        Contains default context on the top
+        Contains default context on the top.
+        Other stacks are created with append() and pop()
         """
-        self._contexts = contexts
+        self._parent = parent
+        self._context = context
         self._data = data
+        self._size = parent._size + 1 if parent is not None else 1
+        self._children = None
 
     def pop(self, count):
-        """Returns new context stack, which doesn't contain few levels
+        """Returns context stack, which doesn't contain few levels
         """
-        if len(self._contexts) - 1 < count:
-            _logger.error("#pop value is too big %d", len(self._contexts))
-            if len(self._contexts) > 1:
-                return ContextStack(self._contexts[:1], self._data[:1])
-            else:
-                return self
+        if self._size - 1 < count:
+            _logger.error("#pop value is too big %d", self._size)
+            count = self._size - 1
 
-        return ContextStack(self._contexts[:-count], self._data[:-count])
+        contextStack = self
+        for i in range(count):
+            contextStack = contextStack._parent
+        return contextStack
 
     def append(self, context, data):
-        """Returns new context, which contains current stack and new frame
+        """Returns context stack, which contains current stack and new frame
         """
-        return ContextStack(self._contexts + [context], self._data + [data])
+        key = (context, data)
+        if self._children is None:
+            self._children = weakref.WeakValueDictionary()
+        else:
+            contextStack = self._children.get(key)
+            if contextStack is not None:
+                return contextStack
+
+        contextStack = ContextStack(context, data, self)
+        self._children[key] = contextStack
+        return contextStack
 
     def currentContext(self):
         """Get current context
         """
-        return self._contexts[-1]
+        return self._context
 
     def currentData(self):
         """Get current data
         """
-        return self._data[-1]
+        return self._data
 
 
 class ContextSwitcher:
@@ -85,35 +247,80 @@ class ContextSwitcher:
 
 
 class TextToMatchObject:
-    """Peace of text, which shall be matched.
+    """Cursor in the line of text, which shall be matched.
+    Created once per line and moved with update(). Rules match wholeLineText at currentColumnIndex
+    instead of slicing the line.
     Contains pre-calculated and pre-checked data for performance optimization
+
+    Public attributes:
+        currentColumnIndex
+        wholeLineText
+        firstNonSpace       Only spaces are before the cursor
+        isWordStart
+        wordLength          Length of the word, which starts at the cursor. 0, if not a word start
+        word                The word. None, if not a word start
+        contextData
     """
     def __init__(self, currentColumnIndex, wholeLineText, deliminatorSet, contextData):
-        self.currentColumnIndex = currentColumnIndex
         self.wholeLineText = wholeLineText
-        self.text = wholeLineText[currentColumnIndex:]
-        self.textLen = len(self.text)
+        self.contextData = contextData
+        self._deliminatorSet = deliminatorSet
+        self._firstNonSpaceColumn = len(wholeLineText) - len(wholeLineText.lstrip())
+
+        # There are no deliminators in the line in range [_wordScanStart, _wordEnd)
+        self._wordScanStart = 0
+        self._wordEnd = -1
 
-        self.firstNonSpace = not bool(wholeLineText[:currentColumnIndex].strip())
+        self.update(currentColumnIndex)
+
+    def setContext(self, deliminatorSet, contextData):
+        """Set parameters of the context, which parses the text.
+        Contexts, included from other syntaxes, have own deliminators
+        """
+        if deliminatorSet is not self._deliminatorSet:
+            self._deliminatorSet = deliminatorSet
+            self._wordEnd = -1  # invalidate cached word boundaries
+        self.contextData = contextData
+
+    def update(self, currentColumnIndex):
+        """Move the cursor to the column
+        """
+        self.currentColumnIndex = currentColumnIndex
+
+        self.firstNonSpace = currentColumnIndex <= self._firstNonSpaceColumn
 
         self.isWordStart = currentColumnIndex == 0 or \
-                         wholeLineText[currentColumnIndex - 1].isspace() or \
-                         wholeLineText[currentColumnIndex - 1] in deliminatorSet
+                         self.wholeLineText[currentColumnIndex - 1].isspace() or \
+                         self.wholeLineText[currentColumnIndex - 1] in self._deliminatorSet
 
-        self.word = None
+        self._word = None
         if self.isWordStart:
-            wordEndIndex = 0
-            for index, char in enumerate(self.text):
-                if char in deliminatorSet:
-                    wordEndIndex = index
-                    break
-            else:
-                wordEndIndex = len(wholeLineText)
+            self.wordLength = self._wordEndIndex(currentColumnIndex) - currentColumnIndex
+        else:
+            self.wordLength = 0
 
-            if wordEndIndex != 0:
-                self.word = self.text[:wordEndIndex]
+    @property
+    def word(self):
+        """The word is sliced on the first access, because most of word starts are not checked by rules
+        """
+        if self._word is None and self.wordLength:
+            self._word = self.wholeLineText[self.currentColumnIndex:self.currentColumnIndex + self.wordLength]
+        return self._word
 
-        self.contextData = contextData
+    def _wordEndIndex(self, currentColumnIndex):
+        """Index of the first deliminator at or after the column, or length of the line.
+        The cursor moves forward, therefore every part of the line is scanned once
+        """
+        if not self._wordScanStart <= currentColumnIndex <= self._wordEnd:
+            self._wordScanStart = currentColumnIndex
+            line = self.wholeLineText
+            deliminatorSet = self._deliminatorSet
+            index = currentColumnIndex
+            while index < len(line) and line[index] not in deliminatorSet:
+                index += 1
+            self._wordEnd = index
+
+        return self._wordEnd
 
 
 class RuleTryMatchResult:
@@ -198,6 +405,13 @@ class AbstractRule:
 
         return self._tryMatch(textToMatchObject)
 
+    def _startCharacters(self, visitedContexts):
+        """Get set of characters, from which text matched by the rule may start.
+        Only characters from the dispatch table range are included.
+        Returns None, if the rule may match text, which starts with any character
+        """
+        return None
+
 
 class DetectChar(AbstractRule):
     """Public attributes:
@@ -229,10 +443,16 @@ class DetectChar(AbstractRule):
         else:
             string = self.char
 
-        if textToMatchObject.text[0] == string:
+        if textToMatchObject.wholeLineText[textToMatchObject.currentColumnIndex] == string:
             return RuleTryMatchResult(self, 1)
         return None
 
+    def _startCharacters(self, visitedContexts):
+        if self.dynamic:
+            return None
+
+        return _matchingCharacters(lambda char: char == self.char)
+
 
 class Detect2Chars(AbstractRule):
     """Public attributes
@@ -249,11 +469,19 @@ class Detect2Chars(AbstractRule):
         if self.string is None:
             return None
 
-        if textToMatchObject.text.startswith(self.string):
+        if textToMatchObject.wholeLineText.startswith(self.string, textToMatchObject.currentColumnIndex):
             return RuleTryMatchResult(self, len(self.string))
 
         return None
 
+    def _startCharacters(self, visitedContexts):
+        if self.string is None:
+            return set()
+        elif not self.string:
+            return None  # empty string matches everywhere
+
+        return _matchingCharacters(lambda char: char == self.string[0])
+
 
 class AnyChar(AbstractRule):
     """Public attributes:
@@ -267,11 +495,14 @@ class AnyChar(AbstractRule):
         return 'AnyChar(%s)' % self.string
 
     def _tryMatch(self, textToMatchObject):
-        if textToMatchObject.text[0] in self.string:
+        if textToMatchObject.wholeLineText[textToMatchObject.currentColumnIndex] in self.string:
             return RuleTryMatchResult(self, 1)
 
         return None
 
+    def _startCharacters(self, visitedContexts):
+        return _matchingCharacters(lambda char: char in self.string)
+
 
 class StringDetect(AbstractRule):
     """Public attributes:
@@ -295,11 +526,19 @@ class StringDetect(AbstractRule):
         else:
             string = self.string
 
-        if textToMatchObject.text.startswith(string):
+        if textToMatchObject.wholeLineText.startswith(string, textToMatchObject.currentColumnIndex):
             return RuleTryMatchResult(self, len(string))
 
         return None
 
+    def _startCharacters(self, visitedContexts):
+        if self.string is None:
+            return set()
+        elif self.dynamic or not self.string:
+            return None
+
+        return _matchingCharacters(lambda char: char == self.string[0])
+
     @staticmethod
     def _makeDynamicSubsctitutions(string, contextData):
         """For dynamic rules, replace %d patterns with actual strings
@@ -329,7 +568,8 @@ class WordDetect(AbstractRule):
         return 'WordDetect(%s, %d)' % (self.word, self.insensitive)
 
     def _tryMatch(self, textToMatchObject):
-        if textToMatchObject.word is None:
+        if not textToMatchObject.wordLength or \
+           textToMatchObject.wordLength != len(self.word):  # the word is not sliced, if lengths differ
             return None
 
         if self.insensitive or \
@@ -343,56 +583,100 @@ class WordDetect(AbstractRule):
         else:
             return None
 
+    def _startCharacters(self, visitedContexts):
+        if not self.word:
+            return set()
+
+        if self.insensitive or \
+           (not self.parentContext.parser.keywordsCaseSensitive):
+            return _matchingCharacters(lambda char: char.lower() == self.word[0])
+        else:
+            return _matchingCharacters(lambda char: char == self.word[0])
+
+
+class KeywordSet(frozenset):
+    """Words of a keyword list. Created by the loader once per list and shared by the keyword rules.
+    minLength and maxLength allow to reject a word without hashing it
+    """
+    __slots__ = ('minLength', 'maxLength')
+
+    def __init__(self, words=()):
+        lengths = [len(word) for word in self]
+        self.minLength = min(lengths, default=1)
+        self.maxLength = max(lengths, default=0)  # empty set doesn't contain any word
+
 
 class keyword(AbstractRule):
     """Public attributes:
-        string
-        words
+        words   KeywordSet
     """
     def __init__(self, abstractRuleParams, words, insensitive):
         AbstractRule.__init__(self, abstractRuleParams)
-        self.words = set(words)
+        self.words = words
         self.insensitive = insensitive
 
     def shortId(self):
         return 'keyword(%s, %d)' % (' '.join(list(self.words)), self.insensitive)
 
     def _tryMatch(self, textToMatchObject):
-        if textToMatchObject.word is None:
+        wordLength = textToMatchObject.wordLength
+        if not wordLength:
             return None
 
         if self.insensitive or \
            (not self.parentContext.parser.keywordsCaseSensitive):
-            wordToCheck = textToMatchObject.word.lower()
+            wordToCheck = textToMatchObject.word.lower()  # length might change
+            wordLength = len(wordToCheck)
         else:
+            wordToCheck = None  # not sliced, if the length doesn't fit
+
+        if wordLength < self.words.minLength or \
+           wordLength > self.words.maxLength:
+            return None
+
+        if wordToCheck is None:
             wordToCheck = textToMatchObject.word
 
         if wordToCheck in self.words:
-            return RuleTryMatchResult(self, len(wordToCheck))
+            return RuleTryMatchResult(self, textToMatchObject.wordLength)
         else:
             return None
 
+    def _startCharacters(self, visitedContexts):
+        firstLetters = {word[0] for word in self.words if word}
+
+        if self.insensitive or \
+           (not self.parentContext.parser.keywordsCaseSensitive):
+            return _matchingCharacters(lambda char: char.lower() in firstLetters)
+        else:
+            return _matchingCharacters(lambda char: char in firstLetters)
+
 
 class RegExpr(AbstractRule):
-    """ Public attributes:
+    """The pattern is matched against the whole line at the current column.
+    Therefore ^, \\b and look-behind assertions see the text before the column
+
+    Public attributes:
         regExp
-        wordStart
-        lineStart
+        cacheHitCount, cacheMissCount  - usage of the cache of dynamic reg exps. For profiling
     """
     def __init__(self, abstractRuleParams,
-                 string, insensitive, minimal, wordStart, lineStart):
+                 string, insensitive, minimal):
         AbstractRule.__init__(self, abstractRuleParams)
         self.string = string
         self.insensitive = insensitive
         self.minimal = minimal
-        self.wordStart = wordStart
-        self.lineStart = lineStart
 
         if self.dynamic:
             self.regExp = None
         else:
             self.regExp = self._compileRegExp(string, insensitive, minimal)
 
+        # {substituted pattern: compiled reg exp}, the most recently used is the last
+        self._dynamicRegExpCache = collections.OrderedDict()
+        self.cacheHitCount = 0
+        self.cacheMissCount = 0
+
 
     def shortId(self):
         return 'RegExpr( %s )' % self.string
@@ -400,33 +684,44 @@ class RegExpr(AbstractRule):
     def _tryMatch(self, textToMatchObject):
         """Tries to parse text. If matched - saves data for dynamic context
         """
-        # Special case. if pattern starts with \b, we have to check it manually,
-        # because string is passed to .match(..) without beginning
-        if self.wordStart and \
-           (not textToMatchObject.isWordStart):
-                return None
-
-        #Special case. If pattern starts with ^ - check column number manually
-        if self.lineStart and \
-           textToMatchObject.currentColumnIndex > 0:
-            return None
-
         if self.dynamic:
-            string = self._makeDynamicSubsctitutions(self.string, textToMatchObject.contextData)
-            regExp = self._compileRegExp(string, self.insensitive, self.minimal)
+            regExp = self._dynamicRegExp(textToMatchObject.contextData)
         else:
             regExp = self.regExp
 
         if regExp is None:
             return None
 
-        wholeMatch, groups = self._matchPattern(regExp, textToMatchObject.text)
+        wholeMatch, groups = self._matchPattern(regExp,
+                                                textToMatchObject.wholeLineText,
+                                                textToMatchObject.currentColumnIndex)
         if wholeMatch is not None:
             count = len(wholeMatch)
             return RuleTryMatchResult(self, count, groups)
         else:
             return None
 
+    def _dynamicRegExp(self, contextData):
+        """Compiled reg exp of a dynamic rule. The same patterns are substituted again and again,
+        i.e. for every column of a here document, therefore recently used reg exps are cached
+        """
+        string = self._makeDynamicSubsctitutions(self.string, contextData)
+        cache = self._dynamicRegExpCache
+        # pop() and assignment are atomic, the rule may be used by several threads
+        regExp = cache.pop(string, False)
+        if regExp is not False:  # None for invalid pattern is cached too
+            self.cacheHitCount += 1
+        else:
+            self.cacheMissCount += 1
+            regExp = self._compileRegExp(string, self.insensitive, self.minimal)
+            if len(cache) >= _DYNAMIC_REG_EXP_CACHE_SIZE:
+                try:
+                    cache.popitem(last=False)
+                except KeyError:  # cleared by other thread
+                    pass
+        cache[string] = regExp
+        return regExp
+
     @staticmethod
     def _makeDynamicSubsctitutions(string, contextData):
         """For dynamic rules, replace %d patterns with actual strings
@@ -465,18 +760,68 @@ class RegExpr(AbstractRule):
             return None
 
     @staticmethod
-    def _matchPattern(regExp, string):
-        """Try to match pattern.
+    def _matchPattern(regExp, string, pos):
+        """Try to match pattern at pos. ^ matches only at the beginning of the string
         Returns tuple (whole match, groups) or (None, None)
         Python function, used by C code
         """
-        match = regExp.match(string)
+        match = regExp.match(string, pos)
         if match is not None and match.group(0):
             return match.group(0), (match.group(0), ) + match.groups()
         else:
             return None, None
 
 
+class RegExprAlternation(AbstractRule):
+    """Consecutive RegExpr rules, folded by the loader into one reg exp.
+    The pattern is an alternation with a group per rule, the group of the N-th rule is named _rN.
+    Alternatives are tried in order, therefore the first matching rule wins as usual
+
+    Public attributes:
+        rules
+        regExp      None, if the pattern is invalid. Then the rules are tried one by one
+    """
+    def __init__(self, abstractRuleParams, rules, string, insensitive, minimal):
+        AbstractRule.__init__(self, abstractRuleParams)
+        self.rules = rules
+        self.string = string
+        self.regExp = RegExpr._compileRegExp(string, insensitive, minimal)
+
+        # group index: (rule index, group count of the rule)
+        if self.regExp is not None:
+            self._alternatives = {self.regExp.groupindex['_r%d' % index]: (index, rule.regExp.groups) \
+                                        for index, rule in enumerate(rules)}
+
+    def shortId(self):
+        return 'RegExprAlternation( %s )' % self.string
+
+    def _tryMatch(self, textToMatchObject):
+        if self.regExp is None:
+            return self._tryMatchRules(textToMatchObject, 0)
+
+        match = self.regExp.match(textToMatchObject.wholeLineText,
+                                  textToMatchObject.currentColumnIndex)
+        if match is None:
+            return None
+
+        # the group of the alternative is closed after groups of its pattern
+        ruleIndex, groupCount = self._alternatives[match.lastindex]
+        wholeMatch = match.group(0)
+        if not wholeMatch:  # RegExpr doesn't match empty text, the next rules are tried
+            return self._tryMatchRules(textToMatchObject, ruleIndex + 1)
+
+        groups = (wholeMatch, ) + match.groups()[match.lastindex:match.lastindex + groupCount]
+        return RuleTryMatchResult(self.rules[ruleIndex], len(wholeMatch), groups)
+
+    def _tryMatchRules(self, textToMatchObject, startIndex):
+        for rule in self.rules[startIndex:]:
+            ruleTryMatchResult = rule.tryMatch(textToMatchObject)
+            if ruleTryMatchResult is not None:
+                return ruleTryMatchResult
+        else:
+            return None
+
+
 class AbstractNumberRule(AbstractRule):
     """Base class for Int and Float rules.
     This rules can have child rules
@@ -497,41 +842,43 @@ class AbstractNumberRule(AbstractRule):
         if not textToMatchObject.isWordStart:
             return None
 
-        index = self._tryMatchText(textToMatchObject.text)
+        column = textToMatchObject.currentColumnIndex
+        index = self._tryMatchText(textToMatchObject.wholeLineText, column)
         if index is None:
             return None
 
-        if textToMatchObject.currentColumnIndex + index < len(textToMatchObject.wholeLineText):
-            newTextToMatchObject = TextToMatchObject(textToMatchObject.currentColumnIndex + index,
-                                                      textToMatchObject.wholeLineText,
-                                                      self.parentContext.parser.deliminatorSet,
-                                                      textToMatchObject.contextData)
+        if column + index < len(textToMatchObject.wholeLineText):
+            textToMatchObject.update(column + index)
             for rule in self.childRules:
-                ruleTryMatchResult = rule.tryMatch(newTextToMatchObject)
+                ruleTryMatchResult = rule.tryMatch(textToMatchObject)
                 if ruleTryMatchResult is not None:
                     index += ruleTryMatchResult.length
                     break
                 # child rule context and attribute ignored
+            textToMatchObject.update(column)
 
         return RuleTryMatchResult(self, index)
 
-    def _countDigits(self, text):
-        """Count digits at start of text
+    def _countDigits(self, text, start):
+        """Count digits in the text, starting from index start
         """
-        index = 0
+        index = start
         while index < len(text):
             if not text[index].isdigit():
                 break
             index += 1
-        return index
+        return index - start
 
 
 class Int(AbstractNumberRule):
     def shortId(self):
         return 'Int()'
 
-    def _tryMatchText(self, text):
-        matchedLength = self._countDigits(text)
+    def _startCharacters(self, visitedContexts):
+        return _matchingCharacters(lambda char: char.isdigit())
+
+    def _tryMatchText(self, text, start):
+        matchedLength = self._countDigits(text, start)
 
         if matchedLength:
             return matchedLength
@@ -543,50 +890,54 @@ class Float(AbstractNumberRule):
     def shortId(self):
         return 'Float()'
 
-    def _tryMatchText(self, text):
+    def _startCharacters(self, visitedContexts):
+        # exponent without mantissa, i.e. 'e5', is matched too
+        return _matchingCharacters(lambda char: char.isdigit() or char in '.eE')
+
+    def _tryMatchText(self, text, start):
 
         haveDigit = False
         havePoint = False
 
-        matchedLength = 0
+        index = start
 
-        digitCount = self._countDigits(text[matchedLength:])
+        digitCount = self._countDigits(text, index)
         if digitCount:
             haveDigit = True
-            matchedLength += digitCount
+            index += digitCount
 
-        if len(text) > matchedLength and text[matchedLength] == '.':
+        if len(text) > index and text[index] == '.':
             havePoint = True
-            matchedLength += 1
+            index += 1
 
-        digitCount = self._countDigits(text[matchedLength:])
+        digitCount = self._countDigits(text, index)
         if digitCount:
             haveDigit = True
-            matchedLength += digitCount
+            index += digitCount
 
-        if len(text) > matchedLength and text[matchedLength].lower() == 'e':
-            matchedLength += 1
+        if len(text) > index and text[index].lower() == 'e':
+            index += 1
 
-            if len(text) > matchedLength and text[matchedLength] in '+-':
-                matchedLength += 1
+            if len(text) > index and text[index] in '+-':
+                index += 1
 
             haveDigitInExponent = False
 
-            digitCount = self._countDigits(text[matchedLength:])
+            digitCount = self._countDigits(text, index)
             if digitCount:
                 haveDigitInExponent = True
-                matchedLength += digitCount
+                index += digitCount
 
             if not haveDigitInExponent:
                 return None
 
-            return matchedLength
+            return index - start
         else:
             if not havePoint:
                 return None
 
-        if matchedLength and haveDigit:
-            return matchedLength
+        if index > start and haveDigit:
+            return index - start
         else:
             return None
 
@@ -595,51 +946,65 @@ class HlCOct(AbstractRule):
     def shortId(self):
         return 'HlCOct'
 
+    def _startCharacters(self, visitedContexts):
+        return {'0'}
+
     def _tryMatch(self, textToMatchObject):
-        if textToMatchObject.text[0] != '0':
+        text = textToMatchObject.wholeLineText
+        start = textToMatchObject.currentColumnIndex
+
+        if text[start] != '0':
             return None
 
-        index = 1
-        while index < len(textToMatchObject.text) and textToMatchObject.text[index] in '01234567':
+        index = start + 1
+        while index < len(text) and text[index] in '01234567':
             index += 1
 
-        if index == 1:
+        if index == start + 1:
             return None
 
-        if index < len(textToMatchObject.text) and textToMatchObject.text[index].upper() in 'LU':
+        if index < len(text) and text[index].upper() in 'LU':
             index += 1
 
-        return RuleTryMatchResult(self, index)
+        return RuleTryMatchResult(self, index - start)
 
 
 class HlCHex(AbstractRule):
     def shortId(self):
         return 'HlCHex'
 
+    def _startCharacters(self, visitedContexts):
+        return {'0'}
+
     def _tryMatch(self, textToMatchObject):
-        if len(textToMatchObject.text) < 3:
+        text = textToMatchObject.wholeLineText
+        start = textToMatchObject.currentColumnIndex
+
+        if len(text) - start < 3:
             return None
 
-        if textToMatchObject.text[:2].upper() != '0X':
+        if text[start] != '0' or text[start + 1] not in 'xX':
             return None
 
-        index = 2
-        while index < len(textToMatchObject.text) and textToMatchObject.text[index].upper() in '0123456789ABCDEF':
+        index = start + 2
+        while index < len(text) and text[index].upper() in '0123456789ABCDEF':
             index += 1
 
-        if index == 2:
+        if index == start + 2:
             return None
 
-        if index < len(textToMatchObject.text) and textToMatchObject.text[index].upper() in 'LU':
+        if index < len(text) and text[index].upper() in 'LU':
             index += 1
 
-        return RuleTryMatchResult(self, index)
+        return RuleTryMatchResult(self, index - start)
 
 
-def _checkEscapedChar(text):
-    index = 0
-    if len(text) > 1 and text[0] == '\\':
-        index = 1
+def _checkEscapedChar(text, start):
+    """Check if escaped character is in the text at index start.
+    Returns its length or None
+    """
+    if len(text) - start > 1 and text[start] == '\\':
+        index = start + 1
 
         if text[index] in "abefnrtv'\"?\\":
             index += 1
@@ -647,15 +1012,15 @@ def _checkEscapedChar(text):
             index += 1
             while index < len(text) and text[index].upper() in '0123456789ABCDEF':
                 index += 1
-            if index == 2:  # no hex digits
+            if index == start + 2:  # no hex digits
                 return None
         elif text[index] in '01234567':
-            while index < 4 and index < len(text) and text[index] in '01234567':
+            while index < start + 4 and index < len(text) and text[index] in '01234567':
                 index += 1
         else:
             return None
 
-        return index
+        return index - start
 
     return None
 
@@ -664,8 +1029,11 @@ class HlCStringChar(AbstractRule):
     def shortId(self):
         return 'HlCStringChar'
 
+    def _startCharacters(self, visitedContexts):
+        return {'\\'}
+
     def _tryMatch(self, textToMatchObject):
-        res = _checkEscapedChar(textToMatchObject.text)
+        res = _checkEscapedChar(textToMatchObject.wholeLineText, textToMatchObject.currentColumnIndex)
         if res is not None:
             return RuleTryMatchResult(self, res)
         else:
@@ -676,16 +1044,22 @@ class HlCChar(AbstractRule):
     def shortId(self):
         return 'HlCChar'
 
+    def _startCharacters(self, visitedContexts):
+        return {"'"}
+
     def _tryMatch(self, textToMatchObject):
-        if len(textToMatchObject.text) > 2 and textToMatchObject.text[0] == "'" and textToMatchObject.text[1] != "'":
-            result = _checkEscapedChar(textToMatchObject.text[1:])
+        text = textToMatchObject.wholeLineText
+        start = textToMatchObject.currentColumnIndex
+
+        if len(text) - start > 2 and text[start] == "'" and text[start + 1] != "'":
+            result = _checkEscapedChar(text, start + 1)
             if result is not None:
-                index = 1 + result
+                index = start + 1 + result
             else:  # 1 not escaped character
-                index = 1 + 1
+                index = start + 1 + 1
 
-            if index < len(textToMatchObject.text) and textToMatchObject.text[index] == "'":
-                return RuleTryMatchResult(self, index + 1)
+            if index < len(text) and text[index] == "'":
+                return RuleTryMatchResult(self, index + 1 - start)
 
         return None
 
@@ -704,20 +1078,33 @@ class RangeDetect(AbstractRule):
         return 'RangeDetect(%s, %s)' % (self.char, self.char1)
 
     def _tryMatch(self, textToMatchObject):
-        if textToMatchObject.text.startswith(self.char):
-            end = textToMatchObject.text.find(self.char1, 1)
-            if end > 0:
-                return RuleTryMatchResult(self, end + 1)
+        text = textToMatchObject.wholeLineText
+        start = textToMatchObject.currentColumnIndex
+
+        if text.startswith(self.char, start):
+            end = text.find(self.char1, start + 1)
+            if end > start:
+                return RuleTryMatchResult(self, end + 1 - start)
 
         return None
 
+    def _startCharacters(self, visitedContexts):
+        if not self.char:
+            return None
+
+        return _matchingCharacters(lambda char: char == self.char[0])
+
 
 class LineContinue(AbstractRule):
     def shortId(self):
         return 'LineContinue'
 
+    def _startCharacters(self, visitedContexts):
+        return {'\\'}
+
     def _tryMatch(self, textToMatchObject):
-        if textToMatchObject.text == '\\':
+        if textToMatchObject.currentColumnIndex == len(textToMatchObject.wholeLineText) - 1 and \
+           textToMatchObject.wholeLineText[-1] == '\\':
             return RuleTryMatchResult(self, 1)
 
         return None
@@ -755,15 +1142,27 @@ class IncludeRules(AbstractRule):
         else:
             return None
 
+    def _startCharacters(self, visitedContexts):
+        if self.context in visitedContexts or \
+           not hasattr(self.context, 'rules'):  # recursive inclusion, or the context is not loaded yet
+            return None
+
+        return _rulesStartCharacters(self.context.rules, visitedContexts | {self.context})
+
 
 class DetectSpaces(AbstractRule):
+    _regExp = re.compile('\\s+')
     def shortId(self):
         return 'DetectSpaces()'
 
+    def _startCharacters(self, visitedContexts):
+        return _matchingCharacters(lambda char: char.isspace())
+
     def _tryMatch(self, textToMatchObject):
-        spaceLen = len(textToMatchObject.text) - len(textToMatchObject.text.lstrip())
-        if spaceLen:
-            return RuleTryMatchResult(self, spaceLen)
+        match = DetectSpaces._regExp.match(textToMatchObject.wholeLineText,
+                                           textToMatchObject.currentColumnIndex)
+        if match is not None:
+            return RuleTryMatchResult(self, match.end() - match.start())
         else:
             return None
 
@@ -774,12 +1173,16 @@ class DetectIdentifier(AbstractRule):
         return 'DetectIdentifier()'
 
     def _tryMatch(self, textToMatchObject):
-        match = DetectIdentifier._regExp.match(textToMatchObject.text)
-        if match is not None and match.group(0):
-            return RuleTryMatchResult(self, len(match.group(0)))
+        match = DetectIdentifier._regExp.match(textToMatchObject.wholeLineText,
+                                               textToMatchObject.currentColumnIndex)
+        if match is not None:
+            return RuleTryMatchResult(self, match.end() - match.start())
 
         return None
 
+    def _startCharacters(self, visitedContexts):
+        return _matchingCharacters(lambda char: DetectIdentifier._regExp.match(char) is not None)
+
 
 class Context:
     """Highlighting context
@@ -792,11 +1195,15 @@ class Context:
         dynamic
         rules
         textType     ' ' : code, 'c' : comment
+        dispatchTable   List of rule tuples, indexed by code of the current character.
+                        Contains only rules, which may match text starting with the character.
+                        None, if not compiled
     """
     def __init__(self, parser, name):
         # Will be initialized later, after all context has been created
         self.parser = parser
         self.name = name
+        self.dispatchTable = None
 
     def setValues(self, attribute, format, lineEndContext, lineBeginContext, lineEmptyContext, fallthroughContext, dynamic, textType):
         self.attribute = attribute
@@ -810,6 +1217,21 @@ class Context:
 
     def setRules(self, rules):
         self.rules = rules
+        self.dispatchTable = None
+
+    def compileDispatchTable(self):
+        """Build dispatchTable. Shall be called after all contexts of the parser got their rules.
+        """
+        rulesStartCharacters = [(rule, rule._startCharacters({self})) for rule in self.rules]
+
+        uniqueRuleLists = {}
+        table = []
+        for char in _DISPATCH_TABLE_CHARACTERS:
+            rules = tuple([rule for rule, startCharacters in rulesStartCharacters \
+                                if startCharacters is None or char in startCharacters])
+            table.append(uniqueRuleLists.setdefault(rules, rules))
+
+        self.dispatchTable = table
 
     def __str__(self):
         """Serialize.
@@ -828,30 +1250,45 @@ class Context:
             res += str(rule)
         return res
 
-    def parseBlock(self, contextStack, currentColumnIndex, text):
+    def parseBlock(self, contextStack, currentColumnIndex, endColumnIndex, textToMatchObject, highlight=True):
         """Parse block
-        Exits, when reached end of the text, or when context is switched
-        Returns (length, newContextStack, highlightedSegments, lineContinue)
+        textToMatchObject is the cursor in the line, shared by all contexts, which parse the line
+        Exits, when reached endColumnIndex, or when context is switched.
+        A matched rule might move the position beyond endColumnIndex
+        If highlight is False, highlightedSegments and textTypeRuns are not built and are empty
+        Returns (length, newContextStack, highlightedSegments, textTypeRuns, lineContinue)
+          where textTypeRuns is a list of (textType, length)
         """
+        text = textToMatchObject.wholeLineText
+        textToMatchObject.setContext(self.parser.deliminatorSet, contextStack.currentData())
         startColumnIndex = currentColumnIndex
         countOfNotMatchedSymbols = 0
         highlightedSegments = []
-        textTypeMap = []
+        textTypeRuns = []
         ruleTryMatchResult = None
-        while currentColumnIndex < len(text):
-            textToMatchObject = TextToMatchObject(currentColumnIndex,
-                                                   text,
-                                                   self.parser.deliminatorSet,
-                                                   contextStack.currentData())
-            for rule in self.rules:
+        dispatchTable = self.dispatchTable
+        while currentColumnIndex < endColumnIndex:
+            if dispatchTable is not None and \
+               text[currentColumnIndex] < '\x80':
+                rules = dispatchTable[ord(text[currentColumnIndex])]
+            else:
+                rules = self.rules
+
+            if rules:
+                textToMatchObject.update(currentColumnIndex)
+            else:
+                ruleTryMatchResult = None
+
+            for rule in rules:
                 ruleTryMatchResult = rule.tryMatch(textToMatchObject)
                 if ruleTryMatchResult is not None:  # if something matched
                     _logger.debug('\tmatched rule %s at %d',
                                   rule.shortId(),
                                   currentColumnIndex)
                     if countOfNotMatchedSymbols > 0:
-                        highlightedSegments.append((countOfNotMatchedSymbols, self.format))
-                        textTypeMap += [self.textType for i in range(countOfNotMatchedSymbols)]
+                        if highlight:
+                            highlightedSegments.append((countOfNotMatchedSymbols, self.format))
+                            textTypeRuns.append((self.textType, countOfNotMatchedSymbols))
                         countOfNotMatchedSymbols = 0
 
                     if ruleTryMatchResult.rule.context is not None:
@@ -860,41 +1297,48 @@ class Context:
                     else:
                         newContextStack = contextStack
 
-                    format = ruleTryMatchResult.rule.format if ruleTryMatchResult.rule.attribute else newContextStack.currentContext().format
-                    textType = ruleTryMatchResult.rule.textType or newContextStack.currentContext().textType
+                    if highlight:
+                        format = ruleTryMatchResult.rule.format if ruleTryMatchResult.rule.attribute else newContextStack.currentContext().format
+                        textType = ruleTryMatchResult.rule.textType or newContextStack.currentContext().textType
 
-                    highlightedSegments.append((ruleTryMatchResult.length,
-                                                format))
-                    textTypeMap += textType * ruleTryMatchResult.length
+                        highlightedSegments.append((ruleTryMatchResult.length,
+                                                    format))
+                        textTypeRuns.append((textType, ruleTryMatchResult.length))
 
                     currentColumnIndex += ruleTryMatchResult.length
 
-                    if newContextStack != contextStack:
+                    if newContextStack is not contextStack:
                         lineContinue = isinstance(ruleTryMatchResult.rule, LineContinue)
 
-                        return currentColumnIndex - startColumnIndex, newContextStack, highlightedSegments, textTypeMap, lineContinue
+                        return currentColumnIndex - startColumnIndex, newContextStack, highlightedSegments, textTypeRuns, lineContinue
+                    elif ruleTryMatchResult.rule.context is not None and \
+                         ruleTryMatchResult.length == 0:
+                        # Rule didn't switch context or consume character. The same situation will occur on next step
+                        _logger.error('Loop detected')
+                        currentColumnIndex += 1  # parsing bug. But avoid freeze
+                        countOfNotMatchedSymbols += 1
 
                     break  # for loop
             else:  # no matched rules
                 if self.fallthroughContext is not None:
                     newContextStack = self.fallthroughContext.getNextContextStack(contextStack)
-                    if newContextStack != contextStack:
-                        if countOfNotMatchedSymbols > 0:
+                    if newContextStack is not contextStack:
+                        if countOfNotMatchedSymbols > 0 and highlight:
                             highlightedSegments.append((countOfNotMatchedSymbols, self.format))
-                            textTypeMap += [self.textType for i in range(countOfNotMatchedSymbols)]
-                        return (currentColumnIndex - startColumnIndex, newContextStack, highlightedSegments, textTypeMap, False)
+                            textTypeRuns.append((self.textType, countOfNotMatchedSymbols))
+                        return (currentColumnIndex - startColumnIndex, newContextStack, highlightedSegments, textTypeRuns, False)
 
                 currentColumnIndex += 1
                 countOfNotMatchedSymbols += 1
 
-        if countOfNotMatchedSymbols > 0:
+        if countOfNotMatchedSymbols > 0 and highlight:
             highlightedSegments.append((countOfNotMatchedSymbols, self.format))
-            textTypeMap += [self.textType for i in range(countOfNotMatchedSymbols)]
+            textTypeRuns.append((self.textType, countOfNotMatchedSymbols))
 
         lineContinue = ruleTryMatchResult is not None and \
                        isinstance(ruleTryMatchResult.rule, LineContinue)
 
-        return currentColumnIndex - startColumnIndex, contextStack, highlightedSegments, textTypeMap, lineContinue
+        return currentColumnIndex - startColumnIndex, contextStack, highlightedSegments, textTypeRuns, lineContinue
 
 
 class Parser:
@@ -905,7 +1349,7 @@ class Parser:
         attributeToFormatMap    Map "attribute" : TextFormat
 
         deliminatorSet          Set of deliminator characters
-        lists                   Keyword lists as dictionary "list name" : "list value"
+        lists                   Keyword lists as dictionary "list name" : KeywordSet
         keywordsCaseSensitive   If true, keywords are not case sensitive
 
         contexts                Context list as dictionary "context name" : context
@@ -921,7 +1365,7 @@ class Parser:
     def setContexts(self, contexts, defaultContext):
         self.contexts = contexts
         self.defaultContext = defaultContext
-        self._defaultContextStack = ContextStack([self.defaultContext], [None])
+        self._defaultContextStack = ContextStack(self.defaultContext)
 
     def __str__(self):
         """Serialize.
@@ -950,7 +1394,31 @@ class Parser:
 
         return (lineData, highlightedSegments)
           where lineData is (contextStack, textTypeMap)
-            where textTypeMap is a string of textType characters
+            where contextStack is None, if it is the default context stack
+            and textTypeMap is a TextTypeMap
+        """
+        lineData, highlightedSegments, columnIndex = \
+            self.highlightBlockPart(text, prevContextStack, 0, max(len(text), 1))
+        return lineData, highlightedSegments
+
+    def highlightBlockPart(self, text, prevContextStack, fromColumnIndex, maxLength):
+        """Parse part of the block. Allows to parse long lines step by step
+
+        Parsing starts at fromColumnIndex with prevContextStack and stops,
+        when fromColumnIndex + maxLength column is reached, and current rule or context ends.
+
+        return (lineData, highlightedSegments, columnIndex)
+          where columnIndex is the column, where parsing stopped.
+          If columnIndex == len(text), the line is finished, and lineData is
+          the same as highlightBlock() result, except that textTypeMap covers only the part.
+          Otherwise the line is not finished, and lineData[0] is the context stack
+          to continue parsing from columnIndex
+        """
+        return self._parseBlockPart(text, prevContextStack, fromColumnIndex, maxLength, True)
+
+    def _parseBlockPart(self, text, prevContextStack, fromColumnIndex, maxLength, highlight):
+        """Implementation of highlightBlockPart() and parseBlock().
+        If highlight is False, only the context stack is calculated, and highlightedSegments and textTypeMap are empty
         """
         if prevContextStack is not None:
             contextStack = prevContextStack
@@ -959,26 +1427,33 @@ class Parser:
 
         highlightedSegments = []
         lineContinue = False
-        currentColumnIndex = 0
-        textTypeMap = []
+        currentColumnIndex = fromColumnIndex
+        endColumnIndex = min(len(text), fromColumnIndex + maxLength)
+        textTypeRuns = []
 
         if len(text) > 0:
-            while currentColumnIndex < len(text):
+            textToMatchObject = TextToMatchObject(currentColumnIndex, text, self.deliminatorSet, None)
+            while currentColumnIndex < endColumnIndex:
                 _logger.debug('In context %s', contextStack.currentContext().name)
 
-                length, newContextStack, segments, textTypeMapPart, lineContinue = \
-                    contextStack.currentContext().parseBlock(contextStack, currentColumnIndex, text)
+                length, newContextStack, segments, textTypeRunsPart, lineContinue = \
+                    contextStack.currentContext().parseBlock(contextStack,
+                                                             currentColumnIndex,
+                                                             endColumnIndex,
+                                                             textToMatchObject,
+                                                             highlight)
 
                 highlightedSegments += segments
                 contextStack = newContextStack
-                textTypeMap += textTypeMapPart
+                textTypeRuns += textTypeRunsPart
                 currentColumnIndex += length
 
-            if not lineContinue:
+            if currentColumnIndex == len(text) and \
+               not lineContinue:
                 while contextStack.currentContext().lineEndContext is not None:
                     oldStack = contextStack
                     contextStack = contextStack.currentContext().lineEndContext.getNextContextStack(contextStack)
-                    if oldStack == contextStack:  # avoid infinite while loop if nothing to switch
+                    if oldStack is contextStack:  # avoid infinite while loop if nothing to switch
                         break
 
                 # this code is not tested, because lineBeginContext is not defined by any xml file
@@ -987,8 +1462,17 @@ class Parser:
         elif contextStack.currentContext().lineEmptyContext is not None:
             contextStack = contextStack.currentContext().lineEmptyContext.getNextContextStack(contextStack)
 
-        lineData = (contextStack, textTypeMap)
-        return lineData, highlightedSegments
+        # as cParser, return None instead of the default context stack
+        if contextStack is self._defaultContextStack:
+            contextStack = None
+
+        lineData = (contextStack, TextTypeMap._fromRuns(textTypeRuns))
+        return lineData, highlightedSegments, currentColumnIndex
 
     def parseBlock(self, text, prevContextStack):
-        return self.highlightBlock(text, prevContextStack)[0]
+        """Parse block and return lineData as highlightBlock() does, but don't build highlighted segments
+        and text type map. textTypeMap of the result is empty
+        """
+        lineData, highlightedSegments, columnIndex = \
+            self._parseBlockPart(text, prevContextStack, 0, max(len(text), 1), False)
+        return lineData
@@ -2,72 +2,100 @@
 Uses syntax module for doing the job
 """
 
+import atexit
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
 import time
+import weakref
 
-from PyQt5.QtCore import QObject, QTimer, pyqtSlot
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtGui import QTextBlockUserData, QTextLayout
 
 import qutepart.syntax
+import qutepart.syntax.batch
 
 
-def _cmpFormatRanges(a, b):
-    """PyQt does not define proper comparison for QTextLayout.FormatRange
-    Define it to check correctly, if formats has changed.
-    It is important for the performance
-    """
-    if a.format == b.format and \
-       a.start == b.start and \
-       a.length == b.length:
-        return 0
-    else:
-        return cmp(id(a), id(b))
-
-
-def _formatRangeListsEqual(a, b):
-    if len(a) != len(b):
-        return False
-
-    for a_item, b_item in zip(a, b):
-        if a_item != b_item:
-            return False
-
-    return True
+_logger = logging.getLogger('qutepart')
 
 
 class _TextBlockUserData(QTextBlockUserData):
-    def __init__(self, data):
+    """Parsing results of a block.
+    contextStack is the context stack at the end of the block. Stacks are interned, equal stacks are
+    the same object. It is used to parse the next block, and to detect, that re-parsing can stop.
+    textTypeMap is used by isCode() and other methods. It is None, if the block has been parsed by
+    _fastForward() and is not highlighted yet. See SyntaxHighlighter._lineData()
+    formatSignature describes formats, which are applied to the block layout. See _applyHighlightedSegments()
+    """
+    def __init__(self, contextStack, textTypeMap, formatSignature=None):
         QTextBlockUserData.__init__(self)
-        self.data = data
+        self.contextStack = contextStack
+        self.textTypeMap = textTypeMap
+        self.formatSignature = formatSignature
+
+    @property
+    def data(self):
+        """lineData, as returned by Syntax.highlightBlock()
+        """
+        return self.contextStack, self.textTypeMap
 
 
 class GlobalTimer:
-    """All parsing and highlighting is done in main loop thread.
+    """Parsing and highlighting is done in main loop thread, unless parsing on the worker thread is enabled
+    with QPART_HIGHLIGHTING_THREAD. Then text is parsed by _highlightInThread() on the worker thread,
+    and only scheduling and applying results is done in main loop thread.
     If parsing is being done for long time, main loop gets blocked.
     Therefore SyntaxHighlighter controls, how long parsign is going, and, if too long,
     schedules timer and releases main loop.
     One global timer is used by all Qutepart instances, because main loop time usage
-    must not depend on opened files count
+    must not depend on opened files count.
+
+    Callbacks with the highest priority (the focused editor, then visible ones) are called first.
+    Callbacks with the same priority are called in turn: a callback, which schedules itself again,
+    is called after other ones. Callbacks are called until the time budget of the main loop iteration
+    is spent, see remainingTime()
     """
+    PRIORITY_FOCUSED = 0
+    PRIORITY_VISIBLE = 1
+    PRIORITY_BACKGROUND = 2
+
+    # callbacks may use this time in one main loop iteration
+    _TIME_BUDGET_SEC = 0.04
 
     def __init__(self):
         self._timer = QTimer(QApplication.instance())
         self._timer.setSingleShot(True)
         self._timer.timeout.connect(self._onTimer)
 
-        self._scheduledCallbacks = []
+        # callback: priority function. Ordered by scheduling time
+        self._scheduledCallbacks = collections.OrderedDict()
+        self._endTime = None  # end of the time budget, if callbacks are being called
+
+        # statistics, see stats()
+        self._callCount = 0
+        self._iterationCount = 0
+        self._maxQueueDepth = 0
+        self._timeSpent = weakref.WeakKeyDictionary()
 
     def isActive(self):
         return self._timer.isActive()
 
-    def scheduleCallback(self, callback):
+    def scheduleCallback(self, callback, priority=None):
+        """Schedule callback. priority is a function, which returns the current priority of the callback.
+        It is called every time, when the next callback is selected. PRIORITY_BACKGROUND is used, if not set
+        """
         if not callback in self._scheduledCallbacks:
-            self._scheduledCallbacks.append(callback)
-            self._timer.start()
+            self._scheduledCallbacks[callback] = priority
+            self._maxQueueDepth = max(self._maxQueueDepth, len(self._scheduledCallbacks))
+            if self._endTime is None:
+                self._timer.start()
 
     def unScheduleCallback(self, callback):
         if callback in self._scheduledCallbacks:
-            self._scheduledCallbacks.remove(callback)
+            del self._scheduledCallbacks[callback]
 
         if not self._scheduledCallbacks:
             self._timer.stop()
@@ -75,10 +103,59 @@ class GlobalTimer:
     def isCallbackScheduled(self, callback):
         return callback in self._scheduledCallbacks
 
+    def remainingTime(self):
+        """Time, which a callback can use now, in seconds.
+        Whole time budget, if called not from a callback
+        """
+        if self._endTime is None:
+            return self._TIME_BUDGET_SEC
+        else:
+            return max(0., self._endTime - time.time())
+
+    def stats(self):
+        """Statistics for profiling. A dictionary:
+            queueDepth     - count of scheduled callbacks
+            maxQueueDepth  - max count of scheduled callbacks
+            callCount      - count of called callbacks
+            iterationCount - count of main loop iterations, in which callbacks were called
+            timeSpent      - {owner: seconds} time spent in callbacks. Owner is the object of the bound method
+        """
+        return {'queueDepth': len(self._scheduledCallbacks),
+                'maxQueueDepth': self._maxQueueDepth,
+                'callCount': self._callCount,
+                'iterationCount': self._iterationCount,
+                'timeSpent': dict(self._timeSpent)}
+
+    def _nextCallback(self):
+        """The first scheduled callback with the highest priority
+        """
+        nextCallback = None
+        nextPriority = None
+        for callback, priority in self._scheduledCallbacks.items():
+            priority = priority() if priority is not None else self.PRIORITY_BACKGROUND
+            if nextPriority is None or priority < nextPriority:
+                nextCallback, nextPriority = callback, priority
+                if priority == self.PRIORITY_FOCUSED:
+                    break
+        return nextCallback
+
     def _onTimer(self):
-        if self._scheduledCallbacks:
-            callback = self._scheduledCallbacks.pop()
-            callback()
+        startTime = time.time()
+        self._endTime = startTime + self._TIME_BUDGET_SEC
+        self._iterationCount += 1
+        try:
+            while self._scheduledCallbacks and time.time() < self._endTime:
+                callback = self._nextCallback()
+                del self._scheduledCallbacks[callback]  # might schedule itself again to the end of the queue
+
+                callStartTime = time.time()
+                callback()
+                self._callCount += 1
+                owner = getattr(callback, '__self__', callback)
+                self._timeSpent[owner] = self._timeSpent.get(owner, 0.) + time.time() - callStartTime
+        finally:
+            self._endTime = None
+
         if self._scheduledCallbacks:
             self._timer.start()
 
@@ -90,12 +167,89 @@ Pyside crashes, if this variable is a class field
 _gLastChangeTime = -777.
 
 
+"""Worker processes for parallel highlighting. See the Qutepart documentation.
+Processes are shared by all Qutepart instances
+"""
+def _processCountFromEnvironment():
+    """Count of the worker processes. 0, which disables parallel highlighting, if the value is invalid
+    """
+    value = os.environ.get('QPART_HIGHLIGHTING_PROCESSES', '0') or '0'
+    try:
+        count = int(value)
+    except ValueError:
+        _logger.warning('Invalid QPART_HIGHLIGHTING_PROCESSES value %s. Parallel highlighting is disabled',
+                        repr(value))
+        return 0
+    return max(count, 0)
+
+
+_gProcessCount = _processCountFromEnvironment()
+_gProcessPool = None  # created on first use
+
+
+def _processPool():
+    global _gProcessPool
+    if _gProcessPool is None:
+        # fork is not safe in a multithreaded Qt application
+        _gProcessPool = multiprocessing.get_context('spawn').Pool(_gProcessCount)
+        atexit.register(_gProcessPool.terminate)
+    return _gProcessPool
+
+
+"""Parsing on a worker thread. See the Qutepart documentation.
+The thread is shared by all Qutepart instances
+"""
+_gThreadHighlighting = os.environ.get('QPART_HIGHLIGHTING_THREAD', 'N') in ('Y', 'y', '1')
+_gThreadPool = None  # created on first use
+
+
+def _threadPool():
+    global _gThreadPool
+    if _gThreadPool is None:
+        _gThreadPool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    return _gThreadPool
+
+
+_NOT_PARSED = object()  # context stack of a block, which has not been parsed yet
+
+
+def _highlightInThread(syntax, texts, contextStack, oldContextStacks, requiredCount):
+    """Highlight texts on the worker thread. At least requiredCount texts are highlighted,
+    and next ones while context stack at the end of the line is not the same as before.
+    Returns ([(lineData, highlightedSegments)], converged)
+    """
+    results = []
+    for index, text in enumerate(texts):
+        lineData, highlightedSegments = syntax.highlightBlock(text, contextStack)
+        results.append((lineData, highlightedSegments))
+        contextStack = lineData[0]
+        if index + 1 >= requiredCount and contextStack is oldContextStacks[index]:
+            return results, True
+    return results, False
+
+
 class SyntaxHighlighter(QObject):
 
+    # emitted from the worker thread. See _startThreadHighlighting()
+    _threadHighlightingFinished = pyqtSignal(object)
+
     # when initially parsing text, it is better, if highlighted text is drawn without flickering
     _MAX_PARSING_TIME_BIG_CHANGE_SEC = 0.4
     # when user is typing text - response shall be quick
     _MAX_PARSING_TIME_SMALL_CHANGE_SEC = 0.02
+    # long lines are parsed by parts. Time is checked after every part
+    _LONG_LINE_PART_LENGTH = 4096
+    # if visible blocks are far below the parsed ones, parser fast-forwards to them. See _fastForward()
+    _FAST_FORWARD_MIN_BLOCK_COUNT = 200
+    # huge files are initially highlighted by worker processes, if enabled. By chunks of lines
+    _PARALLEL_MIN_LINE_COUNT = 50000
+    _PARALLEL_CHUNK_LINE_COUNT = 10000
+    # check, if worker processes have finished the next chunk
+    _PARALLEL_POLL_INTERVAL_MSEC = 20
+    # format ranges are cached for this count of distinct block format signatures
+    _FORMAT_RANGES_CACHE_SIZE = 1000
+    # blocks are sent to the worker thread by chunks, if enabled
+    _THREAD_CHUNK_LINE_COUNT = 500
 
     _globalTimer = GlobalTimer()
 
@@ -107,8 +261,38 @@ class SyntaxHighlighter(QObject):
         self._document = textEdit.document()
 
         # can't store references to block, Qt crashes if block removed
-        self._pendingBlockNumber = None
-        self._pendingAtLeastUntilBlockNumber = None
+        # Blocks, which must be highlighted. Sorted list of disjoint ranges [fromBlockNumber, atLeastUntilBlockNumber].
+        # Every range is highlighted completely, and then while context stack at the end of the block changes.
+        # See _addDirtyBlockRange()
+        self._dirtyBlockRanges = []
+        # State of partially parsed long line:
+        # (blockNumber, columnIndex, contextStack, textTypeMap, highlightedSegments)
+        self._pendingLongLine = None
+        # Blocks, which have been parsed, but formats have not been applied yet. See _fastForward()
+        # List of ranges [fromBlockNumber, untilBlockNumber)
+        self._unformattedBlockRanges = []
+        self._blockCount = self._document.blockCount()
+        # {format signature: [QTextLayout.FormatRange]}. See _applyHighlightedSegments()
+        self._formatRangesCache = {}
+        # [[position, length]] of contiguous blocks, which formats have been changed. See _markBlockDirty()
+        self._dirtyContents = []
+
+        # State of parallel highlighting. See _startParallelHighlighting()
+        self._parallelResults = None  # multiprocessing.AsyncResult for every chunk
+        self._parallelBlockNumber = None  # the first block, which results are not applied yet
+        self._parallelContextStack = None  # real context stack at the end of the previous block
+        self._parallelSynchronized = True  # worker results are valid for the current block
+        self._parallelTimer = QTimer(self)
+        self._parallelTimer.setSingleShot(True)
+        self._parallelTimer.setInterval(self._PARALLEL_POLL_INTERVAL_MSEC)
+        self._parallelTimer.timeout.connect(self._onContinueParallelHighlighting)
+
+        # State of highlighting on the worker thread. See _startThreadHighlighting()
+        self._threadHighlighting = _gThreadHighlighting  # disabled, if the worker thread fails
+        self._revision = 0  # incremented on every change. Results of older revisions are dropped
+        # (revision, fromBlockNumber, atLeastUntilBlockNumber, future) of the chunk being parsed
+        self._threadJob = None
+        self._threadHighlightingFinished.connect(self._onThreadHighlightingFinished)
 
         self._document.contentsChange.connect(self._onContentsChange)
 
@@ -122,12 +306,18 @@ class SyntaxHighlighter(QObject):
             pass
 
         self._globalTimer.unScheduleCallback(self._onContinueHighlighting)
+        self._stopParallelHighlighting()
+        self._threadJob = None
+        self._pendingLongLine = None
+        self._dirtyBlockRanges = []
+        self._unformattedBlockRanges = []
+        self._dirtyContents = []
         block = self._document.firstBlock()
         while block.isValid():
             block.layout().setAdditionalFormats([])
             block.setUserData(None)
-            self._document.markContentsDirty(block.position(), block.length())
             block = block.next()
+        self._document.markContentsDirty(0, self._document.characterCount())
         self._globalTimer.unScheduleCallback(self._onContinueHighlighting)
 
     def syntax(self):
@@ -138,44 +328,69 @@ class SyntaxHighlighter(QObject):
     def isInProgress(self):
         """Highlighting is in progress
         """
-        return self._globalTimer.isCallbackScheduled(self._onContinueHighlighting)
+        return self._globalTimer.isCallbackScheduled(self._onContinueHighlighting) or \
+               self._parallelResults is not None or \
+               self._threadJob is not None
 
     def isCode(self, block, column):
         """Check if character at column is a a code
         """
-        dataObject = block.userData()
-        data = dataObject.data if dataObject is not None else None
-        return self._syntax.isCode(data, column)
+        return self._syntax.isCode(self._lineData(block), column)
 
     def isComment(self, block, column):
         """Check if character at column is a comment
         """
-        dataObject = block.userData()
-        data = dataObject.data if dataObject is not None else None
-        return self._syntax.isComment(data, column)
+        return self._syntax.isComment(self._lineData(block), column)
 
     def isBlockComment(self, block, column):
         """Check if character at column is a block comment
         """
-        dataObject = block.userData()
-        data = dataObject.data if dataObject is not None else None
-        return self._syntax.isBlockComment(data, column)
+        return self._syntax.isBlockComment(self._lineData(block), column)
 
     def isHereDoc(self, block, column):
         """Check if character at column is a here document
         """
+        return self._syntax.isHereDoc(self._lineData(block), column)
+
+    def _lineData(self, block):
+        """lineData of the block for isCode() and other methods. None, if block is not parsed yet.
+        Text type map of a fast-forwarded block is built on first request
+        """
         dataObject = block.userData()
-        data = dataObject.data if dataObject is not None else None
-        return self._syntax.isHereDoc(data, column)
+        if dataObject is None:
+            return None
+
+        if dataObject.textTypeMap is None:
+            lineData, highlightedSegments = self._syntax.highlightBlock(block.text(),
+                                                                       self._contextStack(block.previous()))
+            dataObject.textTypeMap = lineData[1]
+
+        return dataObject.data
 
     @staticmethod
-    def _lineData(block):
+    def _contextStack(block):
+        """Context stack at the end of the block. None for the default stack, or if block is not parsed yet
+        """
         dataObject = block.userData()
         if dataObject is not None:
-            return dataObject.data
+            return dataObject.contextStack
         else:
             return None
 
+    def _setBlockData(self, block, lineData):
+        """Save parsing results to the block. Formats of the block layout are not changed.
+        Returns True, if context stack at the end of the block changed, and the next block must be re-parsed
+        """
+        contextStack, textTypeMap = lineData
+        dataObject = block.userData()
+        if dataObject is None:
+            block.setUserData(_TextBlockUserData(contextStack, textTypeMap))
+            return True
+        else:
+            changed = dataObject.contextStack is not contextStack
+            block.setUserData(_TextBlockUserData(contextStack, textTypeMap, dataObject.formatSignature))
+            return changed
+
     def _wasChangedJustBefore(self):
         """Check if ANY Qutepart instance was changed just before"""
         return time.time() <= _gLastChangeTime + 1
@@ -183,20 +398,56 @@ class SyntaxHighlighter(QObject):
     @pyqtSlot(int, int, int)
     def _onContentsChange(self, from_, charsRemoved, charsAdded, zeroTimeout=False):
         global _gLastChangeTime
+        self._revision += 1
         firstBlock = self._document.findBlock(from_)
         untilBlock = self._document.findBlock(from_ + charsAdded)
 
-        if self._globalTimer.isCallbackScheduled(self._onContinueHighlighting):  # have not finished task.
-            """ Intersect ranges. Might produce a lot of extra highlighting work
-            More complicated algorithm might be invented later
-            """
-            if self._pendingBlockNumber < firstBlock.blockNumber():
-                firstBlock = self._document.findBlockByNumber(self._pendingBlockNumber)
-            if self._pendingAtLeastUntilBlockNumber > untilBlock.blockNumber():
-                untilBlockNumber = min(self._pendingAtLeastUntilBlockNumber,
-                                       self._document.blockCount() - 1)
-                untilBlock = self._document.findBlockByNumber(untilBlockNumber)
+        blockCountDelta = self._document.blockCount() - self._blockCount
+        self._blockCount = self._document.blockCount()
+
+        if firstBlock == self._document.firstBlock() and \
+           (untilBlock == self._document.lastBlock() or not untilBlock.isValid()) and \
+           self._parallelHighlightingEnabled():  # whole text is new
             self._globalTimer.unScheduleCallback(self._onContinueHighlighting)
+            self._stopParallelHighlighting()
+            self._pendingLongLine = None
+            self._dirtyBlockRanges = []
+            self._unformattedBlockRanges = []
+            _gLastChangeTime = time.time()
+            self._startParallelHighlighting()
+            return
+
+        if self._pendingLongLine is not None:  # drop parsing results, if the line has been modified
+            longLineBlock = self._document.findBlockByNumber(self._pendingLongLine[0])
+            if (not longLineBlock.isValid()) or \
+               from_ < longLineBlock.position() + longLineBlock.length():
+                self._pendingLongLine = None
+
+        if not untilBlock.isValid():
+            untilBlock = self._document.lastBlock()
+
+        # formats of the changed blocks are applied again, even if they are the same
+        block = firstBlock
+        while block.isValid():
+            dataObject = block.userData()
+            if dataObject is not None:
+                dataObject.formatSignature = None
+            if block == untilBlock:
+                break
+            block = block.next()
+
+        if self._unformattedBlockRanges:
+            untilBlock = self._splitUnformattedBlockRanges(firstBlock, untilBlock, blockCountDelta)
+
+        if self._parallelResults is not None:  # continue parallel highlighting serially
+            if self._parallelBlockNumber < firstBlock.blockNumber():
+                firstBlock = self._document.findBlockByNumber(self._parallelBlockNumber)
+            untilBlock = self._document.lastBlock()
+            self._stopParallelHighlighting()
+
+        if self._dirtyBlockRanges:  # have not finished tasks. Move them according to the change
+            self._shiftDirtyBlockRanges(firstBlock.blockNumber(), untilBlock.blockNumber(), blockCountDelta)
+        self._addDirtyBlockRange(firstBlock.blockNumber(), untilBlock.blockNumber())
 
         if zeroTimeout:
             timeout = 0  # no parsing, only schedule
@@ -209,87 +460,488 @@ class SyntaxHighlighter(QObject):
 
         _gLastChangeTime = time.time()
 
-        self._highlighBlocks(firstBlock, untilBlock, timeout)
+        self._highlightDirtyBlocks(timeout)
 
     def _onContinueHighlighting(self):
-        self._highlighBlocks(self._document.findBlockByNumber(self._pendingBlockNumber),
-                             self._document.findBlockByNumber(self._pendingAtLeastUntilBlockNumber),
-                             self._MAX_PARSING_TIME_SMALL_CHANGE_SEC)
+        self._highlightDirtyBlocks(self._continueTimeout())
 
-    def _highlighBlocks(self, fromBlock, atLeastUntilBlock, timeout):
-        endTime = time.time() + timeout
+    def _continueTimeout(self):
+        """Timeout for highlighting, which has been scheduled. Limited by the global time budget
+        """
+        return min(self._MAX_PARSING_TIME_SMALL_CHANGE_SEC, self._globalTimer.remainingTime())
 
-        block = fromBlock
-        lineData = self._lineData(block.previous())
+    def _priority(self):
+        """Priority of scheduled highlighting. The focused editor first, then visible ones
+        """
+        if self._textEdit.hasFocus():
+            return GlobalTimer.PRIORITY_FOCUSED
+        elif self._textEdit.isVisible():
+            return GlobalTimer.PRIORITY_VISIBLE
+        else:
+            return GlobalTimer.PRIORITY_BACKGROUND
+
+    def _addDirtyBlockRange(self, fromBlockNumber, atLeastUntilBlockNumber):
+        """Add blocks to the highlighting queue. Overlapping and adjacent ranges are merged
+        """
+        ranges = []
+        for rangeFrom, rangeUntil in self._dirtyBlockRanges:
+            if rangeUntil + 1 < fromBlockNumber or rangeFrom > atLeastUntilBlockNumber + 1:
+                ranges.append((rangeFrom, rangeUntil))
+            else:
+                fromBlockNumber = min(fromBlockNumber, rangeFrom)
+                atLeastUntilBlockNumber = max(atLeastUntilBlockNumber, rangeUntil)
+        ranges.append((fromBlockNumber, atLeastUntilBlockNumber))
+        ranges.sort()
+        self._dirtyBlockRanges = ranges
+
+    def _shiftDirtyBlockRanges(self, firstBlockNumber, untilBlockNumber, blockCountDelta):
+        """Text has been changed in blocks [firstBlockNumber, untilBlockNumber].
+        Ranges before the change stay as is, ranges after it are moved by blockCountDelta.
+        Ranges, which intersect the change, are extended to the changed blocks
+        """
+        lastBlockNumber = self._document.blockCount() - 1
+        ranges = []
+        for fromNumber, untilNumber in self._dirtyBlockRanges:
+            if untilNumber < firstBlockNumber:
+                ranges.append((fromNumber, untilNumber))
+            elif fromNumber > untilBlockNumber - blockCountDelta:
+                ranges.append((fromNumber + blockCountDelta, untilNumber + blockCountDelta))
+            else:
+                ranges.append((min(fromNumber, firstBlockNumber),
+                               min(max(untilNumber + blockCountDelta, untilBlockNumber), lastBlockNumber)))
+        self._dirtyBlockRanges = ranges
 
-        while block.isValid() and block != atLeastUntilBlock:
-            if time.time() >= endTime:  # time is over, schedule parsing later and release event loop
-                self._pendingBlockNumber = block.blockNumber()
-                self._pendingAtLeastUntilBlockNumber = atLeastUntilBlock.blockNumber()
-                self._globalTimer.scheduleCallback(self._onContinueHighlighting)
+    def _removeDirtyBlockRange(self, fromBlockNumber, untilBlockNumber):
+        """Remove highlighted blocks [fromBlockNumber, untilBlockNumber] from the highlighting queue.
+        Parts of queued ranges before and after the blocks stay in the queue
+        """
+        ranges = []
+        for rangeFrom, rangeUntil in self._dirtyBlockRanges:
+            if rangeUntil < fromBlockNumber or rangeFrom > untilBlockNumber:
+                ranges.append((rangeFrom, rangeUntil))
+            else:
+                if rangeFrom < fromBlockNumber:
+                    ranges.append((rangeFrom, fromBlockNumber - 1))
+                if rangeUntil > untilBlockNumber:
+                    ranges.append((untilBlockNumber + 1, rangeUntil))
+        self._dirtyBlockRanges = ranges
+
+    def _highlightDirtyBlocks(self, timeout):
+        """Highlight queued ranges in the document order while time is not over
+        """
+        if self._threadHighlighting:
+            self._startThreadHighlighting()
+            return
+
+        endTime = time.time() + timeout
+
+        while self._dirtyBlockRanges:
+            fromBlockNumber, atLeastUntilBlockNumber = self._dirtyBlockRanges.pop(0)
+            finished = self._highlighBlocks(self._document.findBlockByNumber(fromBlockNumber),
+                                            self._document.findBlockByNumber(atLeastUntilBlockNumber),
+                                            endTime)
+            self._flushDirtyContents()
+            if not finished:
+                self._globalTimer.scheduleCallback(self._onContinueHighlighting, self._priority)
                 return
 
-            contextStack = lineData[0] if lineData is not None else None
-            if block.length() < 4096:
-                lineData, highlightedSegments = self._syntax.highlightBlock(block.text(), contextStack)
+        # highlight blocks, skipped by _fastForward(), later. Visible blocks shall be drawn first
+        if self._unformattedBlockRanges:
+            fromBlockNumber, untilBlockNumber = self._unformattedBlockRanges.pop(0)
+            self._addDirtyBlockRange(fromBlockNumber, min(untilBlockNumber, self._document.blockCount() - 1))
+            self._globalTimer.scheduleCallback(self._onContinueHighlighting, self._priority)
+            return
+
+        # sucessfully finished
+        self._globalTimer.unScheduleCallback(self._onContinueHighlighting)
+
+        """Emit sizeChanged when highlighting finished, because document size might change.
+        See andreikop/enki issue #191
+        """
+        documentLayout = self._textEdit.document().documentLayout()
+        documentLayout.documentSizeChanged.emit(documentLayout.documentSize())
+
+    def _highlightBlock(self, block, contextStack, endTime):
+        """Parse block. Long blocks are parsed by parts, and time is checked after every part.
+        Returns (lineData, highlightedSegments) or None, if time is over before the block is parsed.
+        In the last case parsing state is saved, and the next call continues parsing the block
+        """
+        text = block.text()
+        if len(text) <= self._LONG_LINE_PART_LENGTH:
+            return self._syntax.highlightBlock(text, contextStack)
+
+        if self._pendingLongLine is not None and \
+           self._pendingLongLine[0] == block.blockNumber():
+            blockNumber, columnIndex, contextStack, textTypeMap, highlightedSegments = self._pendingLongLine
+            self._pendingLongLine = None
+        else:
+            columnIndex, textTypeMap, highlightedSegments = 0, None, []
+
+        while True:
+            lineData, segments, columnIndex = self._syntax.highlightBlockPart(text,
+                                                                              contextStack,
+                                                                              columnIndex,
+                                                                              self._LONG_LINE_PART_LENGTH)
+            contextStack = lineData[0]
+            if textTypeMap is None:
+                textTypeMap = lineData[1]
             else:
-                """Parser freezes for a long time, if line is too long
-                invalid parsing results are still better, than freeze
-                """
-                lineData, highlightedSegments = None, []
-            if lineData is not None:
-                block.setUserData(_TextBlockUserData(lineData))
+                textTypeMap += lineData[1]
+            highlightedSegments += segments
+
+            if columnIndex >= len(text):
+                return (contextStack, textTypeMap), highlightedSegments
+
+            if time.time() >= endTime:
+                self._pendingLongLine = (block.blockNumber(), columnIndex, contextStack,
+                                         textTypeMap, highlightedSegments)
+                return None
+
+    def _splitUnformattedBlockRanges(self, firstBlock, untilBlock, blockCountDelta):
+        """Text has been changed in blocks [firstBlock, untilBlock].
+        Unformatted blocks before the change stay as is, ranges after it are moved by blockCountDelta.
+        Blocks of ranges, which intersect the change, will be highlighted together with
+        the changed blocks. Returns new untilBlock
+        """
+        firstBlockNumber = firstBlock.blockNumber()
+        untilBlockNumber = untilBlock.blockNumber()
+        changedUntilBlockNumber = untilBlockNumber - blockCountDelta  # before the change
+
+        ranges = []
+        for fromNumber, untilNumber in self._unformattedBlockRanges:
+            if untilNumber <= firstBlockNumber:
+                ranges.append((fromNumber, untilNumber))
+            elif fromNumber > changedUntilBlockNumber:
+                ranges.append((fromNumber + blockCountDelta, untilNumber + blockCountDelta))
+            else:
+                if fromNumber < firstBlockNumber:
+                    ranges.append((fromNumber, firstBlockNumber))
+                untilBlockNumber = max(untilBlockNumber, untilNumber + blockCountDelta)
+        self._unformattedBlockRanges = ranges
+
+        if untilBlockNumber != untilBlock.blockNumber():
+            untilBlock = self._document.findBlockByNumber(min(untilBlockNumber, self._document.blockCount() - 1))
+        return untilBlock
+
+    def _fastForward(self, block, untilBlock, contextStack, endTime):
+        """Parse blocks until untilBlock with quick parseBlock() and don't apply formats.
+        Used to highlight visible blocks first, if they are far below.
+        Parsed blocks are highlighted later, when other work is done.
+        Stops on a long line, it shall be parsed by parts.
+        Returns (block, contextStack) of the block, where parsing stopped
+        """
+        fromBlockNumber = block.blockNumber()
+        while block != untilBlock and time.time() < endTime:
+            text = block.text()
+            if len(text) > self._LONG_LINE_PART_LENGTH:
+                break
+
+            contextStack, textTypeMap = self._syntax.parseBlock(text, contextStack)
+            self._setBlockData(block, (contextStack, None))  # text types are not known yet
+            block = block.next()
+
+        untilBlockNumber = block.blockNumber()
+        if untilBlockNumber > fromBlockNumber:
+            if self._unformattedBlockRanges and self._unformattedBlockRanges[-1][1] == fromBlockNumber:
+                fromBlockNumber = self._unformattedBlockRanges.pop()[0]
+            self._unformattedBlockRanges.append((fromBlockNumber, untilBlockNumber))
+
+        return block, contextStack
+
+    def _highlighBlocks(self, fromBlock, atLeastUntilBlock, endTime):
+        """Highlight blocks [fromBlock, atLeastUntilBlock], and next blocks while context stack changes.
+        Queued ranges, which are reached, are highlighted too.
+        Returns False, if time is over. Not highlighted blocks are queued again in this case
+        """
+        block = fromBlock
+        contextStack = self._contextStack(block.previous())
+
+        # visible blocks first. Fast-forward to them, if they are far below and must be highlighted
+        firstVisibleBlock = self._textEdit.firstVisibleBlock()
+        if atLeastUntilBlock.isValid() and \
+           firstVisibleBlock.blockNumber() >= atLeastUntilBlock.blockNumber():
+            firstVisibleBlock = None
+
+        while True:
+            while block.isValid() and block != atLeastUntilBlock:
+                if time.time() >= endTime:  # time is over, schedule parsing later and release event loop
+                    self._addDirtyBlockRange(block.blockNumber(), atLeastUntilBlock.blockNumber())
+                    return False
+
+                if firstVisibleBlock is not None and \
+                   firstVisibleBlock.blockNumber() - block.blockNumber() >= self._FAST_FORWARD_MIN_BLOCK_COUNT:
+                    block, contextStack = self._fastForward(block, firstVisibleBlock, contextStack, endTime)
+                    if time.time() >= endTime:
+                        continue  # schedule parsing later
+                    # else visible or long block is highlighted below
+
+                result = self._highlightBlock(block, contextStack, endTime)
+                if result is None:  # time is over in the middle of a long line
+                    self._addDirtyBlockRange(block.blockNumber(), atLeastUntilBlock.blockNumber())
+                    return False
+
+                lineData, highlightedSegments = result
+                self._setBlockData(block, lineData)
+                contextStack = lineData[0]
+
+                self._applyHighlightedSegments(block, highlightedSegments)
+                block = block.next()
+
+            # reached atLeastUntilBlock, now parse next only while context stack at the end of the previous block changed.
+            # Highlighting of a block depends only on its text and the previous context stack.
+            # atLeastUntilBlock itself might be changed, it is always highlighted
+            # If time is over, parsing continues from the block, and atLeastUntilBlock is not used anymore
+            contextStackChanged = True
+            while block.isValid() and contextStackChanged:
+                if self._dirtyBlockRanges and self._dirtyBlockRanges[0][0] == block.blockNumber():
+                    break  # reached the next queued range
+
+                if time.time() >= endTime:  # time is over, schedule parsing later and release event loop
+                    self._addDirtyBlockRange(block.blockNumber(), block.blockNumber())
+                    return False
+                result = self._highlightBlock(block, contextStack, endTime)
+                if result is None:  # time is over in the middle of a long line
+                    self._addDirtyBlockRange(block.blockNumber(), block.blockNumber())
+                    return False
+
+                lineData, highlightedSegments = result
+                contextStackChanged = self._setBlockData(block, lineData)
+                contextStack = lineData[0]
+
+                self._applyHighlightedSegments(block, highlightedSegments)
+                block = block.next()
+
+            if block.isValid() and contextStackChanged:  # highlight the reached queued range now
+                atLeastUntilBlock = self._document.findBlockByNumber(self._dirtyBlockRanges.pop(0)[1])
             else:
-                block.setUserData(None)
+                return True
+
+    def _startThreadHighlighting(self):
+        """Parse the first queued range on the worker thread, if it is not busy with this highlighter.
+        Texts and context stacks of a chunk of blocks are copied, the thread parses them.
+        Results are applied on the main thread, if the document has not been changed meanwhile.
+        Otherwise they are dropped and the chunk is parsed again
+        """
+        if self._threadJob is not None or not self._dirtyBlockRanges:
+            return
+
+        fromBlockNumber, atLeastUntilBlockNumber = self._dirtyBlockRanges[0]
+        untilBlockNumber = fromBlockNumber + self._THREAD_CHUNK_LINE_COUNT
+        if len(self._dirtyBlockRanges) > 1:  # the next range will be parsed separately
+            untilBlockNumber = min(untilBlockNumber, self._dirtyBlockRanges[1][0])
+
+        block = self._document.findBlockByNumber(fromBlockNumber)
+        contextStack = self._contextStack(block.previous())
+        texts = []
+        oldContextStacks = []
+        while block.isValid() and block.blockNumber() < untilBlockNumber:
+            texts.append(block.text())
+            dataObject = block.userData()
+            oldContextStacks.append(dataObject.contextStack if dataObject is not None else _NOT_PARSED)
+            block = block.next()
+
+        future = _threadPool().submit(_highlightInThread, self._syntax, texts, contextStack,
+                                      oldContextStacks, atLeastUntilBlockNumber - fromBlockNumber + 1)
+        job = (self._revision, fromBlockNumber, atLeastUntilBlockNumber, future)
+        self._threadJob = job
+        future.add_done_callback(lambda future: self._emitThreadHighlightingFinished(job))
+
+    def _emitThreadHighlightingFinished(self, job):
+        """Called on the worker thread. The signal is delivered to the main thread
+        """
+        try:
+            self._threadHighlightingFinished.emit(job)
+        except RuntimeError:  # the highlighter has been deleted
+            pass
+
+    def _onThreadHighlightingFinished(self, job):
+        """Apply results of the worker thread and parse the next chunk
+        """
+        if job is not self._threadJob:  # highlighting has been terminated or restarted
+            return
+        self._threadJob = None
+
+        revision, fromBlockNumber, atLeastUntilBlockNumber, future = job
+        if revision != self._revision:  # the document has been changed, results are not valid
+            self._startThreadHighlighting()
+            return
 
+        try:
+            results, converged = future.result()
+        except Exception as ex:
+            # queued ranges are highlighted on the main thread
+            _logger.warning('Highlighting on the worker thread failed: %s', ex)
+            self._threadHighlighting = False
+            self._globalTimer.scheduleCallback(self._onContinueHighlighting, self._priority)
+            return
+
+        block = self._document.findBlockByNumber(fromBlockNumber)
+        for lineData, highlightedSegments in results:
+            self._setBlockData(block, lineData)
             self._applyHighlightedSegments(block, highlightedSegments)
             block = block.next()
+        self._flushDirtyContents()
+
+        # remove parsed blocks from the queue. Ranges might have been merged while the thread was working
+        lastBlockNumber = fromBlockNumber + len(results) - 1
+        self._removeDirtyBlockRange(fromBlockNumber, lastBlockNumber)
+        if atLeastUntilBlockNumber > lastBlockNumber:
+            self._addDirtyBlockRange(lastBlockNumber + 1, atLeastUntilBlockNumber)
+        elif block.isValid() and not converged:
+            self._addDirtyBlockRange(lastBlockNumber + 1, lastBlockNumber + 1)
+
+        if self._dirtyBlockRanges:
+            self._startThreadHighlighting()
+        else:
+            documentLayout = self._textEdit.document().documentLayout()
+            documentLayout.documentSizeChanged.emit(documentLayout.documentSize())
+
+    def _parallelHighlightingEnabled(self):
+        return _gProcessCount > 0 and \
+               self._syntax.xmlFileName is not None and \
+               self._document.blockCount() >= self._PARALLEL_MIN_LINE_COUNT
+
+    def _startParallelHighlighting(self):
+        """Speculative parallel highlighting of a huge file.
+
+        Text is split to chunks. Worker processes highlight every chunk, starting from the default context stack.
+        Results are applied to the blocks in order. Results of a block are valid, if the real context stack
+        at the end of the previous block is the default one, or it has been default at the end of some previous
+        block in the chunk both in the real and in the speculative parsing. Other blocks are parsed
+        on the main thread. Blocks, which end not in the default context stack, are parsed on the main thread too,
+        because context stacks can't be passed between processes
+        """
+        lines = []
+        block = self._document.firstBlock()
+        while block.isValid():
+            lines.append(block.text())
+            block = block.next()
+
+        pool = _processPool()
+        self._parallelResults = \
+            [pool.apply_async(qutepart.syntax.batch.highlightChunk,
+                              (self._syntax.xmlFileName, lines[index:index + self._PARALLEL_CHUNK_LINE_COUNT])) \
+                for index in range(0, len(lines), self._PARALLEL_CHUNK_LINE_COUNT)]
+        self._parallelBlockNumber = 0
+        self._parallelContextStack = None
+        self._parallelSynchronized = True
+        self._parallelTimer.start()
+
+    def _stopParallelHighlighting(self):
+        """Drop results of worker processes
+        """
+        self._parallelResults = None
+        self._parallelTimer.stop()
+        self._globalTimer.unScheduleCallback(self._onContinueParallelHighlighting)
 
-        # reached atLeastUntilBlock, now parse next only while data changed
-        prevLineData = self._lineData(block)
+    def _onContinueParallelHighlighting(self):
+        """Apply results of worker processes while time is not over
+        """
+        try:
+            self._applyParallelResults(time.time() + self._continueTimeout())
+        finally:
+            self._flushDirtyContents()
+
+    def _applyParallelResults(self, endTime):
+        """Apply results of worker processes to blocks. See _onContinueParallelHighlighting()
+        """
+
+        block = self._document.findBlockByNumber(self._parallelBlockNumber)
+        contextStack = self._parallelContextStack
         while block.isValid():
-            if time.time() >= endTime:  # time is over, schedule parsing later and release event loop
-                self._pendingBlockNumber = block.blockNumber()
-                self._pendingAtLeastUntilBlockNumber = atLeastUntilBlock.blockNumber()
-                self._globalTimer.scheduleCallback(self._onContinueHighlighting)
+            if time.time() >= endTime:  # time is over, continue later and release event loop
+                self._globalTimer.scheduleCallback(self._onContinueParallelHighlighting, self._priority)
                 return
-            contextStack = lineData[0] if lineData is not None else None
-            lineData, highlightedSegments = self._syntax.highlightBlock(block.text(), contextStack)
-            if lineData is not None:
-                block.setUserData(_TextBlockUserData(lineData))
-            else:
-                block.setUserData(None)
 
+            chunkIndex, lineIndex = divmod(block.blockNumber(), self._PARALLEL_CHUNK_LINE_COUNT)
+            asyncResult = self._parallelResults[chunkIndex]
+            if not asyncResult.ready():  # wait for worker processes
+                self._parallelTimer.start()
+                return
+
+            try:
+                highlightedSegments, textTypeMap, endsInDefaultContext = asyncResult.get()[lineIndex]
+            except Exception as ex:
+                _logger.warning('Parallel highlighting failed: %s', ex)
+                self._stopParallelHighlighting()
+                self._addDirtyBlockRange(block.blockNumber(), self._document.blockCount() - 1)
+                self._highlightDirtyBlocks(self._continueTimeout())
+                return
+
+            if lineIndex == 0:  # worker has started the chunk with the default context stack
+                self._parallelSynchronized = contextStack is None
+
+            if self._parallelSynchronized and contextStack is None and endsInDefaultContext:
+                lineData = (None, textTypeMap)
+                highlightedSegments = [(length, self._syntax.formatForAttribute(attribute)) \
+                                            for length, attribute in highlightedSegments]
+            else:
+                result = self._highlightBlock(block, contextStack, endTime)
+                if result is None:  # time is over in the middle of a long line
+                    self._globalTimer.scheduleCallback(self._onContinueParallelHighlighting, self._priority)
+                    return
+                lineData, highlightedSegments = result
+                if lineData[0] is None and endsInDefaultContext:
+                    self._parallelSynchronized = True
+
+            self._setBlockData(block, lineData)
             self._applyHighlightedSegments(block, highlightedSegments)
-            if prevLineData == lineData:
-                break
 
+            contextStack = lineData[0]
+            self._parallelContextStack = contextStack
+            self._parallelBlockNumber += 1
             block = block.next()
-            prevLineData = self._lineData(block)
 
-        # sucessfully finished, reset pending tasks
-        self._pendingBlockNumber = None
-        self._pendingAtLeastUntilBlockNumber = None
-
-        """Emit sizeChanged when highlighting finished, because document size might change.
-        See andreikop/enki issue #191
-        """
+        # sucessfully finished
+        self._stopParallelHighlighting()
         documentLayout = self._textEdit.document().documentLayout()
         documentLayout.documentSizeChanged.emit(documentLayout.documentSize())
 
     def _applyHighlightedSegments(self, block, highlightedSegments):
-        ranges = []
-        currentPos = 0
-
-        for length, format in highlightedSegments:
-            if format is not None:  # might be in incorrect syntax file
-                range = QTextLayout.FormatRange()
-                range.format = format
-                range.start = currentPos
-                range.length = length
-                ranges.append(range)
-            currentPos += length
-
-        if not _formatRangeListsEqual(block.layout().additionalFormats(), ranges):
-            block.layout().setAdditionalFormats(ranges)
-            self._document.markContentsDirty(block.position(), block.length())
+        """Apply formats to the block layout. Block user data must be set.
+        Formats are described by a signature, which is saved to the user data. Layout is not changed, if
+        the signature is the same. Format ranges are shared by blocks with the same signature
+        """
+        signature = tuple([(length, id(format)) for length, format in highlightedSegments])
+        dataObject = block.userData()
+        if dataObject.formatSignature == signature:
+            return
+
+        ranges = self._formatRangesCache.get(signature)
+        if ranges is None:
+            ranges = []
+            currentPos = 0
+            for length, format in highlightedSegments:
+                if format is not None:  # might be in incorrect syntax file
+                    range = QTextLayout.FormatRange()
+                    range.format = format
+                    range.start = currentPos
+                    range.length = length
+                    ranges.append(range)
+                currentPos += length
+
+            if len(self._formatRangesCache) >= self._FORMAT_RANGES_CACHE_SIZE:
+                self._formatRangesCache.clear()
+            self._formatRangesCache[signature] = ranges
+
+        dataObject.formatSignature = signature
+        block.layout().setAdditionalFormats(ranges)
+        self._markBlockDirty(block)
+
+    def _markBlockDirty(self, block):
+        """Remember, that formats of the block have been changed. Adjacent blocks are merged to one range.
+        Every markContentsDirty() call invalidates the layout, therefore Qt is notified once per range
+        by _flushDirtyContents(), when a portion of work is done
+        """
+        position = block.position()
+        if self._dirtyContents and sum(self._dirtyContents[-1]) == position:
+            self._dirtyContents[-1][1] += block.length()
+        else:
+            self._dirtyContents.append([position, block.length()])
+
+    def _flushDirtyContents(self):
+        """Mark remembered ranges dirty. Called when a portion of work is done, before the event loop gets control
+        """
+        for position, length in self._dirtyContents:
+            self._document.markContentsDirty(position, length)
+        self._dirtyContents = []
@@ -3,10 +3,13 @@
 import sys
 import os
 import platform
+import shutil
+import tempfile
 
 from setuptools import setup, Extension
 
 import distutils.ccompiler
+import distutils.errors
 import distutils.sysconfig
 
 sys.path.insert(0, 'qutepart')
@@ -48,6 +51,35 @@ def runningOnPip():
   return 'pip' in __file__
 
 
+def _compilesAndLinks(code, libraries):
+    """Check if C code can be compiled and linked with the libraries.
+    False, if it fails, or if the compiler is not available
+    """
+    tmpDir = tempfile.mkdtemp()
+    try:
+        compiler = distutils.ccompiler.new_compiler()
+        distutils.sysconfig.customize_compiler(compiler)
+        sourcePath = os.path.join(tmpDir, 'check.c')
+        with open(sourcePath, 'w') as sourceFile:
+            sourceFile.write(code)
+        objects = compiler.compile([sourcePath], output_dir=tmpDir, include_dirs=include_dirs)
+        compiler.link_executable(objects, os.path.join(tmpDir, 'check'),
+                                 libraries=libraries, library_dirs=library_dirs)
+    except (distutils.errors.DistutilsError, distutils.errors.CCompilerError):
+        return False
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+    return True
+
+
+def _pcre2Available():
+    return _compilesAndLinks('#define PCRE2_CODE_UNIT_WIDTH 8\n'
+                             '#include <pcre2.h>\n'
+                             'int main() { pcre2_match_data_free(pcre2_match_data_create(1, NULL)); return 0; }\n',
+                             ['pcre2-8'])
+
+
 def _checkBuildDependencies():
     compiler = distutils.ccompiler.new_compiler()
     """check if function without parameters from stdlib can be called
@@ -69,13 +101,14 @@ def _checkBuildDependencies():
         print("--lib-dir= and --include-dir= may be used multiple times")
         return False
 
-    if not compiler.has_function('pcre_version',
+    if not usePcre2 and \
+       not compiler.has_function('pcre_version',
                                  includes=['pcre.h'],
                                  libraries=['pcre'],
                                  include_dirs=include_dirs,
                                  library_dirs=library_dirs):
-        print("Failed to find pcre library.")
-        print("Try to install libpcre{version}-dev package, or go to http://pcre.org")
+        print("Failed to find pcre2 or pcre library.")
+        print("Try to install libpcre2-dev package, or go to http://pcre.org")
         print("If not standard directories are used, pass parameters:")
         print("\tpython setup.py install --lib-dir=c://github/pcre-8.37/build/Release --include-dir=c://github/pcre-8.37/build")
         print("\tpython setup.py install --lib-dir=/my/local/lib --include-dir=/my/local/include")
@@ -93,7 +126,7 @@ if onWindows() and (not runningOnPip()) and 'install' in sys.argv:
 packages = ['qutepart', 'qutepart/syntax', 'qutepart/indenter']
 
 package_data = {'qutepart': ['icons/*.png'],
-                'qutepart/syntax': ['data/xml/*.xml', 'data/syntax_db.json']
+                'qutepart/syntax': ['data/xml/*.xml', 'data/syntax_db.bin']
                 }
 
 
@@ -105,17 +138,15 @@ library_dirs = parse_arg_list('--lib-dir=')
 if not library_dirs:
     library_dirs = ['/usr/lib', '/usr/local/lib', '/opt/local/lib']
 
-macros = []
-if platform.system() == 'Windows':
-    macros.append(('HAVE_PCRE_CONFIG_H', None))
-
-extension = Extension('qutepart.syntax.cParser',
-                      sources=['qutepart/syntax/cParser.c'],
-                      libraries=['pcre'],
-                      include_dirs=include_dirs,
-                      library_dirs=library_dirs,
-                      define_macros=macros)
+skipExtension = False
+if '--skip-extension' in sys.argv:
+    skipExtension = True
+    sys.argv.remove('--skip-extension')
 
+legacyPcre = False
+if '--legacy-pcre' in sys.argv:
+    legacyPcre = True
+    sys.argv.remove('--legacy-pcre')
 
 """ A hack to set compiler version for distutils on Windows.
 See https://github.com/andreikop/qutepart/issues/52
@@ -129,11 +160,15 @@ else:
         os.remove(cfgPath)
 
 
-skipExtension = False
-if '--skip-extension' in sys.argv:
-    skipExtension = True
-    sys.argv.remove('--skip-extension')
-
+# PCRE2 is used, if found. Legacy PCRE might be forced with --legacy-pcre
+# The check runs the compiler, therefore it is done only when the extension is going to be built
+usePcre2 = False
+if (('build' in sys.argv or
+    'build_ext' in sys.argv or
+    'install' in sys.argv) and
+    (not skipExtension) and
+    (not legacyPcre)):
+    usePcre2 = _pcre2Available()
 
 # Check build dependencies
 if (('build' in sys.argv or
@@ -144,6 +179,22 @@ if (('build' in sys.argv or
             if not _checkBuildDependencies():
                 sys.exit(-1)
 
+macros = []
+if platform.system() == 'Windows':
+    macros.append(('HAVE_PCRE_CONFIG_H', None))
+if usePcre2:
+    macros.append(('QUTEPART_PCRE2', None))
+    libraries = ['pcre2-8']
+else:
+    libraries = ['pcre']
+
+extension = Extension('qutepart.syntax.cParser',
+                      sources=['qutepart/syntax/cParser.c'],
+                      libraries=libraries,
+                      include_dirs=include_dirs,
+                      library_dirs=library_dirs,
+                      define_macros=macros)
+
 ext_modules = []
 if not skipExtension:
     ext_modules.append(extension)
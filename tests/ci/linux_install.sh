@@ -5,6 +5,6 @@ set -v
 
 sudo add-apt-repository -y ppa:ubuntu-toolchain-r/test
 sudo apt-get update
-sudo apt-get install -y libpcre3-dev libegl1-mesa libstdc++6
+sudo apt-get install -y libpcre2-dev libegl1-mesa libstdc++6
 
 export DISPLAY=:99.0
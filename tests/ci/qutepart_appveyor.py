@@ -70,6 +70,8 @@ def install(should_identify=True):
 def test():
     chdir('tests')
     xqt('python run_all.py')
+    # RegExpr rules folded into alternations must produce the same results
+    xqt('python run_all.py', env=dict(os.environ, QPART_COMBINE_REGEXPR='Y'))
 #
 # main
 # ====
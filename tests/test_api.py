@@ -2,6 +2,8 @@
 
 import os
 import sys
+import logging
+import time
 import unittest
 
 import base
@@ -12,6 +14,7 @@ from PyQt5.QtTest import QTest
 from qutepart import Qutepart
 
 import qutepart.completer
+import qutepart.syntaxhlighter
 qutepart.completer._GlobalUpdateWordSetTimer._IDLE_TIMEOUT_MS = 0
 
 class _BaseTest(unittest.TestCase):
@@ -164,6 +167,485 @@ class IsCodeOrComment(_BaseTest):
         self.assertTrue(self.qpart.isHereDoc(1, 2))
         self.assertTrue(self.qpart.isComment(1, 2))
 
+    def test_long_line(self):
+        # long lines are parsed by parts
+        self.qpart.detectSyntax(language = 'C')
+        self.qpart._highlighter._LONG_LINE_PART_LENGTH = 16
+        self.qpart.text = 'a; ' * 100 + '/* comment\nstill comment'
+
+        self._wait_highlighting_finished()
+
+        self.assertTrue(self.qpart.isCode(0, 300 - 1))
+        self.assertTrue(self.qpart.isComment(0, 300 + 3))
+        self.assertTrue(self.qpart.isComment(1, 2))
+
+
+class _HighlightingTest(_BaseTest):
+    """Base class for tests, which compare highlighting results
+    """
+    def _highlighting(self, qpart):
+        t = time.time()
+        while qpart.isHighlightingInProgress() and time.time() - t < 30:
+            self.app.processEvents()
+            time.sleep(0.01)
+        self.assertFalse(qpart.isHighlightingInProgress())
+
+        results = []
+        block = qpart.document().firstBlock()
+        while block.isValid():
+            lineData = block.userData().data
+            formats = [(range_.start, range_.length, range_.format.foreground().color().name())
+                            for range_ in block.layout().additionalFormats()]
+            results.append((''.join(lineData[1]), formats))
+            block = block.next()
+        return results
+
+
+class ParallelHighlighting(_HighlightingTest):
+    """Huge files are highlighted by worker processes. Results must be the same as of serial highlighting
+    """
+    def setUp(self):
+        _BaseTest.setUp(self)
+        self._processCount = qutepart.syntaxhlighter._gProcessCount
+        qutepart.syntaxhlighter._gProcessCount = 2
+        SyntaxHighlighter = qutepart.syntaxhlighter.SyntaxHighlighter
+        self._minLineCount = SyntaxHighlighter._PARALLEL_MIN_LINE_COUNT
+        self._chunkLineCount = SyntaxHighlighter._PARALLEL_CHUNK_LINE_COUNT
+        SyntaxHighlighter._PARALLEL_MIN_LINE_COUNT = 10
+        SyntaxHighlighter._PARALLEL_CHUNK_LINE_COUNT = 4
+
+    def tearDown(self):
+        qutepart.syntaxhlighter._gProcessCount = self._processCount
+        SyntaxHighlighter = qutepart.syntaxhlighter.SyntaxHighlighter
+        SyntaxHighlighter._PARALLEL_MIN_LINE_COUNT = self._minLineCount
+        SyntaxHighlighter._PARALLEL_CHUNK_LINE_COUNT = self._chunkLineCount
+        _BaseTest.tearDown(self)
+
+    def _test(self, text, language):
+        self.qpart.detectSyntax(language=language)
+        self.qpart.text = text
+        self.assertTrue(self.qpart._highlighter._parallelResults is not None)
+        parallel = self._highlighting(self.qpart)
+
+        qutepart.syntaxhlighter._gProcessCount = 0
+        serialQpart = Qutepart()
+        try:
+            serialQpart.detectSyntax(language=language)
+            serialQpart.text = text
+            self.assertTrue(serialQpart._highlighter._parallelResults is None)
+            self.assertEqual(parallel, self._highlighting(serialQpart))
+        finally:
+            serialQpart.terminate()
+
+    def test_c(self):
+        # block comments cross chunk boundaries
+        text = '\n'.join(['int a = 1; // comment',
+                         'char* s = "string";',
+                         '/* block',
+                         '',
+                         'comment */ int b;',
+                         'x',
+                         '/*',
+                         'long',
+                         'block',
+                         'comment',
+                         '*/ int c = 0x1f;',
+                         'int d; /* */'] * 3)
+        self._test(text, 'C')
+
+    def test_python(self):
+        text = '\n'.join(['def f(x):',
+                         '    """doc',
+                         '    string',
+                         '    """',
+                         '    return x + 1  # comment'] * 5)
+        self._test(text, 'Python')
+
+    def test_process_count(self):
+        """Invalid count of processes disables parallel highlighting
+        """
+        value = os.environ.get('QPART_HIGHLIGHTING_PROCESSES')
+        logging.getLogger('qutepart').setLevel(logging.CRITICAL)
+        try:
+            for string, count in (('3', 3), ('', 0), ('auto', 0), ('-2', 0)):
+                os.environ['QPART_HIGHLIGHTING_PROCESSES'] = string
+                self.assertEqual(qutepart.syntaxhlighter._processCountFromEnvironment(), count)
+        finally:
+            logging.getLogger('qutepart').setLevel(logging.ERROR)
+            if value is None:
+                del os.environ['QPART_HIGHLIGHTING_PROCESSES']
+            else:
+                os.environ['QPART_HIGHLIGHTING_PROCESSES'] = value
+
+
+class ThreadHighlighting(_HighlightingTest):
+    """Text is parsed on the worker thread. Results must be the same as of usual highlighting
+    """
+    def setUp(self):
+        _HighlightingTest.setUp(self)
+        SyntaxHighlighter = qutepart.syntaxhlighter.SyntaxHighlighter
+        self._chunkLineCount = SyntaxHighlighter._THREAD_CHUNK_LINE_COUNT
+        SyntaxHighlighter._THREAD_CHUNK_LINE_COUNT = 7
+        qutepart.syntaxhlighter._gThreadHighlighting = True
+
+    def tearDown(self):
+        qutepart.syntaxhlighter._gThreadHighlighting = False
+        qutepart.syntaxhlighter.SyntaxHighlighter._THREAD_CHUNK_LINE_COUNT = self._chunkLineCount
+        _HighlightingTest.tearDown(self)
+
+    def _usualHighlighting(self, text):
+        qutepart.syntaxhlighter._gThreadHighlighting = False
+        usualQpart = Qutepart()
+        try:
+            usualQpart.detectSyntax(language='C')
+            usualQpart.text = text
+            return self._highlighting(usualQpart)
+        finally:
+            usualQpart.terminate()
+            qutepart.syntaxhlighter._gThreadHighlighting = True
+
+    def test_1(self):
+        text = '\n'.join(['int a = 1; // comment',
+                         '/* block',
+                         'comment */ int b;',
+                         'x'] * 20)
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = text
+        self.assertTrue(self.qpart.isHighlightingInProgress())
+        threaded = self._highlighting(self.qpart)
+        self.assertEqual(threaded, self._usualHighlighting(text))
+
+    def test_edit_while_parsing(self):
+        """Results of the changed text are dropped
+        """
+        text = '\n'.join(['int a = 1; // comment',
+                         'x'] * 20)
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = text
+        self.qpart.lines[5] = '/* block'
+        self.qpart.lines[30] = 'comment */ int b;'
+        threaded = self._highlighting(self.qpart)
+        self.assertEqual(threaded, self._usualHighlighting(self.qpart.text))
+        self.assertTrue(self.qpart.isComment(29, 0))
+        self.assertTrue(self.qpart.isCode(31, 0))
+
+    def test_thread_fails(self):
+        """Queued blocks are highlighted on the main thread, if the worker thread fails
+        """
+        def _highlightInThread(*args):
+            raise ValueError('Test error')
+
+        text = '\n'.join(['int a = 1; // comment',
+                         '/* block',
+                         'comment */ int b;',
+                         'x'] * 20)
+        highlightInThread = qutepart.syntaxhlighter._highlightInThread
+        qutepart.syntaxhlighter._highlightInThread = _highlightInThread
+        logging.getLogger('qutepart').setLevel(logging.CRITICAL)
+        try:
+            self.qpart.detectSyntax(language='C')
+            self.qpart.text = text
+            threaded = self._highlighting(self.qpart)
+        finally:
+            qutepart.syntaxhlighter._highlightInThread = highlightInThread
+            logging.getLogger('qutepart').setLevel(logging.ERROR)
+        self.assertEqual(threaded, self._usualHighlighting(text))
+
+    def test_queue_changed_while_parsing(self):
+        """Only the blocks, parsed by the thread, are removed from the queue
+        """
+        text = '\n'.join(['int a%d;' % index for index in range(30)])
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = text
+        self._highlighting(self.qpart)
+
+        highlighter = self.qpart._highlighter
+        syntax = highlighter._syntax
+        highlightedTexts = []
+        highlightBlock = syntax.highlightBlock
+
+        def countingHighlightBlock(text, contextStack):
+            highlightedTexts.append(text)
+            return highlightBlock(text, contextStack)
+
+        syntax.highlightBlock = countingHighlightBlock
+        try:
+            highlighter._dirtyBlockRanges = [(10, 12)]
+            highlighter._startThreadHighlighting()
+            # a range is queued before the parsed one, the document is not changed
+            highlighter._addDirtyBlockRange(2, 3)
+            self._highlighting(self.qpart)
+        finally:
+            del syntax.highlightBlock
+
+        self.assertIn('int a2;', highlightedTexts)
+        self.assertIn('int a3;', highlightedTexts)
+        self.assertEqual(highlightedTexts.count('int a10;'), 1)
+
+
+class ViewportFirstHighlighting(_HighlightingTest):
+    """Blocks above the viewport are parsed without formats, visible blocks are highlighted first.
+    Other blocks are highlighted later. Results must be the same as of usual highlighting
+    """
+    def setUp(self):
+        _HighlightingTest.setUp(self)
+        SyntaxHighlighter = qutepart.syntaxhlighter.SyntaxHighlighter
+        self._minBlockCount = SyntaxHighlighter._FAST_FORWARD_MIN_BLOCK_COUNT
+        SyntaxHighlighter._FAST_FORWARD_MIN_BLOCK_COUNT = 5
+
+    def tearDown(self):
+        qutepart.syntaxhlighter.SyntaxHighlighter._FAST_FORWARD_MIN_BLOCK_COUNT = self._minBlockCount
+        _HighlightingTest.tearDown(self)
+
+    def test_1(self):
+        text = '\n'.join(['int a = 1; // comment',
+                         '/* block',
+                         'comment */ int b;',
+                         'x'] * 20)
+        self.qpart.firstVisibleBlock = lambda: self.qpart.document().findBlockByNumber(42)
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = text
+
+        block = self.qpart.document().findBlockByNumber(41)
+        self.assertIsNotNone(block.userData())
+        self.assertEqual(block.layout().additionalFormats(), [])
+        block = block.next()
+        self.assertEqual(''.join(block.userData().data[1]), 'cccccccccc       ')
+        self.assertNotEqual(block.layout().additionalFormats(), [])
+        self.assertTrue(self.qpart.isHighlightingInProgress())
+
+        viewportFirst = self._highlighting(self.qpart)
+
+        usualQpart = Qutepart()
+        try:
+            usualQpart.detectSyntax(language='C')
+            usualQpart.text = text
+            self.assertEqual(viewportFirst, self._highlighting(usualQpart))
+        finally:
+            usualQpart.terminate()
+
+    def test_text_types_of_fast_forwarded_blocks(self):
+        """Text types of the blocks above the viewport are known before the blocks are highlighted
+        """
+        text = '\n'.join(['int a = 1; // comment',
+                         '/* block',
+                         'comment */ int b;',
+                         'x'] * 20)
+        self.qpart.firstVisibleBlock = lambda: self.qpart.document().findBlockByNumber(42)
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = text
+
+        block = self.qpart.document().findBlockByNumber(40)
+        self.assertEqual(block.layout().additionalFormats(), [])
+
+        self.assertTrue(self.qpart.isCode(40, 0))
+        self.assertTrue(self.qpart.isComment(40, 12))
+        self.assertFalse(self.qpart.isBlockComment(40, 12))
+        self.assertTrue(self.qpart.isComment(41, 0))
+        self.assertFalse(self.qpart.isCode(41, 0))
+        self.assertTrue(self.qpart.isComment(38, 0))
+        self.assertTrue(self.qpart.isCode(38, 12))
+
+        # formats are still applied later
+        self.assertEqual(block.layout().additionalFormats(), [])
+        self.assertTrue(self.qpart.isHighlightingInProgress())
+
+
+class IncrementalHighlighting(_HighlightingTest):
+    """Highlighting stops as soon as the context stack at the end of a line is the same as before the edit
+    """
+    def _countHighlighting(self, qpart, edit, *args):
+        """Do the edit and wait for highlighting. Return texts of highlighted blocks
+        """
+        syntax = qpart._highlighter._syntax
+        highlightedTexts = []
+        highlightBlock = syntax.highlightBlock
+
+        def countingHighlightBlock(text, contextStack):
+            highlightedTexts.append(text)
+            return highlightBlock(text, contextStack)
+
+        syntax.highlightBlock = countingHighlightBlock
+        try:
+            edit(*args)
+            self._highlighting(qpart)
+        finally:
+            del syntax.highlightBlock
+        return highlightedTexts
+
+    def _editLine(self, lineNumber, text):
+        self.qpart.lines[lineNumber] = text
+
+    def _editDelayed(self, edits):
+        """Edits are only queued, highlighting is done later
+        """
+        SyntaxHighlighter = qutepart.syntaxhlighter.SyntaxHighlighter
+        timeout = SyntaxHighlighter._MAX_PARSING_TIME_SMALL_CHANGE_SEC
+        SyntaxHighlighter._MAX_PARSING_TIME_SMALL_CHANGE_SEC = 0
+        try:
+            for lineNumber, text in edits:
+                self.qpart.lines[lineNumber] = text
+        finally:
+            SyntaxHighlighter._MAX_PARSING_TIME_SMALL_CHANGE_SEC = timeout
+
+    def test_distant_edits(self):
+        """Pending edits in distant regions are not merged to one big range
+        """
+        text = '\n'.join(['int a = 1; // comment'] * 5000)
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = text
+        self._highlighting(self.qpart)
+
+        edits = [(4000, 'int b; /* comment'),
+                 (10, 'int c; // comment\nint d;'),
+                 (4002, '*/ int e;'),
+                 (20, 'int f = "string";')]
+        highlightedTexts = self._countHighlighting(self.qpart, self._editDelayed, edits)
+
+        self.assertLess(len(highlightedTexts), 15)
+        self.assertTrue(self.qpart.isCode(11, 0))
+        self.assertTrue(self.qpart.isComment(4001, 10))
+        self.assertTrue(self.qpart.isComment(4002, 0))
+        self.assertTrue(self.qpart.isCode(4003, 0))
+        self.assertTrue(self.qpart.isCode(4004, 0))
+
+    def test_edit_in_block_comment(self):
+        text = '\n'.join(['/* block', 'comment'] + ['int a = 1; // comment'] * 5000 + ['*/ int b;'])
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = text
+        self._highlighting(self.qpart)
+
+        highlightedTexts = self._countHighlighting(self.qpart, self._editLine, 2500, 'int a = 2; /* comment')
+
+        self.assertLess(len(highlightedTexts), 5)
+        self.assertIn('int a = 2; /* comment', highlightedTexts)
+        self.assertTrue(self.qpart.isComment(2500, 0))
+        self.assertTrue(self.qpart.isComment(2501, 0))
+
+
+class FormatRangesCache(_HighlightingTest):
+    """Format ranges are shared by blocks with the same formats. Results must be the same as without the cache
+    """
+    def test_1(self):
+        text = '\n'.join(['int a = 1; // comment',
+                         'char* s = "string";',
+                         'x'] * 300)
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = text
+        initial = self._highlighting(self.qpart)
+        cache = self.qpart._highlighter._formatRangesCache
+        self.assertLessEqual(len(cache), 5)
+
+        cacheSize = len(cache)
+        self.qpart.lines[0] = '/* comment'
+        self._highlighting(self.qpart)
+        # one entry per length of commented lines and one for the first line
+        self.assertLessEqual(len(cache), cacheSize + 5)
+
+        self.qpart.lines[0] = 'int a = 1; // comment'
+        cacheSize = len(cache)
+        self.assertEqual(self._highlighting(self.qpart), initial)
+        self.assertEqual(len(cache), cacheSize)  # all formats are known
+
+        usualQpart = Qutepart()
+        try:
+            usualQpart.detectSyntax(language='C')
+            usualQpart.text = '/* comment\n' + text.split('\n', 1)[1]
+            self.qpart.lines[0] = '/* comment'
+            self.assertEqual(self._highlighting(self.qpart), self._highlighting(usualQpart))
+        finally:
+            usualQpart.terminate()
+
+
+class MarkContentsDirty(_HighlightingTest):
+    """Changed blocks are marked dirty by contiguous ranges, not one by one
+    """
+    def test_1(self):
+        calls = []
+        document = self.qpart.document()
+        markContentsDirty = document.markContentsDirty
+
+        def recordingMarkContentsDirty(position, length):
+            calls.append((position, length))
+            markContentsDirty(position, length)
+
+        document.markContentsDirty = recordingMarkContentsDirty
+
+        self.qpart.detectSyntax(language='C')
+        self.qpart.text = '\n'.join(['int a = 1; // comment'] * 2000)
+        self._highlighting(self.qpart)
+        self.assertLess(len(calls), 100)
+        self.assertEqual(calls[0][0], 0)
+        self.assertGreaterEqual(sum([length for position, length in calls]), len(self.qpart.text))
+
+        del calls[:]
+        self.qpart.lines[1000] = '/* comment'
+        self._highlighting(self.qpart)
+        self.assertLess(len(calls), 20)
+        self.assertEqual(calls[0][0], len('\n'.join(self.qpart.lines[:1000])) + 1)
+
+
+class Scheduler(_BaseTest):
+    """GlobalTimer calls callbacks by priority, in turn, and within the time budget
+    """
+    def setUp(self):
+        _BaseTest.setUp(self)
+        self.timer = qutepart.syntaxhlighter.GlobalTimer()
+        self.calls = []
+
+    def _callback(self, name, priority, count, duration=0):
+        GlobalTimer = qutepart.syntaxhlighter.GlobalTimer
+        priorityFunction = lambda: getattr(GlobalTimer, 'PRIORITY_' + priority)
+        counter = [count]
+
+        def callback():
+            self.calls.append(name)
+            time.sleep(duration)
+            counter[0] -= 1
+            if counter[0]:
+                self.timer.scheduleCallback(callback, priorityFunction)
+
+        self.timer.scheduleCallback(callback, priorityFunction)
+        return callback
+
+    def _run(self):
+        t = time.time()
+        while self.timer.stats()['queueDepth'] and time.time() - t < 5:
+            self.app.processEvents()
+
+    def test_priority(self):
+        self._callback('background', 'BACKGROUND', 1)
+        self._callback('visible', 'VISIBLE', 2)
+        self._callback('focused', 'FOCUSED', 2)
+        self._run()
+        self.assertEqual(self.calls, ['focused', 'focused', 'visible', 'visible', 'background'])
+
+    def test_round_robin(self):
+        self._callback('a', 'BACKGROUND', 3)
+        self._callback('b', 'BACKGROUND', 2)
+        self._callback('c', 'BACKGROUND', 1)
+        self._run()
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'a', 'b', 'a'])
+
+    def test_budget(self):
+        callback = self._callback('a', 'VISIBLE', 6, duration=0.015)
+        self._run()
+        stats = self.timer.stats()
+        self.assertEqual(stats['callCount'], 6)
+        self.assertEqual(stats['maxQueueDepth'], 1)
+        # several callbacks are called in one iteration, but not more than the budget allows
+        self.assertGreater(stats['iterationCount'], 1)
+        self.assertLess(stats['iterationCount'], 6)
+        self.assertGreaterEqual(stats['timeSpent'][callback], 0.015 * 6)
+
+    def test_highlighter_priority(self):
+        GlobalTimer = qutepart.syntaxhlighter.GlobalTimer
+        self.qpart.detectSyntax(language='C')
+        highlighter = self.qpart._highlighter
+        self.assertEqual(highlighter._priority(), GlobalTimer.PRIORITY_BACKGROUND)
+        self.qpart.show()
+        self.assertEqual(highlighter._priority(), GlobalTimer.PRIORITY_VISIBLE)
+
 
 class DetectSyntax(_BaseTest):
     def test_1(self):
@@ -182,6 +664,19 @@ class DetectSyntax(_BaseTest):
         self.qpart.detectSyntax(firstLine='<?php hello() ?>')
         self.assertEqual(self.qpart.language(), 'PHP (HTML)')
 
+    def test_source_file_name(self):
+        def language(fileName):
+            self.qpart.detectSyntax(sourceFilePath='/tmp/' + fileName)
+            return self.qpart.language()
+
+        self.assertEqual(language('CMakeLists.txt'), 'CMake')  # exact name
+        self.assertEqual(language('file.cmake'), 'CMake')  # suffix
+        self.assertEqual(language('file.desktop.cmake'), '.desktop')  # longer suffix wins
+        self.assertEqual(language('Makefile.am'), 'Makefile')  # glob
+        self.assertEqual(language('Makefile.inc'), 'Makefile')  # glob with bigger priority than '*.inc'
+        self.assertEqual(language('bin.cfg'), 'CubeScript')  # '*.cfg' and 'bin.*' have equal priorities
+        self.assertIsNone(language('file.unknownextension'))
+
 
 class Signals(_BaseTest):
     def test_language_changed(self):
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import io
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import SyntaxManager
+import qutepart.syntax.batch
+import qutepart.syntax.loader
+
+
+class Batch(unittest.TestCase):
+    def setUp(self):
+        self.manager = SyntaxManager(headless=True)
+
+    def test_tokenize_text(self):
+        syntax = self.manager.getSyntax(languageName='Python')
+        tokens = list(qutepart.syntax.batch.tokenizeText(syntax, 'def f(x):  # comment\r\n    return "s"'))
+        self.assertEqual(tokens,
+                         [(0, 0, 3, 'definition keyword', ' '),
+                          (0, 3, 8, 'normal text', ' '),
+                          (0, 11, 9, 'comment', 'c'),
+                          (1, 0, 4, 'normal text', ' '),
+                          (1, 4, 6, 'flow control keyword', ' '),
+                          (1, 10, 1, 'normal text', ' '),
+                          (1, 11, 3, 'string', 's')])
+
+    def test_multiline_comment(self):
+        syntax = self.manager.getSyntax(languageName='C++')
+        tokens = list(qutepart.syntax.batch.tokenizeLines(syntax, io.StringIO('int a; /* c\n */ x\n')))
+        self.assertEqual([token for token in tokens if token[0] == 1],
+                         [(1, 0, 3, 'comment', 'c'),
+                          (1, 3, 2, 'normal text', ' ')])
+
+    def test_no_qt_formats(self):
+        def _convertFormat(format):
+            self.fail('Headless syntax creates Qt formats')
+        convertFormat = qutepart.syntax.loader._convertFormat
+        qutepart.syntax.loader._convertFormat = _convertFormat
+        try:
+            syntax = self.manager.getSyntax(languageName='PHP/PHP')
+            lineData, segments = syntax.highlightBlock('<?php echo "x"; ?>', None)
+        finally:
+            qutepart.syntax.loader._convertFormat = convertFormat
+
+        for length, format in segments:
+            self.assertIsInstance(format, str)
+
+    def test_no_qt_import(self):
+        code = 'import sys; import qutepart.syntax.batch; ' \
+               'print(" ".join(name for name in sys.modules if name.startswith("PyQt5")))'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=topLevelPath,
+                                         universal_newlines=True)
+        self.assertEqual(output.strip(), '')
+
+    def test_tokenize_file(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            filePath = os.path.join(tmpDir, 'script')
+            with open(filePath, 'w') as sourceFile:
+                sourceFile.write('#!/bin/sh\necho "hello"\n')
+
+            syntax, tokens = qutepart.syntax.batch.tokenizeFile(filePath, self.manager)
+            self.assertEqual(syntax.name, 'Bash')
+            self.assertEqual(tokens[0], (0, 0, 9, 'comment', 'c'))
+            # last empty line doesn't have tokens
+            self.assertEqual(tokens[-1][0], 1)
+
+            with open(filePath, 'w') as sourceFile:
+                sourceFile.write('unknown')
+            self.assertEqual(qutepart.syntax.batch.tokenizeFile(filePath, self.manager), (None, None))
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import os.path
+import sys
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import SyntaxManager
+
+
+class Test(unittest.TestCase):
+    """Context stacks are interned. Equal stacks are the same object
+    """
+    def setUp(self):
+        self.syntax = SyntaxManager().getSyntax(languageName='C++')
+
+    def _contextStack(self, lines):
+        contextStack = None
+        for line in lines:
+            contextStack = self.syntax.highlightBlock(line, contextStack)[0][0]
+        return contextStack
+
+    def test_identity(self):
+        contextStack = self._contextStack(['int a; /* comment'])
+        self.assertIsNotNone(contextStack)
+        self.assertIs(self._contextStack(['/* other comment']), contextStack)
+        self.assertIs(self._contextStack(['int a; /* comment', 'still comment']), contextStack)
+        self.assertIsNot(self._contextStack(['char* s = "string \\']), contextStack)
+        self.assertIsNone(self._contextStack(['int a; /* comment */']))
+
+    def test_nested(self):
+        contextStack = self._contextStack(['#if 0', '/* comment'])
+        self.assertIs(self._contextStack(['#if 0', 'x', '/* other comment']), contextStack)
+        self.assertIsNot(self._contextStack(['/* comment']), contextStack)
+        self.assertIs(self._contextStack(['#if 0', '/* comment */', '#endif']), None)
+
+    def test_reference_count(self):
+        contextStack = self._contextStack(['int a; /* comment'])
+        refCount = sys.getrefcount(contextStack)
+        for i in range(10):
+            self.syntax.highlightBlock('comment', contextStack)
+            self.syntax.highlightBlock('comment */ /* comment', contextStack)
+        self.assertEqual(sys.getrefcount(contextStack), refCount)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import SyntaxManager
+import qutepart.syntax.cache
+from qutepart.syntax.cache import DefinitionCache
+from qutepart.syntax.loader import loadDefinition
+
+
+XML_FILES_DIR = os.path.join(topLevelPath, 'qutepart', 'syntax', 'data', 'xml')
+FILES_DIR = os.path.join(os.path.dirname(__file__), 'files')
+
+
+class DefinitionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpDir = tempfile.mkdtemp()
+        self._cacheDir = os.path.join(self._tmpDir, 'cache')
+        self._cache = DefinitionCache(self._cacheDir)
+
+        # copy of a definition, which can be modified
+        self._xmlFilePath = os.path.join(self._tmpDir, 'c.xml')
+        shutil.copy(os.path.join(XML_FILES_DIR, 'c.xml'), self._xmlFilePath)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpDir)
+
+    def test_save_load(self):
+        self.assertIsNone(self._cache.load(self._xmlFilePath))
+        definition = loadDefinition(self._xmlFilePath)
+        self._cache.save(self._xmlFilePath, definition)
+        self.assertEqual(self._cache.load(self._xmlFilePath), definition)
+
+    def test_touched(self):
+        """Modification time is changed, but the contents is not
+        """
+        definition = loadDefinition(self._xmlFilePath)
+        self._cache.save(self._xmlFilePath, definition)
+        stat = os.stat(self._xmlFilePath)
+        os.utime(self._xmlFilePath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self._cache.load(self._xmlFilePath), definition)
+
+    def test_modified(self):
+        self._cache.save(self._xmlFilePath, loadDefinition(self._xmlFilePath))
+        with open(self._xmlFilePath, 'a') as xmlFile:
+            xmlFile.write('\n<!-- modified -->\n')
+        self.assertIsNone(self._cache.load(self._xmlFilePath))
+
+    def test_version(self):
+        self._cache.save(self._xmlFilePath, loadDefinition(self._xmlFilePath))
+        oldVersion = qutepart.syntax.cache.CACHE_VERSION
+        qutepart.syntax.cache.CACHE_VERSION += 1
+        try:
+            self.assertIsNone(self._cache.load(self._xmlFilePath))
+        finally:
+            qutepart.syntax.cache.CACHE_VERSION = oldVersion
+
+    def test_broken_file(self):
+        self._cache.save(self._xmlFilePath, loadDefinition(self._xmlFilePath))
+        cacheFilePath = os.path.join(self._cacheDir, 'c.xml.cache')
+        with open(cacheFilePath, 'rb') as cacheFile:
+            data = cacheFile.read()
+        with open(cacheFilePath, 'wb') as cacheFile:
+            cacheFile.write(data[:len(data) // 2])
+
+        self.assertIsNone(self._cache.load(self._xmlFilePath))
+
+    def test_disabled(self):
+        cache = DefinitionCache(None)
+        cache.save(self._xmlFilePath, loadDefinition(self._xmlFilePath))
+        self.assertIsNone(cache.load(self._xmlFilePath))
+        self.assertFalse(os.path.exists(self._cacheDir))
+
+    @staticmethod
+    def _formatSignature(format):
+        if format is None:
+            return None
+        return (format.foreground().color().name(), format.fontWeight(), format.fontItalic())
+
+    def _highlight(self, fileName):
+        manager = SyntaxManager()
+        manager._definitionCache = self._cache
+        filePath = os.path.join(FILES_DIR, fileName)
+        syntax = manager.getSyntax(sourceFilePath=filePath)
+        with open(filePath, encoding='utf-8') as file_:
+            lines = file_.read().splitlines()
+
+        results = []
+        contextStack = None
+        for line in lines:
+            lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+            contextStack = lineData[0]
+            results.append((''.join(lineData[1]),
+                            [(length, self._formatSignature(format)) for length, format in highlightedSegments]))
+        return results
+
+    def test_highlighting(self):
+        """Syntax, loaded from the cache, highlights text as syntax, loaded from XML file.
+        PHP includes HTML, CSS and JavaScript
+        """
+        cold = self._highlight('highlight.php')
+        self.assertTrue(os.listdir(self._cacheDir))
+        warm = self._highlight('highlight.php')
+        self.assertEqual(cold, warm)
+
+
+if __name__ == '__main__':
+    unittest.main()
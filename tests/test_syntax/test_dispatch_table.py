@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+import os.path
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+import qutepart
+
+from qutepart.syntax import SyntaxManager
+
+import qutepart.syntax.loader
+
+
+FILES_DIR = os.path.join(os.path.dirname(__file__), 'files')
+
+
+@unittest.skipIf(qutepart.syntax.loader.binaryParserAvailable,
+                 'Dispatch tables are used only by the Python parser')
+class DispatchTable(unittest.TestCase):
+    """Highlighting with and without context dispatch tables must produce the same results
+    """
+    def _highlight(self, syntax, lines):
+        results = []
+        contextStack = None
+        for line in lines:
+            lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+            contextStack = lineData[0]
+            results.append((contextStack.currentContext().name if contextStack is not None else None,
+                            ''.join(lineData[1]),
+                            [(length, id(format)) for length, format in highlightedSegments]))
+        return results
+
+    def _setDispatchTablesEnabled(self, manager, enabled):
+        for syntax in manager._loadedSyntaxes.values():
+            for context in syntax.parser.contexts.values():
+                if enabled:
+                    context.compileDispatchTable()
+                else:
+                    context.dispatchTable = None
+
+    def _test(self, fileName):
+        manager = SyntaxManager()
+        filePath = os.path.join(FILES_DIR, fileName)
+        syntax = manager.getSyntax(sourceFilePath=filePath)
+        with open(filePath, encoding='utf-8') as file_:
+            lines = file_.read().splitlines()
+
+        withTables = self._highlight(syntax, lines)
+        self._setDispatchTablesEnabled(manager, False)
+        withoutTables = self._highlight(syntax, lines)
+
+        self.assertEqual(withTables, withoutTables)
+
+    def test_c(self):
+        self._test('highlight_lpc.c')
+
+    def test_php(self):
+        """Includes rules from other syntaxes
+        """
+        self._test('highlight.php')
+
+    def test_perl(self):
+        """Dynamic rules
+        """
+        self._test('highlight.pl')
+
+    def test_ruby(self):
+        self._test('highlight.rb')
+
+    def test_spec(self):
+        self._test('highlight.spec')
+
+    def test_table(self):
+        manager = SyntaxManager()
+        syntax = manager.getSyntax(languageName='C')
+        context = syntax.parser.defaultContext
+        self.assertEqual(len(context.dispatchTable), 128)
+        for rules in context.dispatchTable:
+            self.assertTrue(set(rules).issubset(context.rules))
+        # digits can't start a keyword
+        keywordRules = [rule for rule in context.rules if isinstance(rule, qutepart.syntax.parser.keyword)]
+        self.assertTrue(keywordRules)
+        for rule in keywordRules:
+            self.assertNotIn(rule, context.dispatchTable[ord('5')])
+            self.assertIn(rule, context.dispatchTable[ord('i')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+import os.path
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+import qutepart
+
+from qutepart.syntax import SyntaxManager
+
+
+class LineParts(unittest.TestCase):
+    """Line, parsed by parts, must be highlighted as the whole line
+    """
+    def _highlightByParts(self, syntax, text, prevContextStack, maxLength):
+        contextStack = prevContextStack
+        columnIndex = 0
+        textTypeMap = ''
+        highlightedSegments = []
+        while True:
+            lineData, segments, newColumnIndex = syntax.highlightBlockPart(text, contextStack, columnIndex, maxLength)
+            self.assertGreaterEqual(newColumnIndex, min(len(text), columnIndex + maxLength))
+            self.assertEqual(len(lineData[1]), newColumnIndex - columnIndex)
+            self.assertEqual(sum([length for length, format in segments]), newColumnIndex - columnIndex)
+
+            contextStack = lineData[0]
+            textTypeMap += ''.join(lineData[1])
+            highlightedSegments += segments
+            columnIndex = newColumnIndex
+            if columnIndex >= len(text):
+                return (contextStack, textTypeMap), highlightedSegments
+
+    def _formatRanges(self, highlightedSegments):
+        """Convert segments to list of (column, format). Neighbour segments with the same format are merged
+        """
+        ranges = []
+        column = 0
+        for length, format in highlightedSegments:
+            for i in range(length):
+                ranges.append((column, format))
+                column += 1
+        return ranges
+
+    def _test(self, languageName, lines):
+        syntax = SyntaxManager().getSyntax(languageName=languageName)
+        for maxLength in (1, 3, 7, 100):
+            wholeContextStack = None
+            partsContextStack = None
+            for line in lines:
+                wholeLineData, wholeSegments = syntax.highlightBlock(line, wholeContextStack)
+                partsLineData, partsSegments = self._highlightByParts(syntax, line, partsContextStack, maxLength)
+                self.assertEqual(''.join(wholeLineData[1]), partsLineData[1])
+                self.assertEqual(self._formatRanges(wholeSegments), self._formatRanges(partsSegments))
+                wholeContextStack = wholeLineData[0]
+                partsContextStack = partsLineData[0]
+
+            # the last line ends with an unfinished comment or string
+            self.assertTrue(syntax.isComment(partsLineData, len(lines[-1]) - 1) or
+                            partsLineData[1][-1] == 's')
+
+    def test_c(self):
+        self._test('C', ['int main(int argc, char** argv) { return 0x1F + 1.5e3; } // comment',
+                         '#include <stdio.h>',
+                         'char* s = "string \\" with escape"; /* block',
+                         'comment */ int x; /* unfinished'])
+
+    def test_python(self):
+        self._test('Python', ['def f(a, b=1):  # comment',
+                              '    return "string" + \'string\' + f(a, b=[1, 2, 3])',
+                              'x = """unfinished'])
+
+    def test_empty_line(self):
+        syntax = SyntaxManager().getSyntax(languageName='C')
+        lineData, highlightedSegments, columnIndex = syntax.highlightBlockPart('', None, 0, 10)
+        self.assertEqual(columnIndex, 0)
+        self.assertEqual(highlightedSegments, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import json
+import os
+import os.path
+import subprocess
+import sys
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+import qutepart.syntax.loader
+
+
+_TOKENIZE_CODE = '''
+import json, logging, sys
+from qutepart.syntax import SyntaxManager
+import qutepart.syntax.batch
+logging.getLogger('qutepart').setLevel(logging.WARNING)
+syntax = SyntaxManager(headless=True).getSyntax(languageName=sys.argv[1])
+for line in sys.argv[2:]:
+    print(json.dumps(list(qutepart.syntax.batch.tokenizeText(syntax, line))))
+'''
+
+_BACKTRACKING_CODE = '''
+import logging
+from qutepart.syntax import SyntaxManager
+import qutepart.syntax.loader
+logging.getLogger('qutepart').setLevel(logging.WARNING)
+parser = qutepart.syntax.loader._parserModule
+syntax = SyntaxManager(headless=True).getSyntax(languageName='Python')
+context = syntax.parser.contexts['Normal']
+abstractRuleParams = parser.AbstractRuleParams(context, None, None, None, None, False, False, False, -1)
+rule = parser.RegExpr(abstractRuleParams, '(a|aa)+$', False, False)
+for i in range(2):
+    textToMatchObject = parser.TextToMatchObject(0, 'a' * 40 + '!', syntax.parser.deliminatorSet, None)
+    print(rule.tryMatch(textToMatchObject))
+'''
+
+
+@unittest.skipUnless(qutepart.syntax.loader.binaryParserAvailable,
+                     'Only the C parser limits reg exp matching')
+class Test(unittest.TestCase):
+    """Reg exp match limits of the C parser grow with line length.
+    A process is started per parser, because the parser is selected on import
+    """
+    def _run(self, cParser, args):
+        """Run python with args. Returns (stdout, stderr)
+        """
+        env = dict(os.environ)
+        env['QPART_CPARSER'] = 'Y' if cParser else 'N'
+        process = subprocess.run([sys.executable] + args,
+                                 cwd=topLevelPath, env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        return process.stdout, process.stderr
+
+    def _tokenize(self, cParser, languageName, lines):
+        output, log = self._run(cParser, ['-c', _TOKENIZE_CODE, languageName] + lines)
+        return [json.loads(line) for line in output.splitlines()], log
+
+    def test_long_line(self):
+        """Function with a long list of parameters is matched by one RegExpr
+        """
+        line = 'f = (' + ', '.join('arg%d' % index for index in range(3000)) + ') -> x'
+        cTokens, cLog = self._tokenize(True, 'CoffeeScript', [line])
+        pythonTokens, pythonLog = self._tokenize(False, 'CoffeeScript', [line])
+        self.assertEqual(cTokens, pythonTokens)
+        self.assertIn([0, 4, len(line) - 6, 'function', ' '], cTokens[0])
+        self.assertEqual(cLog, '')
+
+    def test_warning(self):
+        """Catastrophic backtracking is stopped and logged once
+        """
+        output, log = self._run(True, ['-c', _BACKTRACKING_CODE])
+        self.assertEqual(output.split(), ['None', 'None'])
+        self.assertEqual(log.count('match limit exceeded'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import logging
+import os.path
+import sys
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import SyntaxManager
+
+
+_FILES_PATH = os.path.join(os.path.dirname(__file__), 'files')
+
+
+class ParseBlock(unittest.TestCase):
+    """parseBlock() must produce the same context stack as highlightBlock()
+    """
+    def setUp(self):
+        logging.getLogger('qutepart').setLevel(logging.ERROR)
+
+    def _test(self, syntax, lines):
+        """Context stacks are compared by highlighting the next line with them
+        """
+        def highlight(line, contextStack):
+            lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+            return ''.join(lineData[1]), highlightedSegments
+
+        highlightContextStack = None
+        parseContextStack = None
+        for line in lines:
+            self.assertEqual(highlight(line, highlightContextStack),
+                             highlight(line, parseContextStack))
+
+            lineData = syntax.parseBlock(line, parseContextStack)
+            self.assertEqual(len(lineData[1]), 0)
+            parseContextStack = lineData[0]
+            highlightContextStack = syntax.highlightBlock(line, highlightContextStack)[0][0]
+            self.assertEqual(parseContextStack is None, highlightContextStack is None)
+
+    def test_c(self):
+        syntax = SyntaxManager().getSyntax(languageName='C')
+        self._test(syntax, ['int a; /* block',
+                            '',
+                            'comment */ char* s = "string \\',
+                            'continued";',
+                            '#if 0',
+                            'x',
+                            '#endif'])
+
+    def test_files(self):
+        manager = SyntaxManager(headless=True)
+        for fileName in sorted(os.listdir(_FILES_PATH)):
+            syntax = manager.getSyntax(sourceFilePath=os.path.join(_FILES_PATH, fileName))
+            if syntax is None:
+                continue
+
+            with open(os.path.join(_FILES_PATH, fileName), encoding='utf-8', errors='replace') as file_:
+                lines = file_.read().splitlines()[:100]
+            with self.subTest(fileName=fileName):
+                self._test(syntax, lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
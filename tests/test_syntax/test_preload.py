@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import os.path
+import sys
+import threading
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax.cache import DefinitionCache
+
+
+class Preload(unittest.TestCase):
+    def setUp(self):
+        self.manager = SyntaxManager()
+        self.manager._definitionCache = DefinitionCache(None)
+
+        # remember threads, which load definitions
+        self.loadingThreads = set()
+        loadDefinition = self.manager._loadDefinition
+        def _loadDefinition(xmlFileName):
+            self.loadingThreads.add(threading.current_thread())
+            return loadDefinition(xmlFileName)
+        self.manager._loadDefinition = _loadDefinition
+
+    def test_preload(self):
+        self.manager.preload(['PHP/PHP', 'Python'])
+
+        # included syntaxes are preloaded too
+        for xmlFileName in ('php.xml', 'html.xml', 'css.xml', 'javascript.xml', 'python.xml'):
+            self.assertIn(xmlFileName, self.manager._definitionFutures)
+            self.assertTrue(self.manager._definitionFutures[xmlFileName].done())
+        self.assertNotIn(threading.current_thread(), self.loadingThreads)
+
+        # syntaxes are not created until requested
+        self.assertEqual(self.manager._loadedSyntaxes, {})
+
+        syntax = self.manager.getSyntax(languageName='PHP/PHP')
+        self.assertEqual(syntax.name, 'PHP/PHP')
+        self.assertNotIn(threading.current_thread(), self.loadingThreads)
+        self.assertNotIn('php.xml', self.manager._definitionFutures)
+        self.assertNotIn('html.xml', self.manager._definitionFutures)
+
+    def test_preload_loaded(self):
+        syntax = self.manager.getSyntax(languageName='Python')
+        self.manager.preload(['Python'])
+        self.assertEqual(self.manager._definitionFutures, {})
+        self.assertIs(self.manager.getSyntax(languageName='Python'), syntax)
+
+    def test_preload_unknown(self):
+        self.manager.preload(['No such language'])
+        self.assertEqual(self.manager._definitionFutures, {})
+
+    def test_get_syntax_async(self):
+        future = self.manager.getSyntaxAsync(sourceFilePath='/tmp/file.py')
+        syntax = future.result()
+        self.assertTrue(future.done())
+        self.assertEqual(syntax.name, 'Python')
+        self.assertIs(self.manager.getSyntax(languageName='Python'), syntax)
+        self.assertNotIn(threading.current_thread(), self.loadingThreads)
+
+    def test_get_syntax_async_callback(self):
+        future = self.manager.getSyntaxAsync(languageName='C++')
+        loaded = threading.Event()
+        future.addDoneCallback(lambda future_: loaded.set())
+        self.assertTrue(loaded.wait(10))
+        self.assertTrue(future.done())
+        self.assertEqual(future.result().name, 'C++')
+
+    def test_get_syntax_async_not_found(self):
+        future = self.manager.getSyntaxAsync(sourceFilePath='/tmp/file.unknownextension')
+        self.assertTrue(future.done())
+        self.assertIsNone(future.result())
+
+
+class Fallback(unittest.TestCase):
+    """If syntax fails to load with KeyError, next parameter of getSyntax() is tried
+    """
+    def setUp(self):
+        self.manager = SyntaxManager()
+        self.manager._definitionCache = DefinitionCache(None)
+
+        loadDefinition = self.manager._loadDefinition
+        def _loadDefinition(xmlFileName):
+            if xmlFileName == 'python.xml':
+                raise KeyError('Unknown IncludeRules')
+            return loadDefinition(xmlFileName)
+        self.manager._loadDefinition = _loadDefinition
+
+    def test_get_syntax(self):
+        syntax = self.manager.getSyntax(languageName='Python', sourceFilePath='/tmp/file.cpp')
+        self.assertEqual(syntax.name, 'C++')
+        self.assertIsNone(self.manager.getSyntax(languageName='Python'))
+
+    def test_get_syntax_async(self):
+        future = self.manager.getSyntaxAsync(xmlFileName='python.xml', sourceFilePath='/tmp/file.cpp')
+        syntax = future.result()
+        self.assertEqual(syntax.name, 'C++')
+        self.assertIs(future.result(), syntax)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import logging
+import os.path
+import sys
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import SyntaxManager
+
+import qutepart.syntax.loader
+
+
+_FILES_PATH = os.path.join(os.path.dirname(__file__), 'files')
+
+
+class Test(unittest.TestCase):
+    """Highlighting with and without RegExpr rules folded into alternations must produce the same results
+    """
+    def setUp(self):
+        logging.getLogger('qutepart').setLevel(logging.ERROR)
+        self._combineRegExprRules = qutepart.syntax.loader.combineRegExprRules
+
+    def tearDown(self):
+        qutepart.syntax.loader.combineRegExprRules = self._combineRegExprRules
+
+    def _highlight(self, syntax, lines):
+        results = []
+        contextStack = None
+        for line in lines:
+            lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+            contextStack = lineData[0]
+            results.append((contextStack is None,  # stacks of different parsers can't be compared
+                            str(lineData[1]),
+                            highlightedSegments))
+        return results
+
+    def _highlightFiles(self, combineRegExprRules):
+        qutepart.syntax.loader.combineRegExprRules = combineRegExprRules
+        manager = SyntaxManager(headless=True)
+        results = {}
+        for fileName in sorted(os.listdir(_FILES_PATH)):
+            filePath = os.path.join(_FILES_PATH, fileName)
+            syntax = manager.getSyntax(sourceFilePath=filePath)
+            if syntax is not None:
+                with open(filePath, encoding='utf-8', errors='replace') as file_:
+                    results[fileName] = self._highlight(syntax, file_.read().splitlines())
+        return results, manager
+
+    def test_files(self):
+        expected, manager = self._highlightFiles(False)
+        results, manager = self._highlightFiles(True)
+
+        alternations = [rule for syntax in manager._loadedSyntaxes.values() \
+                            for context in syntax.parser.contexts.values() \
+                                for rule in context.rules \
+                                    if type(rule).__name__ == 'RegExprAlternation']
+        self.assertTrue(alternations)
+
+        self.assertEqual(sorted(results.keys()), sorted(expected.keys()))
+        for fileName in expected:
+            for lineIndex, (result, expectedResult) in enumerate(zip(results[fileName], expected[fileName])):
+                self.assertEqual(result, expectedResult, '%s:%d' % (fileName, lineIndex + 1))
+
+    def test_match_groups(self):
+        """Match data of the alternation contains groups of the matched rule only, as if the rule was tried alone
+        """
+        parser = qutepart.syntax.loader._parserModule
+
+        def tryMatch(rule, text):
+            textToMatchObject = parser.TextToMatchObject(0, text, '', None)
+            result = rule.tryMatch(textToMatchObject)
+            return result.rule, result.length, tuple(result.data)
+
+        strings = ['a(b)(c)', 'x(y)', '(z)']
+        rules = []
+        for string in strings:
+            abstractRuleParams = parser.AbstractRuleParams(None, None, None, None, None,
+                                                           False, False, False, -1)
+            rules.append(parser.RegExpr(abstractRuleParams, string, False, False))
+
+        alternation = qutepart.syntax.loader._makeRegExprAlternation(
+            None, list(zip(strings, rules)), False, False)
+
+        for rule, text in zip(rules, ('abc', 'xyz', 'z')):
+            self.assertEqual(tryMatch(alternation, text), tryMatch(rule, text))
+        self.assertEqual(tryMatch(alternation, 'xyz')[2], ('xy', 'y'))
+
+    def test_not_combinable(self):
+        """Rules, which can't be folded, break runs of RegExpr rules
+        """
+        def definition(string, column=-1, dynamic=False):
+            return ('RegExpr', None, '#stay', False, False, dynamic, column, (string, False, False), ())
+
+        self.assertEqual(qutepart.syntax.loader._regExprGroupCount(definition('a(b)(c)')), 2)
+        self.assertEqual(qutepart.syntax.loader._regExprGroupCount(definition('(a)\\1')), None)
+        self.assertEqual(qutepart.syntax.loader._regExprGroupCount(definition('(?i)a')), None)
+        self.assertEqual(qutepart.syntax.loader._regExprGroupCount(definition('(?P<x>a)')), None)
+        self.assertEqual(qutepart.syntax.loader._regExprGroupCount(definition('(a')), None)
+        self.assertEqual(qutepart.syntax.loader._regExprGroupCount(definition('a', column=0)), None)
+        self.assertEqual(qutepart.syntax.loader._regExprGroupCount(definition('%1', dynamic=True)), None)
+        self.assertEqual(qutepart.syntax.loader._regExprGroupCount(definition('(?<=a)b(?:c)')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,10 +34,19 @@ def tryMatchWithData(rule, contextData, column, text):
 
 class Test(unittest.TestCase):
     def _getRule(self, syntaxName, contextName, ruleIndex):
+        """Get rule by its index in the xml definition.
+        RegExpr rules, folded into alternations (see QPART_COMBINE_REGEXPR), keep their indexes
+        """
         global _currentSyntax
         _currentSyntax = SyntaxManager().getSyntax(xmlFileName=syntaxName)
         context = _currentSyntax.parser.contexts[contextName]
-        return context.rules[ruleIndex]
+        rules = []
+        for rule in context.rules:
+            if isinstance(rule, parser.RegExprAlternation):
+                rules.extend(rule.rules)
+            else:
+                rules.append(rule)
+        return rules[ruleIndex]
 
     def test_DetectChar(self):
         rule = self._getRule('debiancontrol.xml', 'Variable', 0)
@@ -114,6 +123,38 @@ class Test(unittest.TestCase):
         self.assertEqual(tryMatch(rule, 1, " varx "), None)
         self.assertEqual(tryMatch(rule, 2, " xvar "), None)
 
+    def test_keyword_set(self):
+        """Keyword rules, which use the same list, share the set
+        """
+        rule = self._getRule("javascript.xml", "Normal", 9)
+        self.assertIs(rule.words, _currentSyntax.parser.lists['keywords'])
+
+        words = ['if', 'else', 'if', 'über', 'x' * 300]
+        keywordSet = parser.KeywordSet(words)
+        self.assertEqual(len(keywordSet), 4)
+        self.assertEqual(sorted(keywordSet), sorted(set(words)))
+        for word in words:
+            self.assertIn(word, keywordSet)
+        self.assertNotIn('x' * 299, keywordSet)
+        self.assertNotIn('ube', keywordSet)
+        self.assertNotIn('', keywordSet)
+
+        context = _currentSyntax.parser.contexts['Normal']
+        abstractRuleParams = parser.AbstractRuleParams(context, None, None, None, None, False, False, False, -1)
+        rule = parser.keyword(abstractRuleParams, keywordSet, False)
+        self.assertEqual(tryMatch(rule, 1, ' über '), 4)  # length in characters
+        self.assertEqual(tryMatch(rule, 0, 'x' * 300), 300)  # no limit of word length
+        self.assertEqual(tryMatch(rule, 0, 'x' * 301), None)
+
+        emptyRule = parser.keyword(abstractRuleParams, parser.KeywordSet(), False)
+        self.assertEqual(tryMatch(emptyRule, 0, 'x'), None)
+
+        if qutepart.syntax.loader.binaryParserAvailable:
+            keywordSet.__init__(['x'])  # C set is rebuilt
+            self.assertEqual(list(keywordSet), ['x'])
+            self.assertNotIn('if', keywordSet)
+            self.assertEqual(tryMatch(rule, 0, 'x'), 1)
+
     def test_jsp_keyword(self):
         rule = self._getRule('jsp.xml', "Jsp Scriptlet", 5)
         self.assertEqual(tryMatch(rule, 0, "String"), len("String"))
@@ -173,6 +214,14 @@ class Test(unittest.TestCase):
         self.assertEqual(tryMatch(rule, 1, ' real'), None)
         self.assertEqual(tryMatch(rule, 0, 'real'), 4)
 
+    def test_RegExpr_whole_line(self):
+        """Reg exp sees the text before the current column
+        """
+        rule = self._getRule('spice.xml', 'Normal', 0)  # \B\.\w+
+        self.assertEqual(tryMatch(rule, 1, 'x.model'), None)
+        self.assertEqual(tryMatch(rule, 1, ' .model'), 6)
+        self.assertEqual(tryMatch(rule, 3, 'xé .model'), 6)  # not ASCII text before the column
+
     @unittest.skip('Fails after update to XML files -- is this test out of date?')
     def test_Int(self):
         rule = self._getRule('apache.xml', 'Integer Directives', 1)
@@ -300,6 +349,24 @@ class Test(unittest.TestCase):
         count = tryMatchWithData(rule, ('blabla|', '|', ), 3, text)
         self.assertEqual(count, 1)
 
+    def test_dynamic_reg_exp_cache(self):
+        """Compiled dynamic reg exps are cached. Results must be the same as without the cache
+        """
+        rule = self._getRule("ruby.xml", "gdl_dq_string_5", 2)  # "\s*%1"
+        hitCount, missCount = rule.cacheHitCount, rule.cacheMissCount
+        for i in range(3):
+            self.assertEqual(tryMatchWithData(rule, ('blabla|', '|', ), 3, '%|a| x'), 1)
+            self.assertEqual(tryMatchWithData(rule, ('blabla}', '}', ), 3, '%|a| x'), None)
+            self.assertEqual(tryMatchWithData(rule, ('blabla}', '}', ), 3, '%|a} x'), 1)
+        self.assertEqual(rule.cacheMissCount - missCount, 2)
+        self.assertEqual(rule.cacheHitCount - hitCount, 7)
+
+        for i in range(100):  # the least recently used reg exps are dropped
+            self.assertEqual(tryMatchWithData(rule, ('x', str(i), ), 0, '  ' + str(i)), 2 + len(str(i)))
+        self.assertEqual(rule.cacheMissCount - missCount, 102)
+        self.assertEqual(tryMatchWithData(rule, ('blabla|', '|', ), 3, '%|a| x'), 1)
+        self.assertEqual(rule.cacheMissCount - missCount, 103)
+
     def test_dynamic_string_detect(self):
         """StringDetect rule, dynamic=true
         """
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import database
+from qutepart.syntax.database import SyntaxDatabase
+
+
+_DATA_PATH = os.path.join(topLevelPath, 'qutepart', 'syntax', 'data')
+
+
+class SyntaxDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.dbPath = os.path.join(self.tmpDir, 'syntax_db.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _db(self):
+        return {
+            'syntaxNameToXmlFileName': {'Python': 'python.xml', 'C++': 'cpp.xml', 'Ünicode': 'unicode.xml'},
+            'mimeTypeToXmlFileName': {'text/x-python': 'python.xml'},
+            'fileNameToXmlFileName': {'SConstruct': 'python.xml'},
+            'suffixToXmlFileName': {'.py': 'python.xml', '.cpp': 'cpp.xml', '.h': 'cpp.xml'},
+            'fileNameGlobs': [('*.pyw?', 'python.xml'), ('Makefile.*', 'cpp.xml')],
+            'firstLineGlobs': [('#!*python*', 'python.xml')],
+            'xmlFileNameToPriority': {'python.xml': 5, 'cpp.xml': -1, 'unicode.xml': 0},
+        }
+
+    def test_write_read(self):
+        db = self._db()
+        database.write(self.dbPath, db)
+        syntaxDb = SyntaxDatabase(self.dbPath)
+
+        for name in ('syntaxNameToXmlFileName', 'mimeTypeToXmlFileName', 'fileNameToXmlFileName',
+                     'suffixToXmlFileName', 'xmlFileNameToPriority'):
+            table = getattr(syntaxDb, name)
+            self.assertEqual(dict(table.items()), db[name])
+            for key, value in db[name].items():
+                self.assertIn(key, table)
+                self.assertEqual(table[key], value)
+
+        self.assertEqual(syntaxDb.globs('fileNameGlobs'), db['fileNameGlobs'])
+        self.assertEqual(syntaxDb.globs('firstLineGlobs'), db['firstLineGlobs'])
+
+    def test_missing_key(self):
+        database.write(self.dbPath, self._db())
+        syntaxDb = SyntaxDatabase(self.dbPath)
+
+        self.assertNotIn('.c', syntaxDb.suffixToXmlFileName)
+        self.assertIsNone(syntaxDb.suffixToXmlFileName.get('.c'))
+        self.assertEqual(syntaxDb.suffixToXmlFileName.get('.c', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            syntaxDb.syntaxNameToXmlFileName['Python3']
+
+    def test_invalid_file(self):
+        with open(self.dbPath, 'wb') as dbFile:
+            dbFile.write(b'{"syntaxNameToXmlFileName": {}}')
+        with self.assertRaises(ValueError):
+            SyntaxDatabase(self.dbPath)
+
+    def test_shipped_database(self):
+        """Database, generated by regenerate-definitions-db.py, refers only to existing xml files
+        """
+        syntaxDb = SyntaxDatabase(os.path.join(_DATA_PATH, 'syntax_db.bin'))
+        xmlFileNames = set(os.listdir(os.path.join(_DATA_PATH, 'xml')))
+
+        self.assertEqual(set(syntaxDb.xmlFileNameToPriority.keys()),
+                         {name for name in xmlFileNames if name.endswith('.xml')})
+        for name in ('syntaxNameToXmlFileName', 'mimeTypeToXmlFileName', 'fileNameToXmlFileName',
+                     'suffixToXmlFileName'):
+            for key, xmlFileName in getattr(syntaxDb, name).items():
+                self.assertIn(xmlFileName, xmlFileNames)
+        for name in ('fileNameGlobs', 'firstLineGlobs'):
+            for glob, xmlFileName in syntaxDb.globs(name):
+                self.assertIn(xmlFileName, xmlFileNames)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import os.path
+import pickle
+import sys
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import SyntaxManager
+from qutepart.syntax import loader
+
+
+TextTypeMap = loader._parserModule.TextTypeMap
+
+
+class Test(unittest.TestCase):
+    """TextTypeMap of the parser, which is in use, behaves like a string
+    """
+    def test_string(self):
+        string = '   cc  sssss b'
+        textTypeMap = TextTypeMap(string)
+        self.assertEqual(len(textTypeMap), len(string))
+        self.assertEqual(str(textTypeMap), string)
+        self.assertEqual(''.join(textTypeMap), string)
+        self.assertEqual(textTypeMap.runCount(), 6)
+        for index in range(-len(string), len(string)):
+            self.assertEqual(textTypeMap[index], string[index])
+
+        with self.assertRaises(IndexError):
+            textTypeMap[len(string)]
+        with self.assertRaises(IndexError):
+            textTypeMap[-len(string) - 1]
+
+    def test_empty(self):
+        textTypeMap = TextTypeMap()
+        self.assertEqual(len(textTypeMap), 0)
+        self.assertEqual(str(textTypeMap), '')
+        self.assertEqual(textTypeMap.runCount(), 0)
+        self.assertEqual(textTypeMap, TextTypeMap(''))
+
+    def test_equal_concat(self):
+        self.assertEqual(TextTypeMap('  cc'), TextTypeMap('  cc'))
+        self.assertNotEqual(TextTypeMap('  cc'), TextTypeMap('  c'))
+        self.assertNotEqual(TextTypeMap('  cc'), TextTypeMap(' ccc'))
+
+        textTypeMap = TextTypeMap(' cc') + TextTypeMap('cc ')
+        self.assertEqual(str(textTypeMap), ' cccc ')
+        self.assertEqual(textTypeMap.runCount(), 3)
+        self.assertEqual(textTypeMap, TextTypeMap(' cccc '))
+
+    def test_pickle(self):
+        textTypeMap = TextTypeMap('  ssss  ')
+        self.assertEqual(pickle.loads(pickle.dumps(textTypeMap)), textTypeMap)
+
+    def test_highlight(self):
+        syntax = SyntaxManager().getSyntax(languageName='C')
+        lineData, highlightedSegments = syntax.highlightBlock('int a = 1; // comment', None)
+        self.assertIsInstance(lineData[1], TextTypeMap)
+        self.assertEqual(lineData[1].runCount(), 2)
+        self.assertTrue(syntax.isCode(lineData, 10))
+        self.assertTrue(syntax.isComment(lineData, 11))
+
+
+if __name__ == '__main__':
+    unittest.main()
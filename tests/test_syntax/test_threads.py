@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import logging
+import os.path
+import sys
+import threading
+
+topLevelPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, topLevelPath)
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.4/'))
+sys.path.insert(0, os.path.join(topLevelPath, 'build/lib.linux-x86_64-3.5/'))
+
+from qutepart.syntax import SyntaxManager
+
+import qutepart.syntax.loader
+
+
+_FILES_PATH = os.path.join(os.path.dirname(__file__), 'files')
+_THREAD_COUNT = 3
+
+
+@unittest.skipUnless(qutepart.syntax.loader.binaryParserAvailable,
+                     'Only the C parser releases the GIL while parsing')
+class Test(unittest.TestCase):
+    """Several threads highlight the same files at the same time.
+    Results must be the same as of highlighting in one thread
+    """
+    def setUp(self):
+        logging.getLogger('qutepart').setLevel(logging.ERROR)
+
+    def _highlight(self, documents):
+        results = []
+        for syntax, lines in documents:
+            contextStack = None
+            for line in lines:
+                lineData, highlightedSegments = syntax.highlightBlock(line, contextStack)
+                contextStack = lineData[0]
+                results.append((contextStack, str(lineData[1]),
+                                [(length, id(format)) for length, format in highlightedSegments]))
+        return results
+
+    def test_files(self):
+        manager = SyntaxManager(headless=True)
+        documents = []
+        for fileName in sorted(os.listdir(_FILES_PATH)):
+            syntax = manager.getSyntax(sourceFilePath=os.path.join(_FILES_PATH, fileName))
+            if syntax is not None:
+                with open(os.path.join(_FILES_PATH, fileName), encoding='utf-8', errors='replace') as file_:
+                    documents.append((syntax, file_.read().splitlines()[:100]))
+
+        expected = self._highlight(documents)
+
+        results = [None] * _THREAD_COUNT
+
+        def run(index):
+            results[index] = self._highlight(documents)
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(_THREAD_COUNT)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for result in results:
+            self.assertEqual(len(result), len(expected))
+            for (contextStack, textTypes, segments), (expectedContextStack, expectedTextTypes, expectedSegments) \
+                    in zip(result, expected):
+                self.assertIs(contextStack, expectedContextStack)  # stacks are interned
+                self.assertEqual(textTypes, expectedTextTypes)
+                self.assertEqual(segments, expectedSegments)
+
+
+if __name__ == '__main__':
+    unittest.main()
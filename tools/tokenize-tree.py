@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Tokenize all files of a directory tree with the headless batch highlighter
+and report throughput. See qutepart.syntax.batch
+
+Usage:
+    tokenize-tree.py [-j PROCESSES] [-o OUTPUT_DIRECTORY] [-v] DIRECTORY
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+
+from qutepart.syntax.batch import tokenizeTree
+
+
+_MB = 1024. * 1024.
+
+
+def main():
+    argParser = argparse.ArgumentParser(description='Tokenize all files of a directory tree')
+    argParser.add_argument('directory')
+    argParser.add_argument('-j', '--processes', type=int, default=os.cpu_count(),
+                           help='count of worker processes. Default is count of CPUs')
+    argParser.add_argument('-o', '--output', default=None,
+                           help='save tokens of every file to this directory')
+    argParser.add_argument('-v', '--verbose', action='store_true',
+                           help='print every file')
+    args = argParser.parse_args()
+
+    tokenizedCount = 0
+    skippedCount = 0
+    tokenizedSize = 0
+    tokensCount = 0
+    tokenizingTime = 0.
+
+    clockBefore = time.perf_counter()
+    for filePath, syntaxName, size, fileTokensCount, fileTime in \
+            tokenizeTree(args.directory, args.processes, args.output):
+        if syntaxName is None:
+            skippedCount += 1
+            continue
+
+        tokenizedCount += 1
+        tokenizedSize += size
+        tokensCount += fileTokensCount
+        tokenizingTime += fileTime
+        if args.verbose:
+            print('{:<20} {:>10} {:>8.1f} ms  {}'.format(syntaxName, size, fileTime * 1000, filePath))
+    wallTime = time.perf_counter() - clockBefore
+
+    print('files:           {} tokenized, {} skipped'.format(tokenizedCount, skippedCount))
+    print('tokens:          {}'.format(tokensCount))
+    print('size:            {:.2f} MB'.format(tokenizedSize / _MB))
+    print('time:            {:.2f} s with {} processes'.format(wallTime, args.processes))
+    if wallTime > 0:
+        print('throughput:      {:.2f} MB/s'.format(tokenizedSize / _MB / wallTime))
+    if tokenizingTime > 0:
+        print('per core:        {:.2f} MB/s'.format(tokenizedSize / _MB / tokenizingTime))
+
+
+if __name__ == '__main__':
+    main()